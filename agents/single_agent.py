@@ -1,8 +1,8 @@
+from functools import lru_cache
 from typing import Annotated, Literal
-from datetime import datetime
+from datetime import datetime, timedelta
 from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from langgraph.checkpoint.sqlite import SqliteSaver
-from langchain_community.tools.tavily_search.tool import TavilySearchResults
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import Runnable, RunnableConfig
 from typing_extensions import TypedDict
@@ -12,11 +12,10 @@ from langgraph.prebuilt import tools_condition
 from langgraph.graph.message import AnyMessage, add_messages
 from langchain_openai import ChatOpenAI
 
-import tools.tnb as tnb_tools
-import tools.ocr as ocr_tools
-import tools.database as db_tools
+import tools.registry as registry
 from components.utilities import create_tool_node_with_fallback
-from components.checkpointer import MongoDBSaver, MongoClient, AsyncMongoDBSaver
+from components.checkpointer import MongoDBSaver, MongoClient, AsyncMongoDBSaver, CompressedSerializer, RetentionPolicy
+from components.checkpoint_cache import CachedCheckpointSaver
 from motor.motor_asyncio import AsyncIOMotorClient
 
 import components.initializer as init
@@ -47,8 +46,31 @@ class Assistant:
         return {"messages": result}
 
 
+retention = None
+if init.CHECKPOINT_KEEP_LAST or init.CHECKPOINT_MAX_AGE_HOURS:
+    retention = RetentionPolicy(
+        keep_last=init.CHECKPOINT_KEEP_LAST,
+        max_age=timedelta(hours=init.CHECKPOINT_MAX_AGE_HOURS) if init.CHECKPOINT_MAX_AGE_HOURS else None,
+        use_ttl_index=init.CHECKPOINT_RETENTION_TTL_INDEX,
+    )
+
 checkpointer = AsyncMongoDBSaver(
-    AsyncIOMotorClient(init.CHATBOT_MONGO_CONNECTION_STRING), init.CHATBOT_MONGO_DATABASE, init.CHATBOT_MONGO_COLLECTION)
+    AsyncIOMotorClient(init.CHATBOT_MONGO_CONNECTION_STRING), init.CHATBOT_MONGO_DATABASE, init.CHATBOT_MONGO_COLLECTION,
+    storage_mode=init.CHECKPOINT_STORAGE_MODE, fetch_mode=init.CHECKPOINT_FETCH_MODE,
+    write_behind=init.CHECKPOINT_WRITE_BEHIND, durability=init.CHECKPOINT_DURABILITY,
+    serde=(
+        CompressedSerializer(compress_threshold=init.CHECKPOINT_COMPRESS_THRESHOLD)
+        if init.CHECKPOINT_SERIALIZER == "compressed"
+        else None
+    ),
+    retention=retention)
+if init.CHECKPOINT_CACHE_ENABLED:
+    checkpointer = CachedCheckpointSaver(
+        checkpointer,
+        max_entries=init.CHECKPOINT_CACHE_MAX_ENTRIES,
+        max_bytes=init.CHECKPOINT_CACHE_MAX_BYTES,
+        ttl=init.CHECKPOINT_CACHE_TTL,
+    )
 
 llm = ChatOpenAI(openai_api_key=init.OPENAI_API_KEY, model=init.DEFAULT_CHAT_MODEL)
 
@@ -72,44 +94,52 @@ assistant_prompt = ChatPromptTemplate.from_messages(
 """
 This section establishes all the safe/sensitive tools and that managers and non-managers have access
 """
-manager_safe_tools = [
-    TavilySearchResults(max_results=1),
-    tnb_tools.agent_get_statement_information,
-    tnb_tools.agent_get_all_account_names,
-    db_tools.determine_db_to_query_tool,
-    db_tools.python_repl_tool,
-    ocr_tools.agent_utilise_ocr,
-    ocr_tools.agent_validate_file,
-    tnb_tools.agent_edit_tnb_meter_application,
-    tnb_tools.agent_fill_up_tnb_meter_application
-]
-
-manager_sensitive_tools = [
-    tnb_tools.agent_retrieve_monthly_bill_pdf,
-    tnb_tools.agent_get_electricity_info_for_month,
-]
-
-non_manager_safe_tools = [
-    TavilySearchResults(max_results=1),
-    tnb_tools.agent_get_statement_information,
-    tnb_tools.agent_get_all_account_names,
-    db_tools.determine_db_to_query_tool,
-    db_tools.python_repl_tool,
-    ocr_tools.agent_utilise_ocr,
-    ocr_tools.agent_validate_file,
-    tnb_tools.agent_edit_tnb_meter_application,
-    tnb_tools.agent_fill_up_tnb_meter_application
-]
-
-non_manager_sensitive_tools = [
-    tnb_tools.agent_retrieve_monthly_bill_pdf,
-    tnb_tools.agent_get_electricity_info_for_month,
-]
+# The search, SQL and chart tools come from the registry and are imported on their first
+# call. tools.tnb and tools.ocr are not in the registry yet, they are imported when the
+# graph is built
+def get_tools():
+    import tools.tnb as tnb_tools
+    import tools.ocr as ocr_tools
+
+    manager_safe_tools = [
+        registry.tavily_search_tool,
+        tnb_tools.agent_get_statement_information,
+        tnb_tools.agent_get_all_account_names,
+        registry.determine_db_to_query_tool,
+        registry.python_repl_tool,
+        ocr_tools.agent_utilise_ocr,
+        ocr_tools.agent_validate_file,
+        tnb_tools.agent_edit_tnb_meter_application,
+        tnb_tools.agent_fill_up_tnb_meter_application
+    ]
+
+    manager_sensitive_tools = [
+        tnb_tools.agent_retrieve_monthly_bill_pdf,
+        tnb_tools.agent_get_electricity_info_for_month,
+    ]
+
+    non_manager_safe_tools = [
+        registry.tavily_search_tool,
+        tnb_tools.agent_get_statement_information,
+        tnb_tools.agent_get_all_account_names,
+        registry.determine_db_to_query_tool,
+        registry.python_repl_tool,
+        ocr_tools.agent_utilise_ocr,
+        ocr_tools.agent_validate_file,
+        tnb_tools.agent_edit_tnb_meter_application,
+        tnb_tools.agent_fill_up_tnb_meter_application
+    ]
+
+    non_manager_sensitive_tools = [
+        tnb_tools.agent_retrieve_monthly_bill_pdf,
+        tnb_tools.agent_get_electricity_info_for_month,
+    ]
+    return manager_safe_tools, manager_sensitive_tools, non_manager_safe_tools, non_manager_sensitive_tools
 
 # Provides differnet tools to agent depneding on manager status
 def check_manager(manager_status):
+    manager_safe_tools, manager_sensitive_tools, non_manager_safe_tools, non_manager_sensitive_tools = get_tools()
     if manager_status == "manager":
-        sensitive_tools = {t.name for t in manager_sensitive_tools}
         # Our LLM doesn't have to know which nodes it has to route to. In its 'mind', it's just invoking functions.
         single_agent_assistant_runnable = assistant_prompt | llm.bind_tools(
             manager_safe_tools + manager_sensitive_tools
@@ -117,48 +147,55 @@ def check_manager(manager_status):
         return single_agent_assistant_runnable, manager_safe_tools, manager_sensitive_tools
     
     else:
-        sensitive_tools = {t.name for t in non_manager_safe_tools}
         # Our LLM doesn't have to know which nodes it has to route to. In its 'mind', it's just invoking functions.
         single_agent_assistant_runnable = assistant_prompt | llm.bind_tools(
             non_manager_safe_tools + non_manager_sensitive_tools
         )
         return single_agent_assistant_runnable, non_manager_safe_tools, non_manager_sensitive_tools
 
-single_agent_assistant_runnable, single_agent_safe_tools, single_agent_sensitive_tools = check_manager(init.MANAGER_STATUS)
 
 # DEFINE THE GRAPH
-builder = StateGraph(State)
-builder.add_node("assistant", Assistant(single_agent_assistant_runnable))
-builder.add_node("safe_tools", create_tool_node_with_fallback(single_agent_safe_tools))
-builder.add_node(
-    "sensitive_tools", create_tool_node_with_fallback(single_agent_sensitive_tools)
-)
-
-sensitive_tools = {t.name for t in non_manager_sensitive_tools + manager_sensitive_tools}
-def route_tools(state: State) -> Literal["safe_tools", "sensitive_tools", "__end__"]:
-    next_node = tools_condition(state)
-    # If no tools are invoked, return to the user
-    if next_node == END:
-        return END
-    ai_message = state["messages"][-1]
-    # This assumes single tool calls. To handle parallel tool calling, you'd want to
-    # use an ANY condition
-    first_tool_call = ai_message.tool_calls[0]
-    if first_tool_call["name"] in sensitive_tools:
-        return "sensitive_tools"
-    return "safe_tools"
-
-builder.add_conditional_edges(
-    "assistant",
-    route_tools,
-)
-builder.add_edge(START, "assistant")
-builder.add_edge("safe_tools", "assistant")
-builder.add_edge("sensitive_tools", "assistant")
-
-
-memory = AsyncSqliteSaver.from_conn_string(":memory:")
-single_agent_graph = builder.compile(
-    checkpointer=checkpointer,
-    interrupt_before=["sensitive_tools"],
-)
+@lru_cache(maxsize=None)
+def get_single_agent_graph():
+    """Build and compile the graph on first use, importing the tools it needs."""
+    single_agent_assistant_runnable, single_agent_safe_tools, single_agent_sensitive_tools = check_manager(init.MANAGER_STATUS)
+    sensitive_tools = {t.name for t in single_agent_sensitive_tools}
+
+    def route_tools(state: State) -> Literal["safe_tools", "sensitive_tools", "__end__"]:
+        next_node = tools_condition(state)
+        # If no tools are invoked, return to the user
+        if next_node == END:
+            return END
+        ai_message = state["messages"][-1]
+        # This assumes single tool calls. To handle parallel tool calling, you'd want to
+        # use an ANY condition
+        first_tool_call = ai_message.tool_calls[0]
+        if first_tool_call["name"] in sensitive_tools:
+            return "sensitive_tools"
+        return "safe_tools"
+
+    builder = StateGraph(State)
+    builder.add_node("assistant", Assistant(single_agent_assistant_runnable))
+    builder.add_node("safe_tools", create_tool_node_with_fallback(single_agent_safe_tools))
+    builder.add_node(
+        "sensitive_tools", create_tool_node_with_fallback(single_agent_sensitive_tools)
+    )
+    builder.add_conditional_edges(
+        "assistant",
+        route_tools,
+    )
+    builder.add_edge(START, "assistant")
+    builder.add_edge("safe_tools", "assistant")
+    builder.add_edge("sensitive_tools", "assistant")
+
+    return builder.compile(
+        checkpointer=checkpointer,
+        interrupt_before=["sensitive_tools"],
+    )
+
+
+def __getattr__(name):
+    # single_agent_graph used to be compiled at import
+    if name == "single_agent_graph":
+        return get_single_agent_graph()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
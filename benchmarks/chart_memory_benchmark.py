@@ -0,0 +1,130 @@
+"""Measure the peak memory of producing one chart, before and after the raw image frames.
+
+Before: the chart code ran in the API process, printed the base64 of the PNG to stdout,
+and the API split it out of the output, decoded it and wrapped it in a BytesIO for the
+upload, holding the image about four times over (figure buffer, base64 string, printed
+output, decoded bytes). After: the worker saves the figure into one buffer and writes it
+to the pipe as is, and the API process holds the image bytes once, handed to the upload.
+
+Peaks are measured with tracemalloc, so they count Python allocations only, not the
+memory of the renderer itself.
+
+Usage:
+    python -m benchmarks.chart_memory_benchmark [--points 100000] [--format png] [--dpi 100] [--repeat 5]
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import statistics
+import tracemalloc
+
+from components.chart_pool import ChartPool, _run_chart
+
+CHART_CODE = """
+import numpy as np
+import matplotlib.pyplot as plt
+x = np.random.rand({points})
+plt.figure(figsize=(10, 6))
+plt.scatter(x, np.random.rand({points}), s=1)
+plt.title("benchmark")
+"""
+
+# What the REPL tool did before the chart pool
+BASE64_SUFFIX = """
+import base64, io
+buffer = io.BytesIO()
+plt.savefig(buffer, format="{image_format}", dpi={dpi})
+print("IMAGE_BASE64:" + base64.b64encode(buffer.getvalue()).decode())
+"""
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def before(code: str, image_format: str, dpi) -> int:
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        exec(code + BASE64_SUFFIX.format(image_format=image_format, dpi=dpi), {})
+    import matplotlib.pyplot as plt
+
+    plt.close("all")
+    encoded = output.getvalue().split("IMAGE_BASE64:")[1].strip()
+    file_bytes = io.BytesIO(base64.b64decode(encoded))
+    return len(file_bytes.getvalue())
+
+
+def after_worker(code: str, image_format: str, dpi) -> int:
+    result = _run_chart(code, timeout=60, cpu_seconds=None, image_format=image_format, dpi=dpi)
+    size = len(result["image"])
+    result["image"].release()
+    return size
+
+
+async def after_api(pool: ChartPool, code: str) -> int:
+    # The API side only holds the bytes read from the pipe
+    tracemalloc.start()
+    try:
+        result = await pool.arender(code)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    if result["error"]:
+        raise RuntimeError(result["error"])
+    return peak
+
+
+def mb(values) -> str:
+    return f"{statistics.median(values) / 2**20:>9.2f} {max(values) / 2**20:>9.2f}"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--points", type=int, default=100_000)
+    parser.add_argument("--format", default="png")
+    parser.add_argument("--dpi", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    import matplotlib
+
+    matplotlib.use("Agg")
+    code = CHART_CODE.format(points=args.points)
+    # Warm up the imports so they are not counted in the first run
+    before(code, args.format, args.dpi)
+
+    befores, workers, sizes = [], [], []
+    for _ in range(args.repeat):
+        size, peak = measure(before, code, args.format, args.dpi)
+        befores.append(peak)
+        sizes.append(size)
+        _, peak = measure(after_worker, code, args.format, args.dpi)
+        workers.append(peak)
+
+    async def run_pool():
+        pool = ChartPool(max_workers=1, image_format=args.format, dpi=args.dpi, max_bytes=None)
+        try:
+            await pool.astart()
+            return [await after_api(pool, code) for _ in range(args.repeat)]
+        finally:
+            await pool.aclose()
+
+    apis = asyncio.run(run_pool())
+
+    print(f"{args.points} points, {args.format} at {args.dpi} dpi, image of {statistics.median(sizes) / 2**20:.2f} MB")
+    print(f"{'peak traced memory':<34} {'median MB':>9} {'max MB':>9}")
+    print(f"{'before (in process, base64)':<34} {mb(befores)}")
+    print(f"{'after, worker (one buffer)':<34} {mb(workers)}")
+    print(f"{'after, API process (raw bytes)':<34} {mb(apis)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Profile the imports of the app modules and check them against the import budget.
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter, prints the
+slowest imports by cumulative time and fails when a module imports something the budget
+forbids (heavy dependencies that are meant to load on first use) or takes longer than its
+optional max_seconds.
+
+Usage:
+    BACKEND=local python -m benchmarks.import_profile [--module agents.single_agent] [--top 25]
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+BUDGET_FILE = os.path.join(os.path.dirname(__file__), "import_budget.json")
+LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)$")
+
+
+def profile(module: str) -> list:
+    """Returns (module, self seconds, cumulative seconds, depth) for every import, in import order."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{proc.stderr[-2000:]}")
+    imports = []
+    for line in proc.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append((name, int(self_us) / 1e6, int(cumulative_us) / 1e6, (len(indent) - 1) // 2))
+    return imports
+
+
+def check(module: str, imports: list, budget: dict) -> list:
+    names = {name for name, _, _, _ in imports}
+    errors = [
+        f"{module} imports {name}, forbidden by {forbidden}"
+        for forbidden in budget.get("forbidden", [])
+        for name in sorted(names)
+        if name == forbidden or name.startswith(forbidden + ".")
+    ]
+    total = next((cumulative for name, _, cumulative, _ in imports if name == module), None)
+    if total is not None and budget.get("max_seconds") is not None and total > budget["max_seconds"]:
+        errors.append(f"{module} takes {total:.2f}s to import, over its budget of {budget['max_seconds']:.2f}s")
+    return errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", nargs="+", help="Modules to profile. Defaults to every module of the budget")
+    parser.add_argument("--top", type=int, default=25)
+    parser.add_argument("--budget", default=BUDGET_FILE)
+    args = parser.parse_args()
+
+    with open(args.budget) as f:
+        budgets = json.load(f)
+    errors = []
+    for module in args.module or list(budgets):
+        imports = profile(module)
+        total = next((cumulative for name, _, cumulative, _ in imports if name == module), 0.0)
+        print(f"\n{module}: {total:.3f}s, {len(imports)} modules")
+        print(f"{'cumulative s':>12} {'self s':>8}  module")
+        for name, self_s, cumulative, depth in sorted(imports, key=lambda i: -i[2])[: args.top]:
+            print(f"{cumulative:>12.3f} {self_s:>8.3f}  {'  ' * depth}{name}")
+        errors.extend(check(module, imports, budgets.get(module, {})))
+
+    if errors:
+        print("\nImport budget exceeded:")
+        for error in errors:
+            print(f"  {error}")
+        sys.exit(1)
+    print("\nImport budget OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Compare the memory of running both frontends in one process with running them in two.
+
+Starts `python main.py all` (the API and the Telegram bot in one event loop), measures it,
+stops it, then starts the API (one uvicorn worker) and `python telegram_bot.py` side by side
+and measures both. The bot talks to the fake Bot API of the load test, so no token or
+network is needed. A setup is measured once its API answers /ready (or --settle seconds
+have passed), and its memory is the RSS and PSS summed over the processes and all their
+children, chart workers included. PSS counts shared pages once, so it is the better
+measure of what the setups cost a host.
+
+Usage:
+    BACKEND=local python -m benchmarks.memory_footprint [--settle 60]
+"""
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import uvicorn
+
+from benchmarks.telegram_load_test import fake_bot_api, free_port
+
+
+def tree(pid: int) -> list:
+    """pid and all its descendants."""
+    pids = [pid]
+    for child in _children(pid):
+        pids.extend(tree(child))
+    return pids
+
+
+def _children(pid: int) -> list:
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def memory(pid: int) -> dict:
+    """RSS and PSS in MB of a process tree, from /proc/<pid>/smaps_rollup."""
+    total = {"rss": 0.0, "pss": 0.0, "processes": 0}
+    for member in tree(pid):
+        try:
+            with open(f"/proc/{member}/smaps_rollup") as f:
+                for line in f:
+                    field, value = line.split(":", 1)
+                    if field in ("Rss", "Pss"):
+                        total[field.lower()] += int(value.split()[0]) / 1024
+        except OSError:
+            continue
+        total["processes"] += 1
+    return total
+
+
+def wait_ready(port: int, deadline: float) -> None:
+    # 503 while warming up; a failed warm-up (missing backends) also counts as done
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=2)
+            return
+        except urllib.error.HTTPError as e:
+            if b'"starting"' not in e.read():
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+
+
+def measure(commands: list, port: int, env: dict, settle: float) -> dict:
+    procs = [subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for command in commands]
+    try:
+        wait_ready(port, time.monotonic() + settle)
+        # Let the bot finish starting and the chart workers import their modules
+        time.sleep(5)
+        for proc in procs:
+            if proc.poll() is not None:
+                raise RuntimeError(f"{' '.join(commands[procs.index(proc)])} exited with {proc.returncode}")
+        results = [memory(proc.pid) for proc in procs]
+    finally:
+        for proc in procs:
+            proc.send_signal(signal.SIGTERM)
+        for proc in procs:
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+    return {key: sum(result[key] for result in results) for key in ("rss", "pss", "processes")}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--settle", type=float, default=60, help="Seconds to wait for /ready at most")
+    args = parser.parse_args()
+
+    # The fake Bot API runs in a thread of this process for both setups
+    fake_port = free_port()
+    server = uvicorn.Server(uvicorn.Config(fake_bot_api([], asyncio.Event(), 0), port=fake_port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    env = dict(
+        os.environ,
+        TELEGRAM_API_KEY=os.environ.get("TELEGRAM_API_KEY", "123456:fake-token-for-load-test"),
+        TELEGRAM_BASE_URL=f"http://127.0.0.1:{fake_port}/bot",
+    )
+    env.pop("TELEGRAM_WEBHOOK_URL", None)
+    port = free_port()
+    one = measure([[sys.executable, "main.py", "all", "--port", str(port)]], port, env, args.settle)
+    two = measure(
+        [
+            [sys.executable, "-m", "uvicorn", "components.routes:app", "--port", str(port), "--workers", "1"],
+            [sys.executable, "telegram_bot.py"],
+        ],
+        port,
+        env,
+        args.settle,
+    )
+    server.should_exit = True
+
+    print(f"{'':<30} {'RSS MB':>9} {'PSS MB':>9} {'processes':>10}")
+    print(f"{'one process (main.py all)':<30} {one['rss']:>9.1f} {one['pss']:>9.1f} {one['processes']:>10}")
+    print(f"{'two processes (api + bot)':<30} {two['rss']:>9.1f} {two['pss']:>9.1f} {two['processes']:>10}")
+    print(f"{'saved':<30} {two['rss'] - one['rss']:>9.1f} {two['pss'] - one['pss']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Compare checkpoint size and encode/decode time of the checkpoint serializers.
+
+Builds checkpoints holding realistic financial conversations (SQL agent results, OCR
+extractions, chart links) of increasing length and serializes them with each serializer.
+
+Usage:
+    python -m benchmarks.serde_benchmark [--turns 10 50 200] [--repeat 5]
+"""
+import argparse
+import json
+import time
+import uuid
+
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from components.checkpointer import CompressedSerializer, JsonPlusSerializerCompat, msgpack, zstandard
+
+
+def sql_result(turn: int) -> str:
+    rows = [
+        f"('2024-{month:02d}-01', 'Suria KLCC', 'Utilities', {1000 + turn * 17 + month * 131:.2f})"
+        for month in range(1, 13)
+    ]
+    return "[" + ", ".join(rows) + "]"
+
+
+def ocr_result(turn: int) -> str:
+    return json.dumps(
+        {
+            "account_number": f"22001{turn:07d}",
+            "bill_date": "2024-06-30",
+            "due_date": "2024-07-21",
+            "items": [
+                {"description": f"Usage block {i}", "kwh": 200 + i * 13, "rate": 0.218 + i / 100, "amount": 43.6 + i}
+                for i in range(20)
+            ],
+            "total_amount": 1234.56 + turn,
+        }
+    )
+
+
+def conversation(turns: int) -> list:
+    messages = []
+    for turn in range(turns):
+        tool_call_id = f"call_{uuid.uuid4().hex[:24]}"
+        if turn % 2:
+            question = "What was the total utilities spend for Suria per month last year?"
+            tool_name, tool_output = "determine_db_to_query_tool", sql_result(turn)
+            args = {"user_input": question}
+        else:
+            question = "Extract the account number, dates and line items from this bill https://storage.googleapis.com/bills/x.pdf"
+            tool_name, tool_output = "agent_utilise_ocr", ocr_result(turn)
+            args = {"file_link": "https://storage.googleapis.com/bills/x.pdf"}
+        messages.extend(
+            [
+                HumanMessage(content=question, id=str(uuid.uuid4())),
+                AIMessage(
+                    content="",
+                    id=str(uuid.uuid4()),
+                    tool_calls=[{"name": tool_name, "args": args, "id": tool_call_id}],
+                ),
+                ToolMessage(content=tool_output, tool_call_id=tool_call_id, id=str(uuid.uuid4())),
+                AIMessage(content="Here is the summary of the result: " + tool_output[:400], id=str(uuid.uuid4())),
+            ]
+        )
+    return messages
+
+
+def checkpoint(turns: int) -> dict:
+    return {
+        "v": 1,
+        "id": str(uuid.uuid4()),
+        "ts": "2024-09-01T00:00:00+00:00",
+        "channel_values": {"messages": conversation(turns)},
+        "channel_versions": {"__start__": 2, "messages": turns * 4, "assistant": turns * 2},
+        "versions_seen": {"assistant": {"messages": turns * 4 - 1}},
+        "pending_sends": [],
+    }
+
+
+def measure(serializer, obj, repeat: int) -> tuple:
+    encode, decode = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        type_, data = serializer.dumps_typed(obj)
+        encode.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        serializer.loads_typed((type_, data))
+        decode.append(time.perf_counter() - start)
+    return type_, len(data), min(encode) * 1000, min(decode) * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    serializers = [("json", JsonPlusSerializerCompat()), ("compressed zlib", CompressedSerializer(compression="zlib"))]
+    if zstandard is not None:
+        serializers.append(("compressed zstd", CompressedSerializer(compression="zstd")))
+    print(f"msgpack installed: {msgpack is not None}, zstandard installed: {zstandard is not None}")
+    print(f"{'turns':>6} {'serializer':<16} {'type':<14} {'bytes':>10} {'ratio':>6} {'encode ms':>10} {'decode ms':>10}")
+    for turns in args.turns:
+        obj = checkpoint(turns)
+        baseline = None
+        for name, serializer in serializers:
+            type_, size, encode_ms, decode_ms = measure(serializer, obj, args.repeat)
+            baseline = baseline or size
+            print(f"{turns:>6} {name:<16} {type_:<14} {size:>10} {size / baseline:>6.2f} {encode_ms:>10.2f} {decode_ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Measure the cold start of API workers: time to import the app and time to warm up.
+
+Every run starts fresh interpreters, like uvicorn starting its workers, and records in each
+of them how long importing the app takes (after which the worker can serve, with /ready
+returning 503) and how long the warm-up of the lifespan then takes (after which /ready
+returns 200). Before the lazy startup every secret fetch and database connection happened
+during the import, so the old cold start is roughly import + warm-up, paid serially.
+
+Usage:
+    BACKEND=local python -m benchmarks.startup_benchmark [--workers 4] [--repeat 3]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+WORKER = """
+import asyncio, json, time
+start = time.perf_counter()
+import {module} as app_module
+imported = time.perf_counter()
+if {warm_up}:
+    asyncio.run(app_module.warm_up())
+warmed_up = time.perf_counter()
+print(json.dumps({{"import": imported - start, "warm_up": warmed_up - imported}}))
+"""
+
+
+def run_workers(module: str, workers: int, warm_up: bool) -> tuple:
+    start = time.perf_counter()
+    procs = [
+        subprocess.Popen(
+            [sys.executable, "-c", WORKER.format(module=module, warm_up=warm_up)],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        for _ in range(workers)
+    ]
+    results = []
+    for proc in procs:
+        out, _ = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(f"Worker exited with {proc.returncode}")
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    return results, time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="components.routes")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-warm-up", action="store_true", help="Only measure the import")
+    args = parser.parse_args()
+
+    imports, warm_ups, walls = [], [], []
+    for _ in range(args.repeat):
+        results, wall = run_workers(args.module, args.workers, not args.no_warm_up)
+        imports.extend(result["import"] for result in results)
+        warm_ups.extend(result["warm_up"] for result in results)
+        walls.append(wall)
+
+    print(f"{args.workers} workers x {args.repeat} runs of {args.module}")
+    print(f"{'':<28} {'median s':>9} {'max s':>9}")
+    print(f"{'import (serving)':<28} {statistics.median(imports):>9.2f} {max(imports):>9.2f}")
+    if not args.no_warm_up:
+        print(f"{'warm-up (ready)':<28} {statistics.median(warm_ups):>9.2f} {max(warm_ups):>9.2f}")
+        totals = [i + w for i, w in zip(imports, warm_ups)]
+        print(f"{'import + warm-up':<28} {statistics.median(totals):>9.2f} {max(totals):>9.2f}")
+    print(f"{'all workers ready (wall)':<28} {statistics.median(walls):>9.2f} {max(walls):>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Load test the Telegram bot against a local fake Bot API: updates per second and reply latency.
+
+Starts a fake Bot API server answering getMe, getUpdates, setWebhook and sendMessage, builds the bot in
+webhook mode pointed at it, and puts --updates text updates from --chats chats on the bot's
+update queue, the way the webhook route does. Every reply sent back through the fake API is
+timed from the moment its update was queued, and the replies of each chat are checked to
+arrive in the order of its messages.
+
+By default the agent is simulated by a sleep of --agent-latency seconds that echoes the
+message, so the test measures the bot frontend and not the LLM. --real-agent runs the real
+single agent instead and needs its backends. --concurrency 1 reproduces handling the
+updates one at a time, as the bot did before concurrent updates.
+
+Usage:
+    BACKEND=local python -m benchmarks.telegram_load_test [--updates 500] [--chats 50] [--concurrency 64] [--agent-latency 0.5]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import time
+
+os.environ.setdefault("TELEGRAM_API_KEY", "123456:fake-token-for-load-test")
+
+import uvicorn
+from fastapi import FastAPI, Request
+
+
+def fake_bot_api(replies: list, done: asyncio.Event, expected: int) -> FastAPI:
+    app = FastAPI()
+    message_ids = iter(range(1, 10**9))
+
+    @app.post("/bot{token}/{method}")
+    async def method(token: str, method: str, request: Request):
+        form = dict(await request.form()) if "form" in request.headers.get("content-type", "") else {}
+        if not form and await request.body():
+            form = json.loads(await request.body())
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Load test", "username": "load_test_bot"}
+        elif method == "sendMessage":
+            replies.append((int(form["chat_id"]), form["text"], time.perf_counter()))
+            if len(replies) >= expected:
+                done.set()
+            result = {
+                "message_id": next(message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(form["chat_id"]), "type": "private"},
+                "text": form["text"],
+            }
+        elif method == "getUpdates":
+            # Long polling with nothing to deliver, without holding the client for the full timeout
+            await asyncio.sleep(min(float(form.get("timeout", 0)), 1))
+            result = []
+        else:
+            result = True
+        return {"ok": True, "result": result}
+
+    return app
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_update(update_id: int, chat_id: int, seq: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+            "text": f"{chat_id}:{seq}",
+        },
+    }
+
+
+async def run(args) -> None:
+    import telegram_bot
+    from telegram import Update
+
+    if not args.real_agent:
+        async def simulated_agent(user_input: str, thread_id: str, file=None, request_id=None) -> str:
+            await asyncio.sleep(args.agent_latency)
+            return user_input
+
+        telegram_bot.handle_single_agent_all = simulated_agent
+
+    replies, done = [], asyncio.Event()
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(fake_bot_api(replies, done, args.updates), port=port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    bot = telegram_bot.build_application(
+        webhook=True,
+        concurrent_updates=args.concurrency,
+        base_url=f"http://127.0.0.1:{port}/bot",
+    )
+    await bot.initialize()
+    await bot.start()
+    try:
+        queued_at = {}
+        start = time.perf_counter()
+        for update_id in range(args.updates):
+            chat_id = 1000 + update_id % args.chats
+            seq = update_id // args.chats
+            queued_at[f"{chat_id}:{seq}"] = time.perf_counter()
+            await bot.update_queue.put(Update.de_json(make_update(update_id, chat_id, seq), bot.bot))
+        await asyncio.wait_for(done.wait(), args.timeout)
+        elapsed = time.perf_counter() - start
+    finally:
+        await bot.stop()
+        await bot.shutdown()
+        server.should_exit = True
+        await server_task
+
+    latencies = sorted(at - queued_at[text] for _, text, at in replies if text in queued_at)
+    last_seq, out_of_order = {}, 0
+    for chat_id, text, _ in replies:
+        seq = int(text.split(":")[1])
+        if seq < last_seq.get(chat_id, -1):
+            out_of_order += 1
+        last_seq[chat_id] = seq
+
+    agent = "real agent" if args.real_agent else f"simulated agent of {args.agent_latency}s"
+    print(f"{args.updates} updates from {args.chats} chats, {args.concurrency} concurrent, {agent}")
+    print(f"{'updates/s':<22} {len(replies) / elapsed:>9.1f}")
+    print(f"{'latency p50 s':<22} {statistics.median(latencies):>9.3f}")
+    print(f"{'latency p95 s':<22} {latencies[int(len(latencies) * 0.95) - 1]:>9.3f}")
+    print(f"{'latency max s':<22} {latencies[-1]:>9.3f}")
+    print(f"{'out of order replies':<22} {out_of_order:>9}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=500)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--agent-latency", type=float, default=0.5)
+    parser.add_argument("--real-agent", action="store_true")
+    parser.add_argument("--timeout", type=float, default=600)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
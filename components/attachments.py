@@ -0,0 +1,249 @@
+# streaming ingestion of chat attachments into the bucket
+import asyncio
+import io
+import logging
+import mimetypes
+import os
+import queue
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+import httpx
+
+import components.gcs_bucket as gcs
+import components.initializer as init
+
+logger = logging.getLogger(__name__)
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+def file_extension(file_name: Optional[str], mime_type: Optional[str], default: str = "bin") -> str:
+    """Extension of an attachment, from its name or else its MIME type."""
+    if file_name and os.path.splitext(file_name)[1]:
+        return os.path.splitext(file_name)[1][1:].lower()
+    extension = mimetypes.guess_extension(mime_type or "")
+    return extension[1:] if extension else default
+
+
+_EOF = object()
+
+
+class _ChunkReader(io.RawIOBase):
+    """A read-only stream over chunks pushed from the event loop, read by an upload thread.
+
+    At most max_chunks chunks are buffered, the download waits for the upload beyond that,
+    so memory stays bounded whatever the size of the file.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_chunks: int) -> None:
+        self._loop = loop
+        self._chunks: "queue.Queue[Any]" = queue.Queue()
+        self._slots = asyncio.Semaphore(max_chunks)
+        self._buffer = b""
+        self._position = 0
+        self._eof = False
+
+    async def aput(self, chunk: bytes, upload: asyncio.Future) -> None:
+        """Push a chunk, waiting for a free slot unless the upload has stopped reading."""
+        acquire = asyncio.ensure_future(self._slots.acquire())
+        await asyncio.wait({acquire, upload}, return_when=asyncio.FIRST_COMPLETED)
+        if not acquire.done():
+            acquire.cancel()
+            return
+        self._chunks.put(chunk)
+
+    def close_input(self, error: Optional[Exception] = None) -> None:
+        """Mark the end of the file, or make the upload fail with error instead of uploading a truncated file."""
+        self._chunks.put(error or _EOF)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # The resumable upload seeks to where it already is, nothing else can be served
+        if whence == io.SEEK_SET and offset == self._position:
+            return self._position
+        raise io.UnsupportedOperation("Streamed attachments can only be read forward")
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            chunk = self._chunks.get()
+            if chunk is _EOF:
+                self._eof = True
+            elif isinstance(chunk, Exception):
+                raise chunk
+            else:
+                self._loop.call_soon_threadsafe(self._slots.release)
+                self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._position += len(data)
+        return data
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+
+class AttachmentPipeline:
+    """Downloads attachments with a pooled async HTTP client and streams them into the bucket.
+
+    Files up to the chunk size of the GCS service are downloaded into memory and uploaded in
+    one request. Larger files are streamed: the download feeds a resumable upload chunk by
+    chunk, so a worker holds at most a couple of chunks of a file however large it is. Files
+    over max_bytes are refused before the download when their size is known, and as soon as
+    the download goes over otherwise.
+
+    Args:
+        max_bytes (int): The largest attachment accepted. Defaults to 20MB, the Bot API download limit.
+        max_connections (int): The maximum number of downloads at once. Defaults to 20.
+        read_chunk_size (int): Bytes per chunk read from the download. Defaults to 256KB.
+        buffered_chunks (int): Chunks buffered between the download and the upload. Defaults to 16.
+        timeout (float): Seconds before a download stalls out. Defaults to 60.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 20 * 1024 * 1024,
+        max_connections: int = 20,
+        read_chunk_size: int = 256 * 1024,
+        buffered_chunks: int = 16,
+        timeout: float = 60,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.read_chunk_size = read_chunk_size
+        self.buffered_chunks = buffered_chunks
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._client: Optional[httpx.AsyncClient] = None
+        self.files = 0
+        self.refused = 0
+        self.bytes = 0
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            )
+        return self._client
+
+    def check_size(self, size: Optional[int]) -> None:
+        if size is not None and size > self.max_bytes:
+            self.refused += 1
+            raise AttachmentTooLarge(
+                f"The file is {size / 2**20:.1f}MB, files up to {self.max_bytes / 2**20:.0f}MB are accepted"
+            )
+
+    async def aingest(
+        self,
+        url: str,
+        extension: str,
+        size: Optional[int] = None,
+        cred_path: Optional[str] = None,
+        bucket_name: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """Download a file and upload it to the bucket.
+
+        Args:
+            url (str): Where to download the file from.
+            extension (str): The file extension, used in the blob name and content type.
+            size (Optional[int]): The size of the file when known beforehand.
+            cred_path (Optional[str]): The service account file of the bucket.
+            bucket_name (Optional[str]): The bucket. Defaults to GCS_BUCKET_NAME.
+
+        Returns:
+            Dict[str, Any]: "link" to the uploaded file, its "bytes" and the seconds of each stage in "timings".
+        """
+        self.check_size(size)
+        bucket_name = bucket_name or init.GCS_BUCKET_NAME
+        blob_name = f"{uuid.uuid4().hex}.{extension}"
+        start = time.perf_counter()
+        async with self.client.stream("GET", url) as response:
+            response.raise_for_status()
+            if response.headers.get("content-length"):
+                size = int(response.headers["content-length"])
+                self.check_size(size)
+            connected = time.perf_counter()
+            service = gcs.get_service(cred_path) if init.BACKEND != "local" else None
+            if service is None or (size is not None and size <= service.chunk_size):
+                data = await self._aread(response)
+            else:
+                data = None
+                received = await self._astream(response, service, blob_name, bucket_name, extension)
+                uploaded = time.perf_counter()
+                link = service.download_link(bucket_name, blob_name)
+                timings = {"connect": connected - start, "transfer": uploaded - connected, "link": time.perf_counter() - uploaded}
+        if data is not None:
+            # Small files are uploaded in one request, after the download connection went back to the pool
+            downloaded = time.perf_counter()
+            link = await gcs.upload_and_download_file(
+                cred_path=cred_path, file_bytes=data, file_extension=extension,
+                blob_name=blob_name, bucket_name=bucket_name,
+            )
+            received = len(data)
+            timings = {"connect": connected - start, "download": downloaded - connected, "upload": time.perf_counter() - downloaded}
+        self.files += 1
+        self.bytes += received
+        timings["total"] = time.perf_counter() - start
+        logger.info(
+            "Ingested %s (%d bytes): %s", blob_name, received,
+            ", ".join(f"{stage} {seconds * 1000:.0f}ms" for stage, seconds in timings.items()),
+        )
+        return {"link": link, "bytes": received, "timings": timings}
+
+    async def _aread(self, response: httpx.Response) -> bytes:
+        buffer = bytearray()
+        async for chunk in response.aiter_bytes(self.read_chunk_size):
+            buffer += chunk
+            self.check_size(len(buffer))
+        return bytes(buffer)
+
+    async def _astream(
+        self,
+        response: httpx.Response,
+        service: "gcs.GCSService",
+        blob_name: str,
+        bucket_name: str,
+        extension: str,
+    ) -> int:
+        reader = _ChunkReader(asyncio.get_running_loop(), self.buffered_chunks)
+        # Size unknown to the upload, so it goes up resumably, chunk by chunk as the download arrives
+        upload = asyncio.ensure_future(service.aupload(reader, blob_name, bucket_name, extension))
+        received = 0
+        try:
+            async for chunk in response.aiter_bytes(self.read_chunk_size):
+                received += len(chunk)
+                self.check_size(received)
+                if upload.done():
+                    break
+                await reader.aput(chunk, upload)
+        except BaseException as e:
+            reader.close_input(IOError(f"Download of {blob_name} failed: {e!r}"))
+            # The upload thread stops at the error, wait for it so nothing is left running
+            await asyncio.gather(upload, return_exceptions=True)
+            raise
+        reader.close_input()
+        await upload
+        return received
+
+    def stats(self) -> Dict[str, Any]:
+        return {"files": self.files, "refused": self.refused, "bytes": self.bytes}
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
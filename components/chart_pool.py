@@ -0,0 +1,323 @@
+# process pool running the chart code written by the agent
+# Also the entry point of the chart workers (python -m components.chart_pool), so it
+# must not import the app
+import asyncio
+import contextlib
+import io
+import os
+import pickle
+import resource
+import shutil
+import signal
+import struct
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Optional
+
+# Imported by every worker before it reports ready
+PRELOAD_MODULES = ["matplotlib", "matplotlib.pyplot", "numpy", "pandas"]
+BASE_DIR = Path(__file__).resolve().parent.parent
+# The only variables the workers inherit, so the agent's chart code cannot read the API keys
+# and connection strings of the app from os.environ
+WORKER_ENV_KEYS = ["PATH", "LANG", "LC_ALL", "TZ", "VIRTUAL_ENV", "MPLCONFIGDIR", "TMPDIR"]
+
+
+def _worker_env(workdir: str) -> Dict[str, str]:
+    env = {key: os.environ[key] for key in WORKER_ENV_KEYS if key in os.environ}
+    # The worker runs in its own empty directory, the app package is found through PYTHONPATH
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(BASE_DIR), os.environ.get("PYTHONPATH")]))
+    env["HOME"] = workdir
+    env["MPLBACKEND"] = "Agg"
+    return env
+
+
+class ChartTimeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise ChartTimeout("Chart code ran out of time")
+
+
+def _write_frame(stream: BinaryIO, obj: Any, payload: Optional[memoryview] = None) -> None:
+    # Header: length of the pickled object, length of the raw payload or -1 for None.
+    # The payload (the image) is written as is, never pickled or copied into the frame
+    data = pickle.dumps(obj)
+    stream.write(struct.pack(">Ii", len(data), -1 if payload is None else len(payload)))
+    stream.write(data)
+    if payload is not None:
+        stream.write(payload)
+    stream.flush()
+
+
+def _read_frame(stream: BinaryIO) -> Any:
+    header = stream.read(8)
+    if len(header) < 8:
+        return None
+    size, _ = struct.unpack(">Ii", header)
+    return pickle.loads(stream.read(size))
+
+
+def _run_chart(
+    code: str,
+    timeout: float,
+    cpu_seconds: Optional[float],
+    image_format: str = "png",
+    dpi: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Run chart code in a worker and return a view of the current figure's image, with what the code printed."""
+    import matplotlib.pyplot as plt
+
+    output = io.StringIO()
+    image, error = None, None
+    # Only the soft limit moves, the worker could not raise the hard limit back
+    cpu_limit = resource.getrlimit(resource.RLIMIT_CPU)
+    if cpu_seconds:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        resource.setrlimit(resource.RLIMIT_CPU, (int(usage.ru_utime + usage.ru_stime + cpu_seconds) + 1, cpu_limit[1]))
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        with contextlib.redirect_stdout(output):
+            # Fresh globals for every job, nothing leaks between users
+            exec(code, {"__name__": "__chart__"})
+        if plt.get_fignums():
+            buffer = io.BytesIO()
+            plt.gcf().savefig(buffer, format=image_format, dpi=dpi)
+            if max_bytes and buffer.tell() > max_bytes:
+                raise ValueError(
+                    f"The chart is {buffer.tell()} bytes, over the limit of {max_bytes}. Draw fewer points or a smaller figure"
+                )
+            image = buffer.getbuffer()
+    except BaseException as e:
+        error = repr(e)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        resource.setrlimit(resource.RLIMIT_CPU, cpu_limit)
+        plt.close("all")
+    return {"image": image, "output": output.getvalue(), "error": error}
+
+
+def serve(memory_limit_mb: Optional[int]) -> None:
+    """Main loop of a chart worker: read a job from stdin, write its result to stdout."""
+    # The protocol gets private copies of stdin and stdout, anything the chart code
+    # writes to the real ones goes to stderr instead
+    jobs = os.fdopen(os.dup(0), "rb")
+    results = os.fdopen(os.dup(1), "wb")
+    os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+    os.dup2(2, 1)
+
+    import importlib
+    import matplotlib
+
+    matplotlib.use("Agg")
+    for module in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+    if memory_limit_mb:
+        # Allocations above the limit raise MemoryError in the job instead of growing the worker
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, resource.getrlimit(resource.RLIMIT_AS)[1]))
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.signal(signal.SIGXCPU, _raise_timeout)
+
+    _write_frame(results, {"ready": os.getpid()})
+    while True:
+        job = _read_frame(jobs)
+        if job is None:
+            return
+        result = _run_chart(**job)
+        image = result.pop("image")
+        _write_frame(results, result, image)
+        if image is not None:
+            image.release()
+
+
+class ChartWorker:
+    """One warm worker process, used by one job at a time.
+
+    The worker starts in an empty temporary directory of its own, never in the app
+    directory that holds .env and the service account files, and as user when one is given.
+    """
+
+    def __init__(self, process: asyncio.subprocess.Process, workdir: str) -> None:
+        self.process = process
+        self.workdir = workdir
+
+    @classmethod
+    async def astart(cls, memory_limit_mb: Optional[int], user: Optional[str] = None) -> "ChartWorker":
+        workdir = tempfile.mkdtemp(prefix="chart-worker-")
+        try:
+            if user:
+                shutil.chown(workdir, user=user)
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "components.chart_pool", str(memory_limit_mb or 0),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                cwd=workdir,
+                env=_worker_env(workdir),
+                user=user,
+            )
+        except BaseException:
+            shutil.rmtree(workdir, ignore_errors=True)
+            raise
+        worker = cls(process, workdir)
+        if await worker._aread() is None:
+            worker.kill()
+            raise RuntimeError("Chart worker exited during startup")
+        return worker
+
+    async def arun(self, job: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        data = pickle.dumps(job)
+        self.process.stdin.write(struct.pack(">Ii", len(data), -1))
+        self.process.stdin.write(data)
+        await self.process.stdin.drain()
+        return await self._aread()
+
+    async def _aread(self) -> Optional[Any]:
+        try:
+            size, payload_size = struct.unpack(">Ii", await self.process.stdout.readexactly(8))
+            result = pickle.loads(await self.process.stdout.readexactly(size))
+            # The image bytes as read from the pipe, handed on without another copy
+            result["image"] = await self.process.stdout.readexactly(payload_size) if payload_size >= 0 else None
+            return result
+        except asyncio.IncompleteReadError:
+            return None
+
+    def kill(self) -> None:
+        if self.process.returncode is None:
+            self.process.kill()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class ChartPool:
+    """A warm pool of processes running chart code, off the API process and its GIL.
+
+    Every worker is a separate interpreter that has already imported matplotlib, NumPy
+    and pandas, with a memory limit on its address space. A job runs with fresh globals,
+    a wall-clock timeout and a CPU-time limit, and its figures are closed afterwards. A
+    worker that does not answer within timeout plus a grace period, or that dies, is
+    killed and replaced without affecting the jobs running on the other workers.
+
+    Workers start in empty temporary directories with a scrubbed environment. Set
+    worker_user to a user without access to the app directory so chart code cannot read
+    the secret files either; this needs the app to run as root.
+
+    Args:
+        max_workers (int): The number of worker processes. Defaults to the number of CPUs.
+        timeout (float): Seconds a job may run. Defaults to 30.
+        cpu_seconds (Optional[float]): CPU seconds a job may use. Defaults to 20.
+        memory_limit_mb (Optional[int]): Address space limit of each worker in MB. Defaults to 1024.
+        image_format (str): The matplotlib format of the images, e.g. "png", "webp" or "svg". Defaults to "png".
+        dpi (Optional[int]): The resolution of the images. Defaults to the matplotlib default.
+        max_bytes (Optional[int]): Images above this size are refused. Defaults to 5MB.
+        worker_user (Optional[str]): The user the workers run as. Defaults to the user of the app.
+    """
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        timeout: float = 30,
+        cpu_seconds: Optional[float] = 20,
+        memory_limit_mb: Optional[int] = 1024,
+        image_format: str = "png",
+        dpi: Optional[int] = None,
+        max_bytes: Optional[int] = 5 * 1024 * 1024,
+        worker_user: Optional[str] = None,
+    ) -> None:
+        self.max_workers = max_workers or os.cpu_count() or 2
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_limit_mb = memory_limit_mb
+        self.image_format = image_format
+        self.dpi = dpi
+        self.max_bytes = max_bytes
+        self.worker_user = worker_user
+        self._idle: Optional[asyncio.Queue] = None
+        self._workers = set()
+        self.jobs = 0
+        self.failures = 0
+        self.restarts = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": len(self._workers),
+            "idle": self._idle.qsize() if self._idle else 0,
+            "jobs": self.jobs,
+            "failures": self.failures,
+            "restarts": self.restarts,
+        }
+
+    async def astart(self) -> None:
+        """Start every worker now rather than on the first charts."""
+        if self._idle is not None:
+            return
+        self._idle = asyncio.Queue()
+        await asyncio.gather(*(self._aspawn() for _ in range(self.max_workers)))
+
+    async def _aspawn(self) -> None:
+        worker = await ChartWorker.astart(self.memory_limit_mb, self.worker_user)
+        self._workers.add(worker)
+        self._idle.put_nowait(worker)
+
+    async def arender(self, code: str, image_format: Optional[str] = None, dpi: Optional[int] = None) -> Dict[str, Any]:
+        """Run chart code in a worker.
+
+        Args:
+            code (str): The Python code drawing the chart with matplotlib.
+            image_format (Optional[str]): The matplotlib format of the image. Defaults to the pool's.
+            dpi (Optional[int]): The resolution of the image. Defaults to the pool's.
+
+        Returns:
+            Dict[str, Any]: "image" bytes or None when the code drew nothing, "output" printed by the code and "error" or None.
+        """
+        await self.astart()
+        # Jobs wait for an idle worker here, so the timeout only counts running time
+        worker = await self._idle.get()
+        self.jobs += 1
+        job = {
+            "code": code,
+            "timeout": self.timeout,
+            "cpu_seconds": self.cpu_seconds,
+            "image_format": image_format or self.image_format,
+            "dpi": dpi or self.dpi,
+            "max_bytes": self.max_bytes,
+        }
+        try:
+            result = await asyncio.wait_for(worker.arun(job), self.timeout + 5)
+        except (asyncio.TimeoutError, ConnectionError):
+            result = None
+        except BaseException:
+            # Cancelled mid-job, the worker's next answer would belong to this job
+            self._replace(worker)
+            raise
+        if result is None:
+            self.failures += 1
+            self._replace(worker)
+            return {"image": None, "output": "", "error": "Chart worker timed out or crashed, it was restarted"}
+        self._idle.put_nowait(worker)
+        if result["error"]:
+            self.failures += 1
+        return result
+
+    def _replace(self, worker: ChartWorker) -> None:
+        self.restarts += 1
+        worker.kill()
+        self._workers.discard(worker)
+        task = asyncio.get_running_loop().create_task(self._aspawn())
+        # A worker that cannot start is retried by the next restart, not raised here
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def aclose(self) -> None:
+        for worker in list(self._workers):
+            worker.kill()
+            await worker.process.wait()
+        self._workers.clear()
+        self._idle = None
+
+
+if __name__ == "__main__":
+    serve(int(sys.argv[1]) or None)
@@ -0,0 +1,214 @@
+# read-through cache in front of the checkpointer
+import sys
+from typing import Any, AsyncIterator, Dict, Optional, Sequence, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    copy_checkpoint,
+    get_checkpoint_id,
+)
+
+from components.checkpointer import AsyncMongoDBSaver
+from components.lru_cache import LRUCache
+
+
+def _estimate_size(checkpoint_tuple: CheckpointTuple) -> int:
+    """Cheap estimate of the memory held by a cached checkpoint, mostly message contents."""
+    size = 0
+    for value in checkpoint_tuple.checkpoint["channel_values"].values():
+        items = value if isinstance(value, list) else [value]
+        for item in items:
+            content = getattr(item, "content", item)
+            size += len(content) if isinstance(content, (str, bytes)) else sys.getsizeof(content)
+    return size + 1024
+
+
+class CachedCheckpointSaver(BaseCheckpointSaver):
+    """A read-through, write-through LRU cache in front of an AsyncMongoDBSaver.
+
+    Checkpoints are immutable once written, so lookups by checkpoint_id are served from
+    memory whenever possible. Pending writes are not, any worker running the thread can
+    add to them, so they are never cached.
+
+    A lookup of the latest checkpoint of a thread makes a single query that returns the
+    latest checkpoint_id in MongoDB with its pending writes. If it is the cached one, the
+    checkpoint is served from memory with those writes: one round-trip, without the
+    checkpoint document and its channel blobs, where a miss takes two or three in "find"
+    mode and always transfers the whole checkpoint. If another worker has written a newer
+    checkpoint the entry is treated as stale and reloaded, so a worker never serves an
+    older state than the one in the database. A hit by checkpoint_id reads its pending
+    writes with one query.
+
+    Args:
+        saver (AsyncMongoDBSaver): The saver to cache.
+        max_entries (int): The maximum number of cached checkpoints. Defaults to 256.
+        max_bytes (int): The maximum estimated size of the cached checkpoints. Defaults to 64MB.
+        ttl (float): Seconds after which a cached checkpoint expires. Defaults to 300.
+    """
+
+    def __init__(
+        self,
+        saver: AsyncMongoDBSaver,
+        *,
+        max_entries: int = 256,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl: float = 300,
+    ) -> None:
+        super().__init__(serde=saver.serde)
+        self.saver = saver
+        self.checkpoints = LRUCache(max_entries, max_bytes, ttl, sizeof=_estimate_size)
+        # (thread_id, checkpoint_ns) -> latest checkpoint_id
+        self.latest = LRUCache(max_entries, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def get_next_version(self, current: Optional[Any], channel: Any) -> Any:
+        return self.saver.get_next_version(current, channel)
+
+    async def asetup(self, check_indexes: bool = True) -> None:
+        await self.saver.asetup(check_indexes=check_indexes)
+
+    async def aflush(self, force: bool = False, thread_id: Optional[str] = None) -> None:
+        await self.saver.aflush(force=force, thread_id=thread_id)
+
+    async def aclose(self) -> None:
+        await self.saver.aclose()
+
+    async def acompact(self, thread_id: Optional[str] = None) -> Dict[str, int]:
+        return await self.saver.acompact(thread_id=thread_id)
+
+    def start_compaction(self, interval: float) -> None:
+        self.saver.start_compaction(interval)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.checkpoints),
+            "bytes": self.checkpoints.stats()["bytes"],
+            "evictions": self.checkpoints.evictions,
+        }
+
+    def invalidate(self, thread_id: str, checkpoint_ns: str = "") -> None:
+        """Forget the latest checkpoint of a thread, the next lookup goes to MongoDB."""
+        self.latest.pop((thread_id, checkpoint_ns))
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = get_checkpoint_id(config)
+
+        if checkpoint_id:
+            cached = self.checkpoints.get((thread_id, checkpoint_ns, checkpoint_id), count=False)
+            if cached is not None:
+                self.hits += 1
+                return await self._awith_writes(cached)
+        else:
+            latest_id = self.latest.get((thread_id, checkpoint_ns), count=False)
+            cached = None
+            if latest_id is not None:
+                cached = self.checkpoints.get((thread_id, checkpoint_ns, latest_id), count=False)
+            if cached is not None:
+                latest = await self.saver.alatest_pending_writes(thread_id, checkpoint_ns)
+                # checkpoint ids are time-ordered, a lower id in MongoDB means our write is not flushed yet
+                if latest is None or latest[0] <= latest_id:
+                    self.hits += 1
+                    pending_writes = latest[1] if latest is not None and latest[0] == latest_id else []
+                    return cached._replace(checkpoint=copy_checkpoint(cached.checkpoint), pending_writes=pending_writes)
+                self.stale += 1
+
+        self.misses += 1
+        checkpoint_tuple = await self.saver.aget_tuple(config)
+        if checkpoint_tuple is not None:
+            self._store(checkpoint_tuple, latest=not checkpoint_id)
+            return self._copy(checkpoint_tuple)
+        return None
+
+    async def _awith_writes(self, cached: CheckpointTuple) -> CheckpointTuple:
+        configurable = cached.config["configurable"]
+        pending_writes = await self.saver.aget_pending_writes(
+            configurable["thread_id"], configurable.get("checkpoint_ns", ""), configurable["checkpoint_id"]
+        )
+        return cached._replace(checkpoint=copy_checkpoint(cached.checkpoint), pending_writes=pending_writes)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        async for checkpoint_tuple in self.saver.alist(config, filter=filter, before=before, limit=limit):
+            yield checkpoint_tuple
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        new_config = await self.saver.aput(config, checkpoint, metadata, new_versions)
+        configurable = new_config["configurable"]
+        parent_id = config["configurable"].get("checkpoint_id")
+        self._store(
+            CheckpointTuple(
+                new_config,
+                copy_checkpoint(checkpoint),
+                metadata,
+                (
+                    {
+                        "configurable": {
+                            "thread_id": configurable["thread_id"],
+                            "checkpoint_ns": configurable["checkpoint_ns"],
+                            "checkpoint_id": parent_id,
+                        }
+                    }
+                    if parent_id
+                    else None
+                ),
+                [],
+            ),
+            latest=True,
+        )
+        return new_config
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+    ) -> None:
+        await self.saver.aput_writes(config, writes, task_id)
+
+    def _store(self, checkpoint_tuple: CheckpointTuple, latest: bool) -> None:
+        configurable = checkpoint_tuple.config["configurable"]
+        thread_id = configurable["thread_id"]
+        checkpoint_ns = configurable.get("checkpoint_ns", "")
+        checkpoint_id = configurable["checkpoint_id"]
+        # Pending writes are read from MongoDB on every hit, only the checkpoint is kept
+        self.checkpoints.set((thread_id, checkpoint_ns, checkpoint_id), checkpoint_tuple._replace(pending_writes=[]))
+        if latest:
+            current = self.latest.get((thread_id, checkpoint_ns), count=False)
+            # Never move the latest pointer back to an older checkpoint
+            if current is None or current <= checkpoint_id:
+                self.latest.set((thread_id, checkpoint_ns), checkpoint_id)
+
+    @staticmethod
+    def _copy(checkpoint_tuple: CheckpointTuple) -> CheckpointTuple:
+        # The graph appends to pending_writes and replaces channel values in place,
+        # so callers get their own copies of the mutable parts
+        return checkpoint_tuple._replace(
+            checkpoint=copy_checkpoint(checkpoint_tuple.checkpoint),
+            pending_writes=list(checkpoint_tuple.pending_writes or []),
+        )
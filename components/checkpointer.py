@@ -1,6 +1,12 @@
 # checkpoint implementation
+import asyncio
+import json
+import logging
 import pickle
+import random
+import zlib
 from contextlib import AbstractContextManager, asynccontextmanager, contextmanager
+from datetime import datetime, timedelta, timezone
 from types import TracebackType
 from typing import Any, Dict, Iterator, Optional, AsyncIterator, Sequence, Tuple
 
@@ -19,7 +25,166 @@ from langgraph.checkpoint.base import (
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
 
 from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
-from pymongo import MongoClient, UpdateOne
+from pymongo import ASCENDING, DESCENDING, MongoClient, UpdateOne
+from pymongo.errors import OperationFailure
+
+# Optional, CompressedSerializer falls back to JSON and zlib without them
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+
+STORAGE_FULL = "full"
+STORAGE_BLOBS = "blobs"
+
+FETCH_FIND = "find"
+FETCH_AGGREGATE = "aggregate"
+
+DURABILITY_ALWAYS = "always"
+DURABILITY_INTERRUPT = "interrupt"
+DURABILITY_NONE = "none"
+
+# Fields aget_tuple actually reads, anything else stored on the documents is left on the server
+_CHECKPOINT_PROJECTION = {
+    "thread_id": 1,
+    "checkpoint_ns": 1,
+    "checkpoint_id": 1,
+    "parent_checkpoint_id": 1,
+    "type": 1,
+    "checkpoint": 1,
+    "metadata": 1,
+    "metadata_type": 1,
+    "storage": 1,
+    "blob_ids": 1,
+}
+_WRITES_PROJECTION = {"_id": 0, "task_id": 1, "channel": 1, "type": 1, "value": 1}
+# Server error code of a result document over the 16MB BSON limit
+_BSON_OBJECT_TOO_LARGE = 10334
+
+
+def _blob_id(thread_id: str, checkpoint_ns: str, channel: str, version: Any) -> str:
+    """Deterministic id of the blob holding a channel value at a given version."""
+    return json.dumps([thread_id, checkpoint_ns, channel, version], separators=(",", ":"))
+
+
+def _normalize_version(version: Any) -> Any:
+    if isinstance(version, int):
+        return f"{version:032}.{0:016}"
+    return version
+
+
+def _normalize_versions(checkpoint: Checkpoint) -> Checkpoint:
+    """Convert the integer channel versions of a legacy checkpoint to blobs-mode strings.
+
+    Mixing integer and string versions in one thread breaks version comparisons, so
+    checkpoints written in full mode are normalized before they are used in blobs mode.
+    """
+    return {
+        **checkpoint,
+        "channel_versions": {
+            channel: _normalize_version(version)
+            for channel, version in checkpoint["channel_versions"].items()
+        },
+        "versions_seen": {
+            node: {channel: _normalize_version(version) for channel, version in seen.items()}
+            for node, seen in checkpoint["versions_seen"].items()
+        },
+    }
+
+
+def _dump_metadata(serde: SerializerProtocol, metadata: CheckpointMetadata) -> Dict[str, Any]:
+    type_, serialized_metadata = serde.dumps_typed(metadata)
+    return {"metadata_type": type_, "metadata": serialized_metadata}
+
+
+def _load_metadata(serde: SerializerProtocol, doc: Dict[str, Any]) -> CheckpointMetadata:
+    # Documents written before metadata_type existed hold untyped JSON
+    if doc.get("metadata_type"):
+        return serde.loads_typed((doc["metadata_type"], doc["metadata"]))
+    return serde.loads(doc["metadata"])
+
+
+class RetentionPolicy:
+    """How much checkpoint history to keep per thread.
+
+    A checkpoint is kept if it is one of the keep_last newest checkpoints of its thread or
+    if it is younger than max_age. The newest checkpoint of a thread is always kept, unless
+    use_ttl_index is set: then a MongoDB TTL index expires every document older than max_age,
+    including the latest state of threads that have been idle for longer than that.
+
+    Args:
+        keep_last (Optional[int]): Number of newest checkpoints to keep per thread. Defaults to no limit.
+        max_age (Optional[timedelta]): Keep every checkpoint younger than this. Defaults to no limit.
+        use_ttl_index (bool): Expire documents with a TTL index instead of compaction. Requires max_age
+            without keep_last, and full storage mode for the async saver. Defaults to False.
+        blob_grace_period (timedelta): Unreferenced blobs younger than this are kept, since the
+            checkpoint referencing them may not have been written yet. Defaults to 10 minutes.
+    """
+
+    def __init__(
+        self,
+        keep_last: Optional[int] = None,
+        max_age: Optional[timedelta] = None,
+        use_ttl_index: bool = False,
+        blob_grace_period: timedelta = timedelta(minutes=10),
+    ) -> None:
+        if keep_last is None and max_age is None:
+            raise ValueError("A retention policy needs keep_last, max_age or both")
+        if keep_last is not None and keep_last < 1:
+            raise ValueError("keep_last must be at least 1")
+        if use_ttl_index and (max_age is None or keep_last is not None):
+            raise ValueError("use_ttl_index requires max_age without keep_last")
+        self.keep_last = keep_last
+        self.max_age = max_age
+        self.use_ttl_index = use_ttl_index
+        self.blob_grace_period = blob_grace_period
+
+    @property
+    def protected(self) -> int:
+        """Number of newest checkpoints per thread that compaction never deletes."""
+        return self.keep_last or 1
+
+    def is_expired(self, created_at: Optional[datetime], now: datetime) -> bool:
+        # Documents written before created_at existed count as old
+        if self.max_age is None or created_at is None:
+            return True
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        return created_at < now - self.max_age
+
+
+def _empty_report() -> Dict[str, int]:
+    return {"checkpoints": 0, "writes": 0, "blobs": 0, "bytes": 0}
+
+
+def _unindexed_stages(plan: Any) -> list:
+    """Collect the stages of an explain plan that are not backed by an index."""
+    stages = []
+    if isinstance(plan, dict):
+        if plan.get("stage") in ("COLLSCAN", "SORT"):
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_unindexed_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_unindexed_stages(value))
+    return stages
+
+
+def _warn_if_unindexed(name: str, explain: Dict[str, Any]) -> bool:
+    """Log a warning if the winning plan of an explained query scans or sorts in memory."""
+    stages = _unindexed_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+    if stages:
+        logger.warning("Checkpoint query %s is not index-backed (stages: %s)", name, ", ".join(stages))
+        return False
+    return True
 
 
 class JsonPlusSerializerCompat(JsonPlusSerializer):
@@ -50,6 +215,79 @@ class JsonPlusSerializerCompat(JsonPlusSerializer):
         return super().loads(data)
 
 
+class CompressedSerializer(JsonPlusSerializerCompat):
+    """A serializer that encodes with msgpack and compresses payloads above a size threshold.
+
+    The type tag returned by dumps_typed records the encoding and the compression, e.g.
+    "msgpack", "msgpack+zstd" or "json+zlib", so loads_typed can read these payloads side by
+    side with the plain JSON, bytes and pickled payloads written by JsonPlusSerializerCompat.
+    msgpack and zstandard are optional, without them JSON and zlib are used.
+
+    Args:
+        compress_threshold (int): Payloads of at least this many bytes are compressed. Defaults to 4096.
+        compression (Optional[str]): "zstd" or "zlib". Defaults to zstd when zstandard is installed.
+        level (Optional[int]): Compression level. Defaults to 3 for zstd and 6 for zlib.
+
+    Examples:
+        >>> serializer = CompressedSerializer(compress_threshold=0)
+        >>> type_, data = serializer.dumps_typed({"key": "value"})
+        >>> type_
+        'msgpack+zstd'
+        >>> serializer.loads_typed((type_, data))
+        {'key': 'value'}
+    """
+
+    def __init__(
+        self,
+        compress_threshold: int = 4096,
+        compression: Optional[str] = None,
+        level: Optional[int] = None,
+    ) -> None:
+        super().__init__()
+        if compression is None:
+            compression = "zstd" if zstandard is not None else "zlib"
+        if compression == "zstd" and zstandard is None:
+            raise ImportError("zstd compression requires the zstandard package")
+        if compression not in ("zstd", "zlib"):
+            raise ValueError(f"Unknown compression: {compression}")
+        self.compress_threshold = compress_threshold
+        self.compression = compression
+        self.level = level if level is not None else (3 if compression == "zstd" else 6)
+
+    def dumps_typed(self, obj: Any) -> Tuple[str, bytes]:
+        if isinstance(obj, (bytes, bytearray)):
+            return super().dumps_typed(obj)
+        if msgpack is not None:
+            type_, data = "msgpack", msgpack.packb(obj, default=self._default, use_bin_type=True)
+        else:
+            type_, data = super().dumps_typed(obj)
+        if len(data) < self.compress_threshold:
+            return type_, data
+        if self.compression == "zstd":
+            data = zstandard.ZstdCompressor(level=self.level).compress(data)
+        else:
+            data = zlib.compress(data, self.level)
+        return f"{type_}+{self.compression}", data
+
+    def loads_typed(self, data: Tuple[str, bytes]) -> Any:
+        type_, payload = data
+        if "+" in type_:
+            type_, compression = type_.rsplit("+", 1)
+            if compression == "zstd":
+                if zstandard is None:
+                    raise ImportError("Reading zstd compressed checkpoints requires the zstandard package")
+                payload = zstandard.ZstdDecompressor().decompress(payload)
+            elif compression == "zlib":
+                payload = zlib.decompress(payload)
+            else:
+                raise ValueError(f"Unknown compression: {compression}")
+        if type_ == "msgpack":
+            if msgpack is None:
+                raise ImportError("Reading msgpack checkpoints requires the msgpack package")
+            return msgpack.unpackb(payload, object_hook=self._reviver, raw=False, strict_map_key=False)
+        return super().loads_typed((type_, payload))
+
+
 class MongoDBSaver(AbstractContextManager, BaseCheckpointSaver):
     """A checkpoint saver that stores checkpoints in a MongoDB database.
 
@@ -58,6 +296,7 @@ class MongoDBSaver(AbstractContextManager, BaseCheckpointSaver):
         db_name (str): The name of the database to use.
         collection_name (str): The name of the collection to use.
         serde (Optional[SerializerProtocol]): The serializer to use for serializing and deserializing checkpoints. Defaults to JsonPlusSerializerCompat.
+        retention (Optional[RetentionPolicy]): How much history compact() keeps. Defaults to keeping everything.
     
     Examples:
 
@@ -92,12 +331,14 @@ class MongoDBSaver(AbstractContextManager, BaseCheckpointSaver):
         collection_name: str,
         *,
         serde: Optional[SerializerProtocol] = None,
+        retention: Optional[RetentionPolicy] = None,
     ) -> None:
         super().__init__(serde=serde)
         self.client = client
         self.db_name = db_name
         self.collection_name = collection_name
         self.collection = client[db_name][collection_name]
+        self.retention = retention
 
     def __enter__(self) -> Self:
         return self
@@ -110,6 +351,41 @@ class MongoDBSaver(AbstractContextManager, BaseCheckpointSaver):
     ) -> Optional[bool]:
         return True
 
+    def setup(self, check_indexes: bool = True) -> None:
+        """Create the indexes used by the checkpoint queries. Safe to call on every startup.
+
+        Args:
+            check_indexes (bool): Explain the checkpoint queries afterwards and log a warning if any of them is not index-backed. Defaults to True.
+        """
+        try:
+            self.collection.create_index([("thread_id", ASCENDING), ("thread_ts", DESCENDING)])
+        except OperationFailure as e:
+            logger.warning("Could not create checkpoint index on %s: %s", self.collection_name, e)
+        if self.retention is not None and self.retention.use_ttl_index:
+            try:
+                self.collection.create_index(
+                    "created_at", expireAfterSeconds=int(self.retention.max_age.total_seconds())
+                )
+            except OperationFailure as e:
+                logger.warning("Could not create checkpoint TTL index on %s: %s", self.collection_name, e)
+        if check_indexes:
+            self.check_indexes()
+
+    def check_indexes(self) -> bool:
+        """Explain the checkpoint queries and log a warning for any that is not index-backed.
+
+        Returns:
+            bool: True if every query is index-backed.
+        """
+        explain = self.collection.find({"thread_id": ""}).sort("thread_ts", -1).limit(1).explain()
+        return _warn_if_unindexed("get_tuple", explain)
+
+    def _load_checkpoint(self, doc: Dict[str, Any]) -> Checkpoint:
+        # Documents written before the type field existed hold untyped JSON or pickle
+        if doc.get("type"):
+            return self.serde.loads_typed((doc["type"], doc["checkpoint"]))
+        return self.serde.loads(doc["checkpoint"])
+
     def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
         """Get a checkpoint tuple from the database.
 
@@ -135,8 +411,8 @@ class MongoDBSaver(AbstractContextManager, BaseCheckpointSaver):
         for doc in result:
             return CheckpointTuple(
                 config,
-                self.serde.loads(doc["checkpoint"]),
-                self.serde.loads(doc["metadata"]),
+                self._load_checkpoint(doc),
+                _load_metadata(self.serde, doc),
                 (
                     {
                         "configurable": {
@@ -187,8 +463,8 @@ class MongoDBSaver(AbstractContextManager, BaseCheckpointSaver):
                         "thread_ts": doc["thread_ts"],
                     }
                 },
-                self.serde.loads(doc["checkpoint"]),
-                self.serde.loads(doc["metadata"]),
+                self._load_checkpoint(doc),
+                _load_metadata(self.serde, doc),
                 (
                     {
                         "configurable": {
@@ -220,19 +496,20 @@ class MongoDBSaver(AbstractContextManager, BaseCheckpointSaver):
         Returns:
             RunnableConfig: The updated config containing the saved checkpoint's timestamp.
         """
+        type_, serialized_checkpoint = self.serde.dumps_typed(checkpoint)
         doc = {
             "thread_id": config["configurable"]["thread_id"],
             "thread_ts": checkpoint["id"],
-            "checkpoint": self.serde.dumps(checkpoint),
-            "metadata": self.serde.dumps(metadata),
+            "type": type_,
+            "checkpoint": serialized_checkpoint,
+            **_dump_metadata(self.serde, metadata),
+            "created_at": datetime.now(timezone.utc),
         }
         if config["configurable"].get("thread_ts"):
             doc["parent_ts"] = config["configurable"]["thread_ts"]
         self.collection.insert_one(doc)
-
-        # Delete previous checkpoints (self added - hsien jun)
-        self.delete_previous_checkpoints(config["configurable"]["thread_id"])
-        
+        # Old checkpoints are removed by compact() according to the retention policy,
+        # not after every put, so list() can still serve the thread history
         return {
             "configurable": {
                 "thread_id": config["configurable"]["thread_id"],
@@ -240,26 +517,209 @@ class MongoDBSaver(AbstractContextManager, BaseCheckpointSaver):
             }
         }
     
-    # self added function (hsienjun)
-    def delete_previous_checkpoints(self, thread_id: str) -> None:
-        """Delete all but the most recent checkpoint for the given thread ID.
- 
+    def compact(self, thread_id: Optional[str] = None) -> Dict[str, int]:
+        """Delete the checkpoints the retention policy no longer keeps.
+
         Args:
-            thread_id (str): The thread ID for which to delete previous checkpoints.
+            thread_id (Optional[str]): Only compact this thread. Defaults to all threads.
+
+        Returns:
+            Dict[str, int]: The number of deleted documents and the bytes reclaimed.
         """
-        # Find the most recent checkpoint
-        most_recent = self.collection.find({"thread_id": thread_id}).sort("thread_ts", -1).limit(1)
-        most_recent_ts = None
-        for doc in most_recent:
-            most_recent_ts = doc["thread_ts"]
-       
-        # Delete all checkpoints with the same thread ID but different timestamps
-        if most_recent_ts is not None:
-            self.collection.delete_many({"thread_id": thread_id, "thread_ts": {"$ne": most_recent_ts}})
+        report = _empty_report()
+        if self.retention is None or self.retention.use_ttl_index:
+            return report
+        if thread_id is not None:
+            thread_ids = [thread_id]
+        else:
+            thread_ids = [
+                group["_id"]
+                for group in self.collection.aggregate(
+                    [
+                        {"$group": {"_id": "$thread_id", "count": {"$sum": 1}}},
+                        {"$match": {"count": {"$gt": self.retention.protected}}},
+                    ]
+                )
+            ]
+        now = datetime.now(timezone.utc)
+        for thread_id in thread_ids:
+            candidates = (
+                self.collection.find({"thread_id": thread_id}, {"thread_ts": 1, "created_at": 1})
+                .sort("thread_ts", -1)
+                .skip(self.retention.protected)
+            )
+            expired = [
+                doc["thread_ts"] for doc in candidates if self.retention.is_expired(doc.get("created_at"), now)
+            ]
+            if not expired:
+                continue
+            query = {"thread_id": thread_id, "thread_ts": {"$in": expired}}
+            for group in self.collection.aggregate(
+                [{"$match": query}, {"$group": {"_id": None, "bytes": {"$sum": {"$bsonSize": "$$ROOT"}}}}]
+            ):
+                report["bytes"] += group["bytes"]
+            report["checkpoints"] += self.collection.delete_many(query).deleted_count
+        return report
+
+
+class CheckpointWriteError(Exception):
+    """Checkpoint writes queued for write-behind could not be persisted."""
+
+
+class WriteBehindQueue:
+    """Background flusher that persists checkpoint writes in ordered batches.
+
+    Submitted items are (collection name, bulk operations) lists of one thread. A single
+    consumer task drains the queue in FIFO order and writes each batch thread by thread
+    with ordered bulk writes, so the writes of a thread are persisted in the order they
+    were made and a failing write only fails the items of its own thread. Within a thread,
+    blobs are written before checkpoints and checkpoints before pending writes, so a
+    checkpoint is never visible before the blobs it references.
+
+    A failure is logged and kept until flush() is called for its thread, which raises
+    it, so a write nobody awaited (durability "interrupt") is not lost silently.
+
+    Args:
+        db (AsyncIOMotorDatabase): The database to write to.
+        max_queue_depth (int): The number of queued items after which submit() blocks.
+        max_batch_size (int): The maximum number of items written together.
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase, max_queue_depth: int = 1000, max_batch_size: int = 100) -> None:
+        self.db = db
+        self.max_queue_depth = max_queue_depth
+        self.max_batch_size = max_batch_size
+        self.pending = 0
+        # thread_id -> first error since the last flush of the thread
+        self.failures: Dict[Optional[str], BaseException] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _ensure_started(self) -> asyncio.Queue:
+        # Created lazily, the saver is built at import time before the event loop runs
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue_depth)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return self._queue
+
+    async def submit(self, operations: Sequence[Tuple[str, list]], thread_id: Optional[str] = None) -> asyncio.Future:
+        """Queue operations of a thread for writing. Returns a future resolved once they are persisted."""
+        queue = self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        # Nobody may await the future (durability "none"), errors are kept for flush()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.pending += 1
+        await queue.put((thread_id, operations, future))
+        return future
+
+    async def flush(self, thread_id: Optional[str] = None, raise_errors: bool = True) -> None:
+        """Wait until everything submitted so far has been written.
+
+        Args:
+            thread_id (Optional[str]): Raise the failures of this thread only. Defaults to those of every thread.
+            raise_errors (bool): Raise CheckpointWriteError for the writes that failed since the last flush. Defaults to True.
+        """
+        if self._queue is not None:
+            await (await self.submit([]))
+        if not raise_errors:
+            return
+        if thread_id is None:
+            failures, self.failures = self.failures, {}
+        else:
+            failures = {thread_id: self.failures.pop(thread_id)} if thread_id in self.failures else {}
+        if failures:
+            failed_thread, error = next(iter(failures.items()))
+            raise CheckpointWriteError(
+                f"Checkpoint writes of {len(failures)} thread(s) were not persisted, thread {failed_thread}: {error!r}"
+            ) from error
+
+    async def close(self) -> None:
+        # Failures were logged when they happened, nobody is left to handle them
+        await self.flush(raise_errors=False)
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            by_thread: Dict[Optional[str], list] = {}
+            for item in batch:
+                by_thread.setdefault(item[0], []).append(item)
+            try:
+                results = await asyncio.gather(
+                    *(self._write(items) for items in by_thread.values()), return_exceptions=True
+                )
+                for (thread_id, items), result in zip(by_thread.items(), results):
+                    if isinstance(result, BaseException):
+                        logger.error(
+                            "Write-behind flush of %d checkpoint writes of thread %s failed: %s", len(items), thread_id, result
+                        )
+                        self.failures.setdefault(thread_id, result)
+                    for _, _, future in items:
+                        if future.done():
+                            continue
+                        if isinstance(result, BaseException):
+                            future.set_exception(result)
+                        else:
+                            future.set_result(None)
+            finally:
+                self.pending -= len(batch)
+
+    async def _write(self, items: list) -> None:
+        # The items of one thread, their operations stay in submission order per collection
+        by_collection: Dict[str, list] = {}
+        for _, operations, _ in items:
+            for collection_name, collection_operations in operations:
+                by_collection.setdefault(collection_name, []).extend(collection_operations)
+        for collection_name in sorted(by_collection, key=_write_order):
+            await self.db[collection_name].bulk_write(by_collection[collection_name], ordered=True)
+
+
+def _write_order(collection_name: str) -> int:
+    if collection_name.endswith("_blobs"):
+        return 0
+    if collection_name.endswith("_writes"):
+        return 2
+    return 1
 
 
 class AsyncMongoDBSaver(BaseCheckpointSaver):
-    """A checkpoint saver that stores checkpoints in a MongoDB database asynchronously."""
+    """A checkpoint saver that stores checkpoints in a MongoDB database asynchronously.
+
+    Two storage modes are supported and can be chosen per saver instance:
+
+    - ``"full"`` (default): every checkpoint document holds the whole serialized
+      checkpoint, including every channel value.
+    - ``"blobs"``: channel values are stored in ``<collection>_blobs``, one document
+      per (channel, version). ``aput`` only writes the channels listed in
+      ``new_versions`` and the checkpoint document keeps a list of the blob ids it
+      needs, so a long thread no longer rewrites its full message history per step.
+
+    Documents written in either format can be read in either mode. In blobs mode,
+    full documents are migrated the first time they are loaded, and
+    ``amigrate_to_blobs`` can be used to migrate a whole collection up front.
+
+    Args:
+        client (AsyncIOMotorClient): The MongoDB client.
+        db_name (str): The name of the database to use.
+        collection_name (str): The name of the collection to use.
+        storage_mode (str): Either "full" or "blobs". Defaults to "full".
+        fetch_mode (str): "find" loads the latest checkpoint and its pending writes with separate
+            queries, "aggregate" loads them in a single round-trip unless together they are over
+            the 16MB BSON limit. Defaults to "find".
+        write_behind (bool): Persist checkpoints and pending writes from a background flusher
+            in ordered batches instead of awaiting every write. Defaults to False.
+        durability (str): With write-behind, "always" awaits every write, "interrupt" only awaits
+            in aflush() at the end of a run, and "none" never awaits. Defaults to "interrupt".
+        max_queue_depth (int): With write-behind, the number of queued writes after which aput blocks. Defaults to 1000.
+        max_batch_size (int): With write-behind, the number of queued writes flushed together. Defaults to 100.
+        serde (Optional[SerializerProtocol]): The serializer to use. Defaults to JsonPlusSerializer.
+        retention (Optional[RetentionPolicy]): How much history acompact() keeps. Defaults to keeping everything.
+    """
 
     client: AsyncIOMotorClient
     db: AsyncIOMotorDatabase
@@ -269,25 +729,246 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
         client: AsyncIOMotorClient,
         db_name: str,
         collection_name: str,
+        *,
+        storage_mode: str = STORAGE_FULL,
+        fetch_mode: str = FETCH_FIND,
+        write_behind: bool = False,
+        durability: str = DURABILITY_INTERRUPT,
+        max_queue_depth: int = 1000,
+        max_batch_size: int = 100,
+        serde: Optional[SerializerProtocol] = None,
+        retention: Optional[RetentionPolicy] = None,
     ) -> None:
-        super().__init__()
+        super().__init__(serde=serde)
+        if retention is not None and retention.use_ttl_index and storage_mode == STORAGE_BLOBS:
+            # A blob can still be referenced by a newer checkpoint, it must not expire on its own
+            raise ValueError("use_ttl_index cannot be used with blobs storage mode")
+        if durability not in (DURABILITY_ALWAYS, DURABILITY_INTERRUPT, DURABILITY_NONE):
+            raise ValueError(f"Unknown checkpoint durability: {durability}")
+        if storage_mode not in (STORAGE_FULL, STORAGE_BLOBS):
+            raise ValueError(f"Unknown checkpoint storage mode: {storage_mode}")
+        if fetch_mode not in (FETCH_FIND, FETCH_AGGREGATE):
+            raise ValueError(f"Unknown checkpoint fetch mode: {fetch_mode}")
         self.client = client
         self.db = self.client[db_name]
         self.collection_name = collection_name
+        self.storage_mode = storage_mode
+        self.fetch_mode = fetch_mode
+        self.durability = durability
+        self.retention = retention
+        self._compaction_task: Optional[asyncio.Task] = None
+        self.write_behind = (
+            WriteBehindQueue(self.db, max_queue_depth=max_queue_depth, max_batch_size=max_batch_size)
+            if write_behind
+            else None
+        )
 
     @classmethod
     async def from_conn_info(
-        cls, uri: str, db_name: str, collection_name:str, 
+        cls, uri: str, db_name: str, collection_name:str, *, storage_mode: str = STORAGE_FULL,
+        fetch_mode: str = FETCH_FIND,
     ) -> AsyncIterator["AsyncMongoDBSaver"]:
         client = None
         try:
             client = AsyncIOMotorClient(uri)
             print(f"You successfully connected to MongoDB! {client}")
-            yield cls(client, db_name, collection_name)
+            yield cls(client, db_name, collection_name, storage_mode=storage_mode, fetch_mode=fetch_mode)
         finally:
             if client:
                 client.close()
 
+    @property
+    def blobs_collection_name(self) -> str:
+        return f"{self.collection_name}_blobs"
+
+    async def asetup(self, check_indexes: bool = True) -> None:
+        """Create the indexes used by the checkpoint queries. Safe to call on every startup.
+
+        Args:
+            check_indexes (bool): Explain the checkpoint queries afterwards and log a warning if any of them is not index-backed. Defaults to True.
+        """
+        indexes = [
+            (
+                self.collection_name,
+                [("thread_id", ASCENDING), ("checkpoint_ns", ASCENDING), ("checkpoint_id", DESCENDING)],
+            ),
+            (
+                f"{self.collection_name}_writes",
+                [
+                    ("thread_id", ASCENDING),
+                    ("checkpoint_ns", ASCENDING),
+                    ("checkpoint_id", ASCENDING),
+                    ("task_id", ASCENDING),
+                    ("idx", ASCENDING),
+                ],
+            ),
+        ]
+        for collection_name, keys in indexes:
+            try:
+                await self.db[collection_name].create_index(keys, unique=True)
+            except OperationFailure as e:
+                logger.warning("Could not create checkpoint index on %s: %s", collection_name, e)
+        # Used by compaction to find the blobs of a thread
+        try:
+            await self.db[self.blobs_collection_name].create_index(
+                [("thread_id", ASCENDING), ("checkpoint_ns", ASCENDING)]
+            )
+        except OperationFailure as e:
+            logger.warning("Could not create checkpoint index on %s: %s", self.blobs_collection_name, e)
+        if self.retention is not None and self.retention.use_ttl_index:
+            expire_after = int(self.retention.max_age.total_seconds())
+            for collection_name in (self.collection_name, f"{self.collection_name}_writes"):
+                try:
+                    await self.db[collection_name].create_index("created_at", expireAfterSeconds=expire_after)
+                except OperationFailure as e:
+                    logger.warning("Could not create checkpoint TTL index on %s: %s", collection_name, e)
+        if check_indexes:
+            await self.acheck_indexes()
+
+    async def acheck_indexes(self) -> bool:
+        """Explain the checkpoint queries and log a warning for any that is not index-backed.
+
+        Returns:
+            bool: True if every query is index-backed.
+        """
+        query = {"thread_id": "", "checkpoint_ns": ""}
+        latest = await self.db[self.collection_name].find(query).sort("checkpoint_id", -1).limit(1).explain()
+        writes = await self.db[f"{self.collection_name}_writes"].find({**query, "checkpoint_id": ""}).explain()
+        listed = await self.db[self.collection_name].find(query).sort("checkpoint_id", -1).explain()
+        results = [
+            _warn_if_unindexed("aget_tuple", latest),
+            _warn_if_unindexed("aget_tuple pending writes", writes),
+            _warn_if_unindexed("alist", listed),
+        ]
+        return all(results)
+
+    def get_next_version(self, current: Optional[Any], channel: Any) -> Any:
+        """Get the next version of a channel.
+
+        In blobs mode versions are zero-padded strings with a random suffix, so that two
+        branches forked from the same checkpoint never write the same blob id for
+        different values. Legacy integer versions are carried over into the new format.
+        """
+        if self.storage_mode != STORAGE_BLOBS:
+            return super().get_next_version(current, channel)
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        return f"{current_v + 1:032}.{random.random():016}"
+
+    def _dump_blobs(
+        self,
+        thread_id: str,
+        checkpoint_ns: str,
+        values: Dict[str, Any],
+        versions: ChannelVersions,
+    ) -> list:
+        """Build the upserts for the channel values written at the given versions."""
+        operations = []
+        for channel, version in versions.items():
+            if channel in values:
+                type_, serialized_value = self.serde.dumps_typed(values[channel])
+            else:
+                type_, serialized_value = "empty", None
+            operations.append(
+                UpdateOne(
+                    {"_id": _blob_id(thread_id, checkpoint_ns, channel, version)},
+                    {
+                        "$setOnInsert": {
+                            "thread_id": thread_id,
+                            "checkpoint_ns": checkpoint_ns,
+                            "channel": channel,
+                            "version": version,
+                            "type": type_,
+                            "value": serialized_value,
+                            "created_at": datetime.now(timezone.utc),
+                        }
+                    },
+                    upsert=True,
+                )
+            )
+        return operations
+
+    def _load_blobs(self, blob_docs: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
+        """Rebuild the channel values of a checkpoint from its blob documents."""
+        return {
+            blob["channel"]: self.serde.loads_typed((blob["type"], blob["value"]))
+            for blob in blob_docs
+            if blob["type"] != "empty"
+        }
+
+    async def _aload_blobs(self, blob_ids: Sequence[str]) -> Dict[str, Any]:
+        if not blob_ids:
+            return {}
+        blob_docs = self.db[self.blobs_collection_name].find({"_id": {"$in": list(blob_ids)}})
+        return self._load_blobs([blob async for blob in blob_docs])
+
+    async def _aload_checkpoint(
+        self, doc: Dict[str, Any], blob_docs: Optional[Sequence[Dict[str, Any]]] = None
+    ) -> Checkpoint:
+        """Deserialize the checkpoint stored in a document, whatever its storage format.
+
+        Blobs that were already fetched together with the document can be passed in as
+        blob_docs, otherwise they are loaded from the blobs collection.
+        """
+        if doc.get("storage") == STORAGE_BLOBS:
+            checkpoint = self.serde.loads_typed((doc["type"], doc["checkpoint"]))
+            if blob_docs is not None:
+                checkpoint["channel_values"] = self._load_blobs(blob_docs)
+            else:
+                checkpoint["channel_values"] = await self._aload_blobs(doc["blob_ids"])
+            return checkpoint
+        if self.storage_mode == STORAGE_BLOBS:
+            return await self._amigrate_doc(doc)
+        return self.serde.loads_typed((doc["type"], doc["checkpoint"]))
+
+    async def _amigrate_doc(self, doc: Dict[str, Any]) -> Checkpoint:
+        """Rewrite a full checkpoint document in blobs format and return its checkpoint."""
+        checkpoint = _normalize_versions(self.serde.loads_typed((doc["type"], doc["checkpoint"])))
+        values = checkpoint["channel_values"]
+        blob_operations = self._dump_blobs(
+            doc["thread_id"], doc["checkpoint_ns"], values, checkpoint["channel_versions"]
+        )
+        if blob_operations:
+            await self.db[self.blobs_collection_name].bulk_write(blob_operations)
+        type_, serialized_checkpoint = self.serde.dumps_typed({**checkpoint, "channel_values": {}})
+        await self.db[self.collection_name].update_one(
+            {"_id": doc["_id"]},
+            {
+                "$set": {
+                    "storage": STORAGE_BLOBS,
+                    "type": type_,
+                    "checkpoint": serialized_checkpoint,
+                    "blob_ids": [
+                        _blob_id(doc["thread_id"], doc["checkpoint_ns"], channel, version)
+                        for channel, version in checkpoint["channel_versions"].items()
+                    ],
+                }
+            },
+        )
+        return checkpoint
+
+    async def amigrate_to_blobs(self, thread_id: Optional[str] = None) -> int:
+        """Migrate full checkpoint documents to the blobs storage format.
+
+        Args:
+            thread_id (Optional[str]): Only migrate the checkpoints of this thread. Defaults to all threads.
+
+        Returns:
+            int: The number of migrated checkpoint documents.
+        """
+        query: Dict[str, Any] = {"storage": {"$ne": STORAGE_BLOBS}}
+        if thread_id is not None:
+            query["thread_id"] = thread_id
+        migrated = 0
+        async for doc in self.db[self.collection_name].find(query):
+            await self._amigrate_doc(doc)
+            migrated += 1
+        return migrated
+
     async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
         """Get a checkpoint tuple from the database asynchronously.
 
@@ -302,6 +983,7 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
         Returns:
             Optional[CheckpointTuple]: The retrieved checkpoint tuple, or None if no matching checkpoint was found.
         """
+        await self._await_pending_writes()
         thread_id = config["configurable"]["thread_id"]
         checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
         if checkpoint_id := get_checkpoint_id(config):
@@ -316,40 +998,175 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
                 "checkpoint_ns": checkpoint_ns,
             }
 
-        result = self.db[self.collection_name].find(query).sort("checkpoint_id", -1).limit(1)
-        async for doc in result:
-            config_values = {
+        docs = await self._aaggregate_latest(query) if self.fetch_mode == FETCH_AGGREGATE else None
+        if docs is not None:
+            if not docs:
+                return None
+            doc = docs[0]
+            checkpoint = await self._aload_checkpoint(doc, blob_docs=doc["blobs"])
+            serialized_writes = doc["pending_writes"]
+        else:
+            doc = await self.db[self.collection_name].find_one(
+                query, _CHECKPOINT_PROJECTION, sort=[("checkpoint_id", -1)]
+            )
+            if doc is None:
+                return None
+            checkpoint = await self._aload_checkpoint(doc)
+            serialized_writes = await self._afind_writes(thread_id, checkpoint_ns, doc["checkpoint_id"])
+
+        config_values = {
+            "thread_id": thread_id,
+            "checkpoint_ns": checkpoint_ns,
+            "checkpoint_id": doc["checkpoint_id"],
+        }
+        pending_writes = self._load_writes(serialized_writes)
+        return CheckpointTuple(
+            {"configurable": config_values},
+            checkpoint,
+            _load_metadata(self.serde, doc),
+            (
+                {
+                    "configurable": {
+                        "thread_id": thread_id,
+                        "checkpoint_ns": checkpoint_ns,
+                        "checkpoint_id": doc["parent_checkpoint_id"],
+                    }
+                }
+                if doc.get("parent_checkpoint_id")
+                else None
+            ),
+            pending_writes,
+        )
+
+    async def _afind_writes(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> list:
+        return await self.db[f"{self.collection_name}_writes"].find(
+            {
                 "thread_id": thread_id,
                 "checkpoint_ns": checkpoint_ns,
-                "checkpoint_id": doc["checkpoint_id"],
-            }
-            checkpoint = self.serde.loads_typed((doc["type"], doc["checkpoint"]))
-            serialized_writes = self.db[f"{self.collection_name}_writes"].find(config_values)
-            pending_writes = [
-                (
-                    doc["task_id"],
-                    doc["channel"],
-                    self.serde.loads_typed((doc["type"], doc["value"])),
-                )
-                async for doc in serialized_writes
-            ]
-            return CheckpointTuple(
-                {"configurable": config_values},
-                checkpoint,
-                self.serde.loads(doc["metadata"]),
-                (
-                    {
-                        "configurable": {
-                            "thread_id": thread_id,
-                            "checkpoint_ns": checkpoint_ns,
-                            "checkpoint_id": doc["parent_checkpoint_id"],
-                        }
-                    }
-                    if doc.get("parent_checkpoint_id")
-                    else None
-                ),
-                pending_writes,
+                "checkpoint_id": checkpoint_id,
+            },
+            _WRITES_PROJECTION,
+            # Same order as the $lookup of _latest_checkpoint_pipeline, served by the writes index
+            sort=[("task_id", ASCENDING), ("idx", ASCENDING)],
+        ).to_list(length=None)
+
+    def _load_writes(self, serialized_writes: Sequence[Dict[str, Any]]) -> list:
+        return [
+            (
+                write["task_id"],
+                write["channel"],
+                self.serde.loads_typed((write["type"], write["value"])),
+            )
+            for write in serialized_writes
+        ]
+
+    async def aget_pending_writes(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> list:
+        """Get the pending writes of a checkpoint, without loading the checkpoint itself."""
+        await self._await_pending_writes()
+        return self._load_writes(await self._afind_writes(thread_id, checkpoint_ns, checkpoint_id))
+
+    async def alatest_pending_writes(self, thread_id: str, checkpoint_ns: str = "") -> Optional[Tuple[str, list]]:
+        """Get the id of the latest checkpoint of a thread with its pending writes, in one round-trip.
+
+        The checkpoint itself and its blobs are not loaded, this is for callers that
+        already hold the checkpoint and only need to know it is still the latest.
+
+        Returns:
+            Optional[Tuple[str, list]]: The checkpoint_id and the pending writes, None when the thread has no checkpoint.
+        """
+        await self._await_pending_writes()
+        query = {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns}
+        docs = await self._aaggregate_latest(query, with_checkpoint=False)
+        if docs is None:
+            doc = await self.db[self.collection_name].find_one(
+                query, {"_id": 0, "checkpoint_id": 1}, sort=[("checkpoint_id", -1)]
             )
+            if doc is None:
+                return None
+            return doc["checkpoint_id"], self._load_writes(
+                await self._afind_writes(thread_id, checkpoint_ns, doc["checkpoint_id"])
+            )
+        if not docs:
+            return None
+        return docs[0]["checkpoint_id"], self._load_writes(docs[0]["pending_writes"])
+
+    async def _aaggregate_latest(self, query: Dict[str, Any], with_checkpoint: bool = True) -> Optional[list]:
+        """Run _latest_checkpoint_pipeline, None when its result is over the 16MB BSON limit.
+
+        The checkpoint, its writes and its blobs are returned as a single document, which
+        a long thread can grow past the limit even though each of them fits on its own.
+        Callers then load them with separate queries instead.
+        """
+        try:
+            return await self.db[self.collection_name].aggregate(
+                self._latest_checkpoint_pipeline(query, with_checkpoint=with_checkpoint)
+            ).to_list(length=1)
+        except OperationFailure as e:
+            if e.code != _BSON_OBJECT_TOO_LARGE and "BSONObjectTooLarge" not in str(e):
+                raise
+            logger.warning("Checkpoint of %s is too large for one query, loading it in parts", query.get("thread_id"))
+            return None
+
+    def _latest_checkpoint_pipeline(self, query: Dict[str, Any], with_checkpoint: bool = True) -> list:
+        """Aggregation that returns the latest matching checkpoint with its pending writes and blobs.
+
+        Loading a checkpoint this way costs a single round-trip to MongoDB instead of one
+        for the checkpoint, one for its pending writes and one for its blobs. Without
+        with_checkpoint only the checkpoint_id and the pending writes are returned.
+        """
+        pipeline = [
+            {"$match": query},
+            {"$sort": {"checkpoint_id": -1}},
+            {"$limit": 1},
+            {
+                "$lookup": {
+                    "from": f"{self.collection_name}_writes",
+                    "let": {
+                        "thread_id": "$thread_id",
+                        "checkpoint_ns": "$checkpoint_ns",
+                        "checkpoint_id": "$checkpoint_id",
+                    },
+                    "pipeline": [
+                        {
+                            "$match": {
+                                "$expr": {
+                                    "$and": [
+                                        {"$eq": ["$thread_id", "$$thread_id"]},
+                                        {"$eq": ["$checkpoint_ns", "$$checkpoint_ns"]},
+                                        {"$eq": ["$checkpoint_id", "$$checkpoint_id"]},
+                                    ]
+                                }
+                            }
+                        },
+                        {"$sort": {"task_id": 1, "idx": 1}},
+                        {"$project": _WRITES_PROJECTION},
+                    ],
+                    "as": "pending_writes",
+                }
+            },
+        ]
+        if not with_checkpoint:
+            return pipeline + [{"$project": {"_id": 0, "checkpoint_id": 1, "pending_writes": 1}}]
+        return pipeline + [
+            {
+                # Full documents have no blob_ids, so this only matches for blobs mode
+                "$lookup": {
+                    "from": self.blobs_collection_name,
+                    "localField": "blob_ids",
+                    "foreignField": "_id",
+                    "as": "blobs",
+                }
+            },
+            {
+                "$project": {
+                    **_CHECKPOINT_PROJECTION,
+                    "pending_writes": 1,
+                    "blobs.channel": 1,
+                    "blobs.type": 1,
+                    "blobs.value": 1,
+                }
+            },
+        ]
 
     async def alist(
         self,
@@ -373,6 +1190,7 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
         Yields:
             AsyncIterator[CheckpointTuple]: An asynchronous iterator of matching checkpoint tuples.
         """
+        await self._await_pending_writes()
         query = {}
         if config is not None:
             query = {
@@ -392,7 +1210,12 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
         if limit is not None:
             result = result.limit(limit)
         async for doc in result:
-            checkpoint = self.serde.loads_typed((doc["type"], doc["checkpoint"]))
+            if doc.get("storage") == STORAGE_BLOBS:
+                checkpoint = await self._aload_checkpoint(doc)
+            else:
+                checkpoint = self.serde.loads_typed((doc["type"], doc["checkpoint"]))
+                if self.storage_mode == STORAGE_BLOBS:
+                    checkpoint = _normalize_versions(checkpoint)
             yield CheckpointTuple(
                 {
                     "configurable": {
@@ -402,7 +1225,7 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
                     }
                 },
                 checkpoint,
-                self.serde.loads(doc["metadata"]),
+                _load_metadata(self.serde, doc),
                 (
                     {
                         "configurable": {
@@ -440,22 +1263,37 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
         thread_id = config["configurable"]["thread_id"]
         checkpoint_ns = config["configurable"]["checkpoint_ns"]
         checkpoint_id = checkpoint["id"]
-        type_, serialized_checkpoint = self.serde.dumps_typed(checkpoint)
         doc = {
             "parent_checkpoint_id": config["configurable"].get("checkpoint_id"),
-            "type": type_,
-            "checkpoint": serialized_checkpoint,
-            "metadata": self.serde.dumps(metadata),
+            **_dump_metadata(self.serde, metadata),
+            "created_at": datetime.now(timezone.utc),
         }
+        operations = []
+        if self.storage_mode == STORAGE_BLOBS:
+            # Only the channels updated by this step are written, the rest are
+            # referenced through blob_ids from earlier checkpoints
+            blob_operations = self._dump_blobs(
+                thread_id, checkpoint_ns, checkpoint["channel_values"], new_versions
+            )
+            if blob_operations:
+                operations.append((self.blobs_collection_name, blob_operations))
+            type_, serialized_checkpoint = self.serde.dumps_typed({**checkpoint, "channel_values": {}})
+            doc["storage"] = STORAGE_BLOBS
+            doc["blob_ids"] = [
+                _blob_id(thread_id, checkpoint_ns, channel, version)
+                for channel, version in checkpoint["channel_versions"].items()
+            ]
+        else:
+            type_, serialized_checkpoint = self.serde.dumps_typed(checkpoint)
+        doc["type"] = type_
+        doc["checkpoint"] = serialized_checkpoint
         upsert_query = {
             "thread_id": thread_id,
             "checkpoint_ns": checkpoint_ns,
             "checkpoint_id": checkpoint_id,
         }
-        # Perform your operations here
-        await self.db[self.collection_name].update_one(
-            upsert_query, {"$set": doc}, upsert=True
-        )
+        operations.append((self.collection_name, [UpdateOne(upsert_query, {"$set": doc}, upsert=True)]))
+        await self._awrite(operations, thread_id)
         return {
             "configurable": {
                 "thread_id": thread_id,
@@ -500,9 +1338,163 @@ class AsyncMongoDBSaver(BaseCheckpointSaver):
                             "channel": channel,
                             "type": type_,
                             "value": serialized_value,
+                            "created_at": datetime.now(timezone.utc),
                         }
                     },
                     upsert=True,
                 )
             )
-        await self.db[f"{self.collection_name}_writes"].bulk_write(operations)
\ No newline at end of file
+        await self._awrite([(f"{self.collection_name}_writes", operations)], thread_id)
+
+    async def _awrite(self, operations: Sequence[Tuple[str, list]], thread_id: str) -> None:
+        """Persist (collection name, bulk operations) pairs of a thread, in order.
+
+        Without write-behind the operations are written before returning. With write-behind
+        they are handed to the background flusher, and only awaited when durability is "always".
+        """
+        if self.write_behind is None:
+            for collection_name, collection_operations in operations:
+                await self.db[collection_name].bulk_write(collection_operations)
+            return
+        future = await self.write_behind.submit(operations, thread_id)
+        if self.durability == DURABILITY_ALWAYS:
+            try:
+                await future
+            except Exception:
+                # Raised here, aflush() must not raise it a second time
+                self.write_behind.failures.pop(thread_id, None)
+                raise
+
+    async def aflush(self, force: bool = False, thread_id: Optional[str] = None) -> None:
+        """Wait until every checkpoint write queued so far has been persisted.
+
+        Call this when a graph run ends, on an interrupt or at END. With durability "none"
+        this returns immediately unless force is set.
+
+        Args:
+            force (bool): Flush even when durability is "none". Defaults to False.
+            thread_id (Optional[str]): Only raise the failed writes of this thread. Defaults to every thread.
+
+        Raises:
+            CheckpointWriteError: When queued writes failed since the last flush.
+        """
+        if self.write_behind is None:
+            return
+        if self.durability == DURABILITY_NONE and not force:
+            return
+        await self.write_behind.flush(thread_id)
+
+    async def aclose(self) -> None:
+        """Flush queued writes and stop the background flusher and compaction."""
+        self.stop_compaction()
+        if self.write_behind is not None:
+            await self.write_behind.close()
+
+    async def acompact(self, thread_id: Optional[str] = None) -> Dict[str, int]:
+        """Delete the checkpoints, pending writes and blobs the retention policy no longer keeps.
+
+        Args:
+            thread_id (Optional[str]): Only compact this thread. Defaults to all threads.
+
+        Returns:
+            Dict[str, int]: The number of deleted documents per collection and the bytes reclaimed.
+        """
+        report = _empty_report()
+        if self.retention is None or self.retention.use_ttl_index:
+            return report
+        await self._await_pending_writes()
+        match = {"thread_id": thread_id} if thread_id is not None else {}
+        groups = self.db[self.collection_name].aggregate(
+            [
+                {"$match": match},
+                {"$group": {"_id": {"thread_id": "$thread_id", "checkpoint_ns": "$checkpoint_ns"}, "count": {"$sum": 1}}},
+                {"$match": {"count": {"$gt": self.retention.protected}}},
+            ]
+        )
+        async for group in groups:
+            thread_report = await self._acompact_thread(group["_id"]["thread_id"], group["_id"]["checkpoint_ns"])
+            for key, value in thread_report.items():
+                report[key] += value
+        return report
+
+    async def _acompact_thread(self, thread_id: str, checkpoint_ns: str) -> Dict[str, int]:
+        report = _empty_report()
+        thread_query = {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns}
+        now = datetime.now(timezone.utc)
+        candidates = (
+            self.db[self.collection_name]
+            .find(thread_query, {"checkpoint_id": 1, "created_at": 1})
+            .sort("checkpoint_id", -1)
+            .skip(self.retention.protected)
+        )
+        expired = [
+            doc["checkpoint_id"]
+            async for doc in candidates
+            if self.retention.is_expired(doc.get("created_at"), now)
+        ]
+        if not expired:
+            return report
+
+        query = {**thread_query, "checkpoint_id": {"$in": expired}}
+        for key, collection_name in (("checkpoints", self.collection_name), ("writes", f"{self.collection_name}_writes")):
+            report["bytes"] += await self._abson_size(collection_name, query)
+            result = await self.db[collection_name].delete_many(query)
+            report[key] += result.deleted_count
+
+        # Blobs are shared between checkpoints, only delete the ones no remaining checkpoint references
+        referenced = set()
+        async for doc in self.db[self.collection_name].find({**thread_query, "storage": STORAGE_BLOBS}, {"blob_ids": 1}):
+            referenced.update(doc["blob_ids"])
+        blob_query = {
+            **thread_query,
+            "_id": {"$nin": list(referenced)},
+            "$or": [
+                {"created_at": {"$lt": now - self.retention.blob_grace_period}},
+                {"created_at": {"$exists": False}},
+            ],
+        }
+        report["bytes"] += await self._abson_size(self.blobs_collection_name, blob_query)
+        result = await self.db[self.blobs_collection_name].delete_many(blob_query)
+        report["blobs"] += result.deleted_count
+        return report
+
+    async def _abson_size(self, collection_name: str, query: Dict[str, Any]) -> int:
+        groups = await self.db[collection_name].aggregate(
+            [{"$match": query}, {"$group": {"_id": None, "bytes": {"$sum": {"$bsonSize": "$$ROOT"}}}}]
+        ).to_list(length=1)
+        return groups[0]["bytes"] if groups else 0
+
+    def start_compaction(self, interval: float) -> None:
+        """Run acompact() every interval seconds in a background task."""
+        if self.retention is None or self.retention.use_ttl_index:
+            return
+        if self._compaction_task is None or self._compaction_task.done():
+            self._compaction_task = asyncio.create_task(self._run_compaction(interval))
+
+    def stop_compaction(self) -> None:
+        if self._compaction_task is not None:
+            self._compaction_task.cancel()
+            self._compaction_task = None
+
+    async def _run_compaction(self, interval: float) -> None:
+        while True:
+            # Spread the workers out so they do not all compact at once
+            await asyncio.sleep(interval * random.uniform(0.5, 1.5))
+            try:
+                report = await self.acompact()
+            except Exception as e:
+                logger.error("Checkpoint compaction failed: %s", e)
+                continue
+            if report["checkpoints"] or report["blobs"]:
+                logger.info(
+                    "Checkpoint compaction removed %d checkpoints, %d writes and %d blobs, reclaiming %d bytes",
+                    report["checkpoints"],
+                    report["writes"],
+                    report["blobs"],
+                    report["bytes"],
+                )
+
+    async def _await_pending_writes(self) -> None:
+        # Reads always see this worker's own writes, whatever the durability
+        if self.write_behind is not None and self.write_behind.pending:
+            await self.write_behind.flush(raise_errors=False)
\ No newline at end of file
@@ -1,17 +1,25 @@
+import json
 import uuid
-from langchain_core.messages import ToolMessage
+from langchain_core.messages import AIMessage, AIMessageChunk, ToolMessage
 from components.utilities import _print_event
 import tools.ocr as ocr_tools
 import components.initializer as init
 from pymongo import MongoClient
 from fastapi import UploadFile
-from typing import List
-from agents.single_agent import single_agent_graph
+from typing import AsyncIterator, List, Optional
+from agents.single_agent import get_single_agent_graph, checkpointer
 from components.initializer import mongo_client as client
+from components.thread_lock import InProcessThreadLocks, MongoLeaseThreadLocks
 
 db = client[init.CHATBOT_MONGO_DATABASE]
 collection = db[init.CHATBOT_MONGO_COLLECTION_STATUS]
 
+# Serializes the turns of each thread, "mongo" also across uvicorn workers
+if init.THREAD_LOCK_BACKEND == "mongo":
+    thread_locks = MongoLeaseThreadLocks(db[init.THREAD_LOCK_COLLECTION])
+else:
+    thread_locks = InProcessThreadLocks()
+
 
 async def handle_single_agent_1(user_input: str, thread_id):
     print("1")
@@ -22,7 +30,7 @@ async def handle_single_agent_1(user_input: str, thread_id):
     }
     _printed = set()
     tool_call_id = "None"   
-    events = single_agent_graph.astream(
+    events = get_single_agent_graph().astream(
         {"messages": ("user", user_input)}, config, stream_mode="values"
     )
     async for event in events:
@@ -35,7 +43,7 @@ async def handle_single_agent_1(user_input: str, thread_id):
                 message = message[-1]
                 last_msg = message.content
 
-    snapshot = await single_agent_graph.aget_state(config)
+    snapshot = await get_single_agent_graph().aget_state(config)
 
     if snapshot.next:
         ask_permission = "ask permission"
@@ -54,13 +62,13 @@ async def handle_single_agent_2(user_input: str, ask_permission: str, tool_call_
             "thread_id": thread_id,
         }
     }
-    snapshot = await single_agent_graph.aget_state(config)
+    snapshot = await get_single_agent_graph().aget_state(config)
     user_input = user_input.lower()
 
     while snapshot.next and ask_permission == "ask permission":
         if user_input == "yes":
             print("in response yes")
-            event = await single_agent_graph.ainvoke(None, config)
+            event = await get_single_agent_graph().ainvoke(None, config)
 
         else:
             print("In response no")
@@ -72,14 +80,14 @@ async def handle_single_agent_2(user_input: str, ask_permission: str, tool_call_
             for id in tool_call_ids
             ]
 
-            event = await single_agent_graph.ainvoke(
+            event = await get_single_agent_graph().ainvoke(
                 {
                     "messages": tool_messages
                 },
                 config,
             )
 
-        snapshot = await single_agent_graph.aget_state(config)
+        snapshot = await get_single_agent_graph().aget_state(config)
     
     message = event.get("messages")
     # print(message)
@@ -91,13 +99,25 @@ async def handle_single_agent_2(user_input: str, ask_permission: str, tool_call_
     return last_msg, ask_permission
 
 
-async def handle_single_agent_all(user_input: str, thread_id: str, file: UploadFile = None):
-    permission, tool_call_id = await get_status(thread_id=thread_id)
-  
+async def handle_single_agent_all(user_input: str, thread_id: str, file: UploadFile = None, request_id: Optional[str] = None):
+    # Uploads do not touch the thread state, so they run before waiting for the thread
     if file is not None:
         link = await ocr_tools.upload_file_and_get_link(file)
         user_input = user_input + " " + link
 
+    # Turns of a thread run one at a time, a request sent again with the same request id
+    # while the first one is still in flight (client retry, Telegram redelivery) gets the
+    # first one's response. The same text without a request id is a new turn
+    return await thread_locks.run(
+        thread_id,
+        lambda: handle_single_agent_turn(user_input, thread_id),
+        coalesce_key=request_id,
+    )
+
+
+async def handle_single_agent_turn(user_input: str, thread_id: str):
+    permission, tool_call_id = await get_status(thread_id=thread_id)
+
     if permission == "ask permission":
         response, permission = await handle_single_agent_2(user_input=user_input, ask_permission=permission, tool_call_ids=tool_call_id, thread_id=thread_id)
 
@@ -108,15 +128,124 @@ async def handle_single_agent_all(user_input: str, thread_id: str, file: UploadF
     elif permission == "finish":
         permission = "new"
 
+    # The run ended on an interrupt or at END, persist any checkpoint writes still queued
+    await checkpointer.aflush(thread_id=thread_id)
+
     # Update the permission and tool_call_id on mongodb
     await update_status(thread_id, permission, tool_call_id)
     return response
 
 
+async def stream_single_agent_all(user_input: str, thread_id: str) -> AsyncIterator[dict]:
+    """
+    streams a turn of the single agent as server-sent events:
+    start, token (LLM output), tool_start, tool_end, permission (tool approval needed), end and error
+    """
+    # Sent before any database or LLM work so the client gets its first byte immediately
+    yield {"event": "start", "data": json.dumps({"thread_id": thread_id})}
+    try:
+        async with thread_locks.hold(thread_id):
+            permission, tool_call_ids = await get_status(thread_id=thread_id)
+            config = {
+                "configurable": {
+                    "thread_id": thread_id,
+                }
+            }
+            if permission == "ask permission":
+                approved = user_input.lower() == "yes"
+                graph_input = None if approved else _deny_tool_calls(tool_call_ids)
+            else:
+                approved = False
+                graph_input = {"messages": ("user", user_input)}
+
+            while True:
+                last_msg = None
+                async for event, last in _stream_run(graph_input, config):
+                    if event is not None:
+                        yield event
+                    if last is not None:
+                        last_msg = last
+                snapshot = await get_single_agent_graph().aget_state(config)
+                # Same as handle_single_agent_2: a "yes" approves every sensitive tool of this turn
+                if snapshot.next and approved:
+                    graph_input = None
+                    continue
+                break
+
+            if snapshot.next:
+                permission = "ask permission"
+                tool_calls = snapshot.values["messages"][-1].tool_calls
+                tool_call_ids = [tc["id"] for tc in tool_calls]
+                response = "Do you approve the use of the tool? Type in (yes/no) \nTool Called: " + tool_calls[0]["name"]
+                yield {
+                    "event": "permission",
+                    "data": json.dumps({"message": response, "tool": tool_calls[0]["name"], "tool_call_ids": tool_call_ids}),
+                }
+            else:
+                permission = "new"
+                tool_call_ids = "None"
+                response = last_msg
+
+            await checkpointer.aflush(thread_id=thread_id)
+            await update_status(thread_id, permission, tool_call_ids)
+            yield {"event": "end", "data": json.dumps({"message": response, "permission": permission})}
+    except Exception as e:
+        yield {"event": "error", "data": json.dumps({"detail": str(e)})}
+
+
+async def _stream_run(graph_input, config):
+    """
+    runs the graph once, yields (event, last assistant message) pairs as the run progresses
+    """
+    async for mode, chunk in get_single_agent_graph().astream(graph_input, config, stream_mode=["messages", "updates"]):
+        if mode == "messages":
+            message, metadata = chunk
+            # Tokens of the SQL agent inside the tools are not meant for the user
+            if isinstance(message, AIMessageChunk) and message.content and metadata.get("langgraph_node") == "assistant":
+                yield {"event": "token", "data": json.dumps({"content": message.content})}, None
+            continue
+
+        for node, update in chunk.items():
+            messages = update.get("messages") if isinstance(update, dict) else None
+            if messages is None:
+                continue
+            if not isinstance(messages, list):
+                messages = [messages]
+            for message in messages:
+                if isinstance(message, AIMessage) and message.tool_calls:
+                    for tool_call in message.tool_calls:
+                        yield {
+                            "event": "tool_start",
+                            "data": json.dumps({"id": tool_call["id"], "name": tool_call["name"], "args": tool_call["args"]}, default=str),
+                        }, None
+                elif isinstance(message, AIMessage):
+                    yield None, message.content
+                elif isinstance(message, ToolMessage):
+                    yield {
+                        "event": "tool_end",
+                        "data": json.dumps({"id": message.tool_call_id, "name": message.name, "content": message.content}, default=str),
+                    }, None
+
+
+def _deny_tool_calls(tool_call_ids: List[str]) -> dict:
+    return {
+        "messages": [
+            ToolMessage(
+                content="API call denied by user. Continue assisting, accounting for the user's input.",
+                tool_call_id=id,
+            )
+            for id in tool_call_ids
+        ]
+    }
+
+
 async def get_status(thread_id: str) -> str:
     """
     gets and uploads status of the user from MongoDB
     """
+    if init.STATUS_FROM_CHECKPOINT:
+        return await get_status_from_checkpoint(thread_id)
+
     # Retrieve the status document from MongoDB
     print("Fetching status...")
     status = await collection.find_one({"thread_id": thread_id})  # Replace with your document's _id or any identifier
@@ -131,10 +260,34 @@ async def get_status(thread_id: str) -> str:
     return permission, tool_call_id
 
 
+async def get_status_from_checkpoint(thread_id: str):
+    """
+    derives the status from the graph checkpoint instead of the status collection:
+    the graph is waiting for permission exactly when it was interrupted before a tool,
+    and the tool call ids are the ones of the last AI message
+    """
+    config = {
+        "configurable": {
+            "thread_id": thread_id,
+        }
+    }
+    snapshot = await get_single_agent_graph().aget_state(config)
+    if snapshot.next:
+        tool_calls = snapshot.values["messages"][-1].tool_calls
+        return "ask permission", [tc["id"] for tc in tool_calls]
+    # Without a checkpoint there is nothing to resume, a pending permission of a status
+    # document from before this mode cannot be resumed either
+    return "new", "None"
+
+
 async def update_status(thread_id, permission, tool_call_id) -> None:
     """
     updates the status for user on mongodb
     """
+    if init.STATUS_FROM_CHECKPOINT:
+        # The status is derived from the checkpoint, nothing to store
+        return
+
     # Prepare the fields to update
     update_fields = {
         "permission": permission,
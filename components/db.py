@@ -1,3 +1,13 @@
+import asyncio
+import contextvars
+import functools
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
 from langchain_community.utilities import SQLDatabase
 from google.cloud.sql.connector import Connector
 import sqlalchemy
@@ -15,10 +25,16 @@ def create_connector(credential_path):
 # Load the credential set
 # connector_1 = create_connector(os.getenv('GOOGLE_APPLICATION_CREDENTIALS_1'))
 # connector_2 = create_connector(os.getenv('GOOGLE_APPLICATION_CREDENTIALS_2'))
-# for suria
-connector_1 = create_connector(init.SURIA_DB_SERVICE_ACCOUNT_FILE)
-# for sip-cde
-connector_2 = create_connector(init.SIP_CDE_DB_SERVICE_ACCOUNT_FILE)
+# Created on first use, the pools keep using them to open new connections
+connectors: Dict[str, Connector] = {}
+_connectors_lock = threading.Lock()
+
+
+def get_connector(credential_path):
+    with _connectors_lock:
+        if credential_path not in connectors:
+            connectors[credential_path] = create_connector(credential_path)
+        return connectors[credential_path]
 
 def getconn(connector: Connector, instance_name, user, db):
     conn = connector.connect(
@@ -31,32 +47,214 @@ def getconn(connector: Connector, instance_name, user, db):
     return conn
 
 # getconn now using IAM user and requiring no password with IAM Auth enabled
+# for suria
 def getconn_1():
-    return getconn(connector_1, init.INSTANCE_CONNECTION_NAME_1, init.IAM_USER_1, init.DB_NAME_1)
+    return getconn(get_connector(init.SURIA_DB_SERVICE_ACCOUNT_FILE), init.INSTANCE_CONNECTION_NAME_1, init.IAM_USER_1, init.DB_NAME_1)
 
+# for sip-cde
 def getconn_2():
-    return getconn(connector_2, init.INSTANCE_CONNECTION_NAME_2, init.IAM_USER_2, init.DB_NAME_2)
- 
-connectors = [getconn_1(), getconn_2()]
-# create connection pool
-pools = [(sqlalchemy.create_engine(
-    "postgresql+pg8000://",
-    creator=lambda conn=connector: conn  ,
-)) for connector in connectors]
-
-# connect to connection pool
-for pool in pools:
-    print(type(pool))
+    return getconn(get_connector(init.SIP_CDE_DB_SERVICE_ACCOUNT_FILE), init.INSTANCE_CONNECTION_NAME_2, init.IAM_USER_2, init.DB_NAME_2)
+
+def create_pool(creator=None, url="postgresql+pg8000://"):
+    # Every checkout opens its own Cloud SQL connection through the connector, up to
+    # pool_size + max_overflow at once. Dead connections are replaced on checkout and
+    # old ones recycled before the IAM token they were opened with expires
+    if url.startswith("sqlite"):
+        # Local stub, SQLite has its own pooling
+        path = sqlalchemy.engine.make_url(url).database
+        if path and path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        return sqlalchemy.create_engine(url)
+    kwargs = {"creator": creator} if creator else {}
+    return sqlalchemy.create_engine(
+        url,
+        pool_size=init.SQL_POOL_SIZE,
+        max_overflow=init.SQL_POOL_MAX_OVERFLOW,
+        pool_timeout=init.SQL_POOL_TIMEOUT,
+        pool_recycle=init.SQL_POOL_RECYCLE,
+        pool_pre_ping=True,
+        **kwargs,
+    )
+
+# database name -> (creator of a Cloud SQL connection, URL of the local stub)
+DATABASE_SOURCES = {
+    "suria": (getconn_1, init.SURIA_DB_URL),
+    "sip-cde": (getconn_2, init.SIP_CDE_DB_URL),
+}
+
+# pg8000 is blocking, SQL runs on its own threads so it neither blocks the event loop
+# nor competes with the default executor. One thread per connection the pools can open
+sql_executor = ThreadPoolExecutor(
+    max_workers=len(DATABASE_SOURCES) * (init.SQL_POOL_SIZE + init.SQL_POOL_MAX_OVERFLOW),
+    thread_name_prefix="sql",
+)
+
+
+async def arun_sql(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Run a blocking database call on the SQL thread pool."""
+    # Keeps the callbacks and tracing context of the calling task
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        sql_executor, functools.partial(ctx.run, func, *args, **kwargs)
+    )
+
+def check_connection(pool):
+    # connect to connection pool
     with pool.connect() as db_conn:
         # get current datetime from database
-        results = db_conn.execute(sqlalchemy.text("SELECT NOW()")).fetchone()
+        results = db_conn.execute(sqlalchemy.text("SELECT CURRENT_TIMESTAMP")).fetchone()
 
         # output time
         print("Current time: ", results[0])
 
-suria_db = SQLDatabase(engine=pools[0])
-sip_cde_db = SQLDatabase(engine=pools[1])
- 
-# cleanup connector
-connector_1.close()
-connector_2.close()
\ No newline at end of file
+
+class CachedSQLDatabase(SQLDatabase):
+    """SQLDatabase that keeps a versioned snapshot of the schema in memory.
+
+    The table list and each table's info (CREATE TABLE plus sample rows) are introspected
+    once and served from memory, so the agent's sql_db_list_tables and sql_db_schema tools
+    no longer query the database on every question. Every check_interval seconds a
+    fingerprint of information_schema.columns is compared with the snapshot's version and
+    the tables are reflected again on a DDL change. The snapshot is also rebuilt after ttl
+    seconds to refresh the sample rows.
+
+    Args:
+        engine (sqlalchemy.engine.Engine): The database engine.
+        ttl (float): Seconds after which the snapshot is rebuilt. Defaults to 3600.
+        check_interval (float): Seconds between two DDL-change checks. Defaults to 300.
+    """
+
+    def __init__(self, engine: sqlalchemy.engine.Engine, ttl: float = 3600, check_interval: float = 300, **kwargs: Any) -> None:
+        super().__init__(engine=engine, **kwargs)
+        self.ttl = ttl
+        self.check_interval = check_interval
+        # The agent tools run in executor threads
+        self._lock = threading.Lock()
+        self._table_info: Dict[str, str] = {}
+        self.version = self._fingerprint()
+        self.built_at = self.checked_at = time.monotonic()
+        self.rebuilds = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "tables": len(self._usable_tables),
+            "cached_tables": len(self._table_info),
+            "age_seconds": time.monotonic() - self.built_at,
+            "rebuilds": self.rebuilds,
+        }
+
+    def invalidate(self) -> None:
+        """Drop the snapshot, the next lookup reflects the tables again."""
+        with self._lock:
+            self._rebuild()
+
+    def get_usable_table_names(self) -> Iterable[str]:
+        self._ensure_fresh()
+        return super().get_usable_table_names()
+
+    def get_table_info(self, table_names: Optional[List[str]] = None) -> str:
+        self._ensure_fresh()
+        usable = self.get_usable_table_names()
+        if table_names is None:
+            table_names = list(usable)
+        else:
+            missing_tables = set(table_names).difference(usable)
+            if missing_tables:
+                raise ValueError(f"table_names {missing_tables} not found in database")
+        # Same order as SQLDatabase.get_table_info
+        ordered = [table.name for table in self._metadata.sorted_tables if table.name in set(table_names)]
+        return "\n\n".join(self._get_one_table_info(name) for name in ordered)
+
+    def _get_one_table_info(self, table_name: str) -> str:
+        info = self._table_info.get(table_name)
+        if info is None:
+            info = super().get_table_info([table_name])
+            with self._lock:
+                self._table_info[table_name] = info
+        return info
+
+    def _ensure_fresh(self) -> None:
+        now = time.monotonic()
+        if now - self.checked_at < self.check_interval and now - self.built_at < self.ttl:
+            return
+        with self._lock:
+            if now - self.built_at >= self.ttl:
+                self._rebuild()
+            elif now - self.checked_at >= self.check_interval:
+                version = self._fingerprint()
+                if version != self.version:
+                    print(f"Schema changed ({self.version} -> {version}), reflecting the tables again")
+                    self._rebuild(version)
+                self.checked_at = time.monotonic()
+
+    def _rebuild(self, version: Optional[str] = None) -> None:
+        self._inspector = sqlalchemy.inspect(self._engine)
+        self._all_tables = set(
+            self._inspector.get_table_names(schema=self._schema)
+            + (self._inspector.get_view_names(schema=self._schema) if self._view_support else [])
+        )
+        self._usable_tables = self._include_tables or self._all_tables - self._ignore_tables
+        self._metadata = sqlalchemy.MetaData()
+        self._metadata.reflect(
+            views=self._view_support, bind=self._engine, only=list(self._usable_tables), schema=self._schema
+        )
+        self._table_info = {}
+        self.version = version or self._fingerprint()
+        self.built_at = self.checked_at = time.monotonic()
+        self.rebuilds += 1
+
+    def _fingerprint(self) -> str:
+        with self._engine.connect() as conn:
+            if self.dialect == "sqlite":
+                # The local stub has no information_schema
+                rows = conn.execute(sqlalchemy.text("SELECT name, sql FROM sqlite_master ORDER BY name")).fetchall()
+            else:
+                rows = conn.execute(
+                    sqlalchemy.text(
+                        "SELECT table_name, column_name, data_type FROM information_schema.columns "
+                        "WHERE table_schema = :schema ORDER BY table_name, ordinal_position"
+                    ),
+                    {"schema": self._schema or "public"},
+                ).fetchall()
+        return hashlib.sha256(repr([tuple(row) for row in rows]).encode("utf-8")).hexdigest()[:16]
+
+
+# Opened on first use or by awarm_up(), so importing this module does not connect
+databases: Dict[str, CachedSQLDatabase] = {}
+_database_locks = {name: threading.Lock() for name in DATABASE_SOURCES}
+
+
+def get_database(name: str) -> CachedSQLDatabase:
+    """Get the database of a name, connecting and reading its schema the first time. Blocking."""
+    database = databases.get(name)
+    if database is not None:
+        return database
+    with _database_locks[name]:
+        if name not in databases:
+            creator, url = DATABASE_SOURCES[name]
+            pool = create_pool(url=url) if init.BACKEND == "local" else create_pool(creator)
+            check_connection(pool)
+            databases[name] = CachedSQLDatabase(
+                engine=pool, ttl=init.SQL_SCHEMA_TTL, check_interval=init.SQL_SCHEMA_CHECK_INTERVAL
+            )
+        return databases[name]
+
+
+async def aget_database(name: str) -> CachedSQLDatabase:
+    database = databases.get(name)
+    if database is None:
+        database = await arun_sql(get_database, name)
+    return database
+
+
+async def awarm_up() -> None:
+    """Connect to every database concurrently, called at startup."""
+    await asyncio.gather(*(aget_database(name) for name in DATABASE_SOURCES))
+
+
+def __getattr__(name):
+    # suria_db and sip_cde_db used to be opened at import
+    if name in ("suria_db", "sip_cde_db"):
+        return get_database(name[: -len("_db")].replace("_", "-"))
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
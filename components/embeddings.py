@@ -0,0 +1,134 @@
+# async embeddings client shared by every embedding call site
+import asyncio
+import logging
+import random
+from typing import Any, Dict, List, Optional, Sequence
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# Worth retrying, anything else (bad request, auth) fails straight away
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+
+class AsyncEmbeddingClient:
+    """Async OpenAI embeddings with a pooled HTTP client, a concurrency limit, retries and batching.
+
+    aembed_one() calls made within batch_window seconds of each other are sent as one
+    embeddings request, so concurrent users routing questions at the same time share a
+    round-trip. Requests are retried with exponential backoff and jitter on rate limits,
+    timeouts, connection and server errors.
+
+    Args:
+        api_key (str): The OpenAI API key.
+        model (str): The embeddings model.
+        max_concurrency (int): The maximum number of embeddings requests in flight. Defaults to 8.
+        max_batch_size (int): The maximum number of inputs per request. Defaults to 256.
+        batch_window (float): Seconds aembed_one() waits for other inputs to batch with. Defaults to 0.01.
+        max_retries (int): Retries per request before giving up. Defaults to 5.
+        timeout (float): Seconds before a request times out. Defaults to 30.
+    """
+
+    def __init__(
+        self,
+        api_key: Optional[str],
+        model: str,
+        *,
+        max_concurrency: int = 8,
+        max_batch_size: int = 256,
+        batch_window: float = 0.01,
+        max_retries: int = 5,
+        timeout: float = 30,
+    ) -> None:
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.max_retries = max_retries
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            max_retries=0,  # retried here, with our own backoff
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=max_concurrency * 2, max_keepalive_connections=max_concurrency),
+                timeout=timeout,
+            ),
+        )
+        self.max_concurrency = max_concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._pending: List[tuple] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self.requests = 0
+        self.inputs = 0
+        self.retries = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {"requests": self.requests, "inputs": self.inputs, "retries": self.retries}
+
+    async def aembed(self, texts: Sequence[str]) -> List[List[float]]:
+        """Embed several texts, split into concurrent requests of at most max_batch_size inputs."""
+        texts = list(texts)
+        chunks = [texts[i : i + self.max_batch_size] for i in range(0, len(texts), self.max_batch_size)]
+        results = await asyncio.gather(*(self._acreate(chunk) for chunk in chunks))
+        return [embedding for chunk in results for embedding in chunk]
+
+    async def aembed_one(self, text: str) -> List[float]:
+        """Embed one text, batched with the other texts submitted within batch_window."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, []
+        if pending:
+            asyncio.get_running_loop().create_task(self._aflush(pending))
+
+    async def _aflush(self, pending: List[tuple]) -> None:
+        try:
+            embeddings = await self._acreate([text for text, _ in pending])
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), embedding in zip(pending, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+    async def _acreate(self, texts: List[str]) -> List[List[float]]:
+        if self._semaphore is None:
+            # Created lazily, the client is built at import time before the event loop runs
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    res = await self.client.embeddings.create(input=texts, model=self.model)
+                self.requests += 1
+                self.inputs += len(texts)
+                return [data.embedding for data in sorted(res.data, key=lambda data: data.index)]
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = min(0.5 * 2**attempt, 20) * random.uniform(0.5, 1.5)
+                logger.warning("Embeddings request failed (%s), retrying in %.1fs", e.__class__.__name__, delay)
+                attempt += 1
+                self.retries += 1
+                await asyncio.sleep(delay)
+
+    async def aclose(self) -> None:
+        await self.client.close()
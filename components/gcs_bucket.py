@@ -1,68 +1,218 @@
 from google.cloud import storage
-import os
+import asyncio
 import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from typing import Any, BinaryIO, Dict, Optional, Union
+from urllib.parse import quote
 from dotenv import load_dotenv
 load_dotenv()
 
+from google.auth.credentials import AnonymousCredentials
+from google.cloud.storage.retry import DEFAULT_RETRY
 from google.oauth2 import service_account
+from pathlib import Path
+import components.initializer as init
 
-async def set_google_credentials(cred_path=None):
-    """Set the GOOGLE_APPLICATION_CREDENTIALS environment variable."""
-    if cred_path:
-        credentials = service_account.Credentials.from_service_account_file(cred_path)
-        return credentials
-        # if os.path.exists(cred_path):
-        #     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = cred_path
-        # else:
-        #     print(f"Credentials file not found at {cred_path}")
-        #     raise FileNotFoundError(f"Credentials file not found at {cred_path}")
-    else:
-        raise EnvironmentError("GOOGLE_APPLICATION_CREDENTIALS is not set. Please set the environment variable or provide the path to the credentials file.")
-    # elif "GOOGLE_APPLICATION_CREDENTIALS" not in os.environ:
-    #     raise EnvironmentError("GOOGLE_APPLICATION_CREDENTIALS is not set. Please set the environment variable or provide the path to the credentials file.")
+# Content types of the chart formats, other extensions are uploaded as application/<extension>
+CONTENT_TYPES = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "svg": "image/svg+xml",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+}
+
+def content_type(file_extension: str) -> str:
+    file_extension = file_extension.lstrip(".").lower()
+    return CONTENT_TYPES.get(file_extension, f"application/{file_extension}")
+
+
+class GCSService:
+    """A long-lived Google Cloud Storage client for one service account.
+
+    The credentials and the storage client are built once and reused by every upload. The
+    blocking client calls run on a thread pool of their own, so uploads never block the
+    event loop and up to max_workers of them run at once. Files above resumable_threshold
+    are uploaded resumably in chunks of chunk_size, so a large file is neither sent in one
+    request nor restarted from scratch when a chunk fails.
+
+    With STORAGE_EMULATOR_HOST set the client talks to that server with anonymous
+    credentials, and the links point at its download endpoint instead of being signed.
+
+    Args:
+        credentials_file (Optional[str]): Path to the service account JSON file. Defaults to the application default credentials.
+        max_workers (int): The number of uploads running at once. Defaults to 8.
+        chunk_size (int): Bytes per request of a resumable upload, a multiple of 256KB. Defaults to 8MB.
+        resumable_threshold (int): Uploads above this size are resumable. Defaults to 8MB.
+        signed_url_hours (float): Hours a signed URL is valid for. Defaults to 1.
+    """
+
+    def __init__(
+        self,
+        credentials_file: Optional[str] = None,
+        max_workers: int = 8,
+        chunk_size: int = 8 * 1024 * 1024,
+        resumable_threshold: int = 8 * 1024 * 1024,
+        signed_url_hours: float = 1,
+    ) -> None:
+        self.credentials_file = credentials_file
+        self.emulator_host = init.STORAGE_EMULATOR_HOST
+        self.chunk_size = chunk_size
+        self.resumable_threshold = resumable_threshold
+        self.signed_url_hours = signed_url_hours
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gcs")
+        self._client: Optional[storage.Client] = None
+        self._lock = threading.Lock()
+        self.uploads = 0
+        self.resumable_uploads = 0
+        self.uploaded_bytes = 0
+        self.upload_seconds = 0.0
+
+    @property
+    def client(self) -> storage.Client:
+        with self._lock:
+            if self._client is None:
+                if self.emulator_host:
+                    self._client = storage.Client(credentials=AnonymousCredentials(), project="local")
+                elif self.credentials_file:
+                    credentials = service_account.Credentials.from_service_account_file(self.credentials_file)
+                    self._client = storage.Client(credentials=credentials, project=credentials.project_id)
+                else:
+                    self._client = storage.Client()
+            return self._client
 
-async def upload_file_to_gcs(file_bytes: io.BytesIO, file_extension: str, destination_blob_name: str, bucket_name: str, credentials: service_account.Credentials):
-    """Uploads a file to the bucket."""
-    storage_client = storage.Client(credentials=credentials)
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "uploads": self.uploads,
+            "resumable_uploads": self.resumable_uploads,
+            "uploaded_bytes": self.uploaded_bytes,
+            "upload_seconds": self.upload_seconds,
+        }
 
-    file_bytes.seek(0)  # Ensure the BytesIO object is at the start
-    blob.upload_from_file(file_bytes, content_type=f'application/{file_extension}')
+    def upload(
+        self,
+        data: Union[bytes, BinaryIO],
+        blob_name: str,
+        bucket_name: str,
+        file_extension: str,
+        size: Optional[int] = None,
+    ) -> None:
+        """Upload bytes or a file object to the bucket, blocking. size is read from bytes, unknown sizes go up resumably."""
+        start = time.monotonic()
+        blob = self.client.bucket(bucket_name).blob(blob_name)
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            size = len(data)
+            data = io.BytesIO(data)
+        elif size is None and data.seekable():
+            position = data.tell()
+            size = data.seek(0, io.SEEK_END) - position
+            data.seek(position)
+        if size is None or size > self.resumable_threshold:
+            blob.chunk_size = self.chunk_size
+            self.resumable_uploads += 1
+        # Blob names are unique per upload, so retrying a failed request is safe
+        blob.upload_from_file(data, size=size, content_type=content_type(file_extension), retry=DEFAULT_RETRY)
+        self.uploads += 1
+        self.uploaded_bytes += size if size is not None else blob.size or 0
+        self.upload_seconds += time.monotonic() - start
+        print(f"File uploaded to {blob_name}.")
 
-    print(f"File uploaded to {destination_blob_name}.")
-    storage_client.close()
+    async def aupload(
+        self,
+        data: Union[bytes, BinaryIO],
+        blob_name: str,
+        bucket_name: str,
+        file_extension: str,
+        size: Optional[int] = None,
+    ) -> None:
+        await asyncio.get_running_loop().run_in_executor(
+            self._executor, self.upload, data, blob_name, bucket_name, file_extension, size
+        )
 
-async def generate_download_link(bucket_name: str, blob_name: str, credentials: service_account.Credentials, expiration_hours=1) -> str:
-    """Generates a signed URL for downloading a file from Google Cloud Storage."""
-    if not bucket_name:
-        raise ValueError("Bucket name must be specified.")
+    def download_link(self, bucket_name: str, blob_name: str) -> str:
+        """Get a signed URL for downloading a blob."""
+        if not bucket_name:
+            raise ValueError("Bucket name must be specified.")
+        if self.emulator_host:
+            return f"{self.emulator_host.rstrip('/')}/download/storage/v1/b/{bucket_name}/o/{quote(blob_name, safe='')}?alt=media"
+        blob = self.client.bucket(bucket_name).blob(blob_name)
+        # Signed locally with the service account key, no request is made
+        return blob.generate_signed_url(expiration=timedelta(hours=self.signed_url_hours))
 
-    storage_client = storage.Client(credentials=credentials)
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
+    async def aupload_and_link(
+        self,
+        data: Union[bytes, BinaryIO],
+        blob_name: str,
+        bucket_name: str,
+        file_extension: str,
+        size: Optional[int] = None,
+    ) -> str:
+        await self.aupload(data, blob_name, bucket_name, file_extension, size)
+        return self.download_link(bucket_name, blob_name)
 
-    # Generate a signed URL for the blob that is valid for the specified duration
-    url = blob.generate_signed_url(expiration=timedelta(hours=expiration_hours))
-    storage_client.close()    
-    return url
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
 
 
+# One service per service account file, see get_service
+services: Dict[Optional[str], GCSService] = {}
+_services_lock = threading.Lock()
 
-async def upload_and_download_file(cred_path: str, file_bytes : io.BytesIO, file_extension: str, blob_name: str, bucket_name: str) -> str:
+
+def get_service(credentials_file: Optional[str] = None) -> GCSService:
+    with _services_lock:
+        if credentials_file not in services:
+            services[credentials_file] = GCSService(
+                credentials_file,
+                max_workers=init.GCS_UPLOAD_WORKERS,
+                chunk_size=init.GCS_CHUNK_SIZE,
+                resumable_threshold=init.GCS_RESUMABLE_THRESHOLD,
+                signed_url_hours=init.GCS_SIGNED_URL_HOURS,
+            )
+        return services[credentials_file]
+
+
+async def aclose() -> None:
+    """Wait for the uploads in progress and close the clients."""
+    for service in list(services.values()):
+        await asyncio.to_thread(service.close)
+    services.clear()
+
+
+async def upload_to_local_storage(file_bytes: Union[io.BytesIO, bytes], blob_name: str, bucket_name: str) -> str:
+    """Local stub of the bucket (BACKEND=local), writes the file under LOCAL_STORAGE_DIR and returns its file link."""
+    path = Path(init.LOCAL_STORAGE_DIR) / (bucket_name or "local") / blob_name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(file_bytes, bytes):
+        path.write_bytes(file_bytes)
+    else:
+        file_bytes.seek(0)
+        path.write_bytes(file_bytes.read())
+    return path.resolve().as_uri()
+
+
+async def upload_and_download_file(cred_path: str, file_bytes : Union[io.BytesIO, bytes], file_extension: str, blob_name: str, bucket_name: str) -> str:
     """ Uploads and downloads the file from gcs bucket, returns download link
 
     cred_path (str): path to authentication json file for Google cloud service
-    file_bytes (str): files that are converted to bytes to be uploaded to GCS
+    file_bytes (Union[io.BytesIO, bytes]): files that are converted to bytes to be uploaded to GCS
     file_extension (str): the extension name of the files (e.g. .pdf, .png, .jpeg)
     blob_name (str): Name of the file to be uploaded
     bucket_name (str): name of the database to be uploaded to in google cloud
-    
+
     """
 
-    credentials = await set_google_credentials(cred_path=cred_path)
-    await upload_file_to_gcs(file_bytes=file_bytes, file_extension=file_extension, destination_blob_name=blob_name, bucket_name=bucket_name, credentials=credentials)
-    # Generate a download link
-    download_link = await generate_download_link(bucket_name=bucket_name, blob_name=blob_name, credentials=credentials, expiration_hours=1)
-    return download_link
\ No newline at end of file
+    if init.BACKEND == "local":
+        return await upload_to_local_storage(file_bytes=file_bytes, blob_name=blob_name, bucket_name=bucket_name)
+    if not isinstance(file_bytes, bytes):
+        file_bytes.seek(0)  # Ensure the BytesIO object is at the start
+    return await get_service(cred_path).aupload_and_link(
+        file_bytes, blob_name=blob_name, bucket_name=bucket_name, file_extension=file_extension
+    )
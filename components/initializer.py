@@ -1,6 +1,12 @@
 from dotenv import load_dotenv
+import fcntl
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
+from components.embeddings import AsyncEmbeddingClient
 from pymongo import MongoClient
 from motor.motor_asyncio import AsyncIOMotorClient 
 from pathlib import Path
@@ -11,27 +17,64 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # speicify environment variables path for GCP
 env_file = os.path.join(BASE_DIR, ".env")
 
-# FOR LOCAL TESTING USE GOOGLE = False
-IS_GOOGLE = True
+# "gcp" loads the settings and credentials from Google Secret Manager. "local" only
+# reads .env and replaces Cloud SQL and the GCS bucket with the local stubs below
+BACKEND = os.environ.get("BACKEND", "gcp")
+IS_GOOGLE = BACKEND == "gcp"
+# Secrets written by another worker of the host less than this many seconds ago are reused
+SECRETS_MAX_AGE = float(os.environ.get("SECRETS_MAX_AGE", 300))
+
+_secret_client = None
+_project = None
+
+
+def access_secret(secret_name: str) -> str:
+    """Get the latest version of a secret from Google Secret Manager."""
+    global _secret_client, _project
+    if _secret_client is None:
+        import google.auth
+        from google.cloud import secretmanager_v1
+
+        _, _project = google.auth.default()
+        _secret_client = secretmanager_v1.SecretManagerServiceClient()
+    name = f"projects/{_project}/secrets/{secret_name}/versions/latest"
+    return _secret_client.access_secret_version(name=name).payload.data.decode("UTF-8")
+
+
+def write_secret_files(secrets: dict) -> None:
+    """Write secrets to files, fetched in parallel and once per host.
+
+    The workers of a host start together, the first one to take the lock fetches the
+    secrets and the others find fresh files once they get it.
+
+    Args:
+        secrets (dict): Path of each file -> name of the secret it holds.
+    """
+    with open(os.path.join(BASE_DIR, ".secrets.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        stale = {
+            path: secret_name
+            for path, secret_name in secrets.items()
+            if not os.path.exists(path) or time.time() - os.path.getmtime(path) > SECRETS_MAX_AGE
+        }
+        if not stale:
+            return
+        with ThreadPoolExecutor(len(stale)) as pool:
+            payloads = list(pool.map(access_secret, stale.values()))
+        for path, payload in zip(stale, payloads):
+            # Readable by the app user only, chart workers run as another user
+            with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+                f.write(payload)
+            os.chmod(path, 0o600)
+
 
 if IS_GOOGLE:
     # FOR DEPLOYMENT
-    import google.auth
-    from google.cloud import secretmanager_v1
-    
     # to get environmental vraiables from google secret manager
     SECRET_SETTINGS_NAME = "brain-secrets"
-    _, project = google.auth.default()
-    if project:
-        client = secretmanager_v1.SecretManagerServiceClient()
-
-        SETTINGS_NAME = os.environ.get("SETTINGS_NAME", SECRET_SETTINGS_NAME)
-        name = f"projects/{project}/secrets/{SETTINGS_NAME}/versions/latest"
-        payload = client.access_secret_version(
-            name=name).payload.data.decode("UTF-8")
-        with open(env_file, "w") as f:
-            f.write(payload)
-    
+    SETTINGS_NAME = os.environ.get("SETTINGS_NAME", SECRET_SETTINGS_NAME)
+    # Every setting below comes from this secret, so it is the only one fetched at import
+    write_secret_files({env_file: SETTINGS_NAME})
     load_dotenv(env_file)
 
 else:
@@ -44,6 +87,50 @@ CHATBOT_MONGO_DATABASE = os.environ.get("CHATBOT_MONGO_DATABASE")
 CHATBOT_MONGO_COLLECTION = os.environ.get("CHATBOT_MONGO_COLLECTION")
 CHATBOT_MONGO_COLLECTION_STATUS = os.environ.get("CHATBOT_MONGO_COLLECTION_STATUS")
 MANAGER_STATUS = os.environ.get("MANAGER_STATUS")
+# "full" stores whole checkpoints, "blobs" stores one document per channel version
+CHECKPOINT_STORAGE_MODE = os.environ.get("CHECKPOINT_STORAGE_MODE", "full")
+# "find" loads a checkpoint and its pending writes in two queries, "aggregate" in one
+CHECKPOINT_FETCH_MODE = os.environ.get("CHECKPOINT_FETCH_MODE", "find")
+# Persist checkpoints from a background flusher, durability is "always", "interrupt" or "none"
+CHECKPOINT_WRITE_BEHIND = os.environ.get("CHECKPOINT_WRITE_BEHIND", "false").lower() == "true"
+CHECKPOINT_DURABILITY = os.environ.get("CHECKPOINT_DURABILITY", "interrupt")
+# "json" or "compressed" (msgpack + zstd/zlib above CHECKPOINT_COMPRESS_THRESHOLD bytes)
+CHECKPOINT_SERIALIZER = os.environ.get("CHECKPOINT_SERIALIZER", "json")
+CHECKPOINT_COMPRESS_THRESHOLD = int(os.environ.get("CHECKPOINT_COMPRESS_THRESHOLD", 4096))
+# Checkpoint history retention, keeps everything when neither limit is set
+CHECKPOINT_KEEP_LAST = int(os.environ["CHECKPOINT_KEEP_LAST"]) if os.environ.get("CHECKPOINT_KEEP_LAST") else None
+CHECKPOINT_MAX_AGE_HOURS = float(os.environ["CHECKPOINT_MAX_AGE_HOURS"]) if os.environ.get("CHECKPOINT_MAX_AGE_HOURS") else None
+CHECKPOINT_RETENTION_TTL_INDEX = os.environ.get("CHECKPOINT_RETENTION_TTL_INDEX", "false").lower() == "true"
+CHECKPOINT_COMPACTION_INTERVAL = float(os.environ.get("CHECKPOINT_COMPACTION_INTERVAL", 3600))
+# Derive the permission status from the graph checkpoint instead of the status collection
+STATUS_FROM_CHECKPOINT = os.environ.get("STATUS_FROM_CHECKPOINT", "false").lower() == "true"
+# "memory" serializes turns of a thread per worker, "mongo" across workers with leases
+THREAD_LOCK_BACKEND = os.environ.get("THREAD_LOCK_BACKEND", "memory")
+THREAD_LOCK_COLLECTION = os.environ.get("THREAD_LOCK_COLLECTION", "thread_leases")
+# In-process LRU cache in front of the checkpointer
+CHECKPOINT_CACHE_ENABLED = os.environ.get("CHECKPOINT_CACHE_ENABLED", "true").lower() == "true"
+CHECKPOINT_CACHE_MAX_ENTRIES = int(os.environ.get("CHECKPOINT_CACHE_MAX_ENTRIES", 256))
+CHECKPOINT_CACHE_MAX_BYTES = int(os.environ.get("CHECKPOINT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+CHECKPOINT_CACHE_TTL = float(os.environ.get("CHECKPOINT_CACHE_TTL", 300))
+# Semantic cache of SQL agent answers, SQL_RESULT_CACHE_TTLS overrides the TTL per database as JSON
+SQL_RESULT_CACHE_ENABLED = os.environ.get("SQL_RESULT_CACHE_ENABLED", "false").lower() == "true"
+SQL_RESULT_CACHE_THRESHOLD = float(os.environ.get("SQL_RESULT_CACHE_THRESHOLD", 0.97))
+SQL_RESULT_CACHE_TTL = float(os.environ.get("SQL_RESULT_CACHE_TTL", 3600))
+SQL_RESULT_CACHE_TTLS = json.loads(os.environ.get("SQL_RESULT_CACHE_TTLS", "{}"))
+# Worker processes running the agent's chart code, and the limits of one chart
+CHART_POOL_WORKERS = int(os.environ["CHART_POOL_WORKERS"]) if os.environ.get("CHART_POOL_WORKERS") else None
+CHART_TIMEOUT = float(os.environ.get("CHART_TIMEOUT", 30))
+CHART_CPU_SECONDS = float(os.environ.get("CHART_CPU_SECONDS", 20))
+CHART_MEMORY_LIMIT_MB = int(os.environ.get("CHART_MEMORY_LIMIT_MB", 1024))
+# User the chart workers run as, e.g. "nobody", so the chart code cannot read the secret files
+CHART_WORKER_USER = os.environ.get("CHART_WORKER_USER") or None
+# "png", "webp" or "svg", charts over CHART_MAX_BYTES are refused
+CHART_FORMAT = os.environ.get("CHART_FORMAT", "png")
+CHART_DPI = int(os.environ["CHART_DPI"]) if os.environ.get("CHART_DPI") else None
+CHART_MAX_BYTES = int(os.environ.get("CHART_MAX_BYTES", 5 * 1024 * 1024))
+# Log callbacks holding the event loop longer than this, LOOP_DEBUG also names the callback
+LOOP_LAG_THRESHOLD_MS = float(os.environ.get("LOOP_LAG_THRESHOLD_MS", 100))
+LOOP_DEBUG = os.environ.get("LOOP_DEBUG", "false").lower() == "true"
 
 mongo_client = AsyncIOMotorClient(CHATBOT_MONGO_CONNECTION_STRING, uuidRepresentation="standard")
 mongodb = mongo_client.sql_database
@@ -55,12 +142,39 @@ tnb_mongo_client = AsyncIOMotorClient(os.environ.get('TNB_MONGO_CONNECTION_STRIN
 # TNB and OCR
 OCR_API_KEY = os.getenv("OCR_API_KEY")
 OCR_API_SECRET = os.getenv("OCR_API_SECRET")
+# Gemini extractions running at once per worker, and the largest file accepted
+OCR_MAX_CONCURRENCY = int(os.getenv("OCR_MAX_CONCURRENCY", 4))
+OCR_MAX_FILE_BYTES = int(os.getenv("OCR_MAX_FILE_BYTES", 50 * 1024 * 1024))
+# Uploads above this many bytes are spooled to disk instead of memory
+OCR_SPOOL_MAX_MEMORY = int(os.getenv("OCR_SPOOL_MAX_MEMORY", 8 * 1024 * 1024))
+# Jobs of /ocr_jobs and how long their results are kept
+OCR_JOBS_COLLECTION = os.getenv("OCR_JOBS_COLLECTION", "ocr_jobs")
+OCR_JOB_TTL_HOURS = float(os.getenv("OCR_JOB_TTL_HOURS", 24))
+# Jobs queued or running at once per worker, each holds its upload until it finishes
+OCR_MAX_JOBS = int(os.getenv("OCR_MAX_JOBS", 32))
+# Comma-separated hosts job callbacks may go to, ".example.com" allows its subdomains, any public host when empty
+OCR_CALLBACK_ALLOWED_HOSTS = [host.strip() for host in os.getenv("OCR_CALLBACK_ALLOWED_HOSTS", "").split(",") if host.strip()]
+# Extractions cached by file content and request, bump OCR_CACHE_VERSION when the OCR prompt or model changes
+OCR_CACHE_ENABLED = os.getenv("OCR_CACHE_ENABLED", "true").lower() == "true"
+OCR_CACHE_TTL_HOURS = float(os.getenv("OCR_CACHE_TTL_HOURS", 720))
+OCR_CACHE_MAX_ENTRIES = int(os.getenv("OCR_CACHE_MAX_ENTRIES", 1024))
+OCR_CACHE_VERSION = os.getenv("OCR_CACHE_VERSION", "1")
+# Hit counts are written to the entries at most this often
+OCR_CACHE_HITS_FLUSH_SECONDS = float(os.getenv("OCR_CACHE_HITS_FLUSH_SECONDS", 30))
 
 # Initialize OpenAI
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 DEFAULT_EMBEDDINGS_MODEL = "text-embedding-ada-002"
 DEFAULT_CHAT_MODEL = "gpt-4o-mini"
 openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# Used by the async paths, the sync client above blocks the event loop
+embedding_client = AsyncEmbeddingClient(
+    OPENAI_API_KEY,
+    DEFAULT_EMBEDDINGS_MODEL,
+    max_concurrency=int(os.environ.get("EMBEDDING_MAX_CONCURRENCY", 8)),
+)
+# On-disk cache of query embeddings shared by the workers, memory only when unset
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR")
 
 # Initialize Langchain
 LANGCHAIN_API_KEY = os.environ.get("LANGCHAIN_API_KEY")
@@ -71,23 +185,26 @@ TAVILY_API_KEY = os.environ.get("TAVILY_API_KEY")
 # Initialize telegram API Key
 TELEGRAM_API_KEY = os.environ.get("TELEGRAM_API_KEY")
 TELEGRAM_BOT_USERNAME = os.environ.get("TELEGRAM_BOT_USERNAME")
+# Attachments over this size are refused, the Bot API does not serve files above 20MB
+TELEGRAM_MAX_FILE_BYTES = int(os.environ.get("TELEGRAM_MAX_FILE_BYTES", 20 * 1024 * 1024))
+# Seconds to wait for the other messages of an album before answering them together
+TELEGRAM_MEDIA_GROUP_WAIT = float(os.environ.get("TELEGRAM_MEDIA_GROUP_WAIT", 1.0))
+# Updates handled at once, the updates of one chat are always handled in order
+TELEGRAM_CONCURRENT_UPDATES = int(os.environ.get("TELEGRAM_CONCURRENT_UPDATES", 64))
+# Public URL of the webhook route, the FastAPI app then also serves the bot. Unset to poll with telegram_bot()
+TELEGRAM_WEBHOOK_URL = os.environ.get("TELEGRAM_WEBHOOK_URL")
+# Sent by Telegram with every update, requests without it are rejected. Required in webhook
+# mode, as is THREAD_LOCK_BACKEND=mongo since every API worker receives updates
+TELEGRAM_WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET")
+# Webhook updates not handled yet, the updates of a chat are handled in update_id order across workers
+TELEGRAM_UPDATES_COLLECTION = os.environ.get("TELEGRAM_UPDATES_COLLECTION", "telegram_updates")
+# Poll for updates from the FastAPI process (set by `python main.py all`), only one process may poll
+TELEGRAM_POLLING = os.environ.get("TELEGRAM_POLLING", "false").lower() == "true"
+# Another Bot API server, e.g. a local one or the fake one of the benchmarks
+TELEGRAM_BASE_URL = os.environ.get("TELEGRAM_BASE_URL")
 
 ## SURIA PROJECT
 # GOOGLE_APPLICATION_CREDENTIALS_1 = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_1")
-# CREDENTIALS to get from directory suria_db_creds.json
-if IS_GOOGLE:
-    # FOR DEPLOYMENT
-    suria_db_creds_file = os.path.join(BASE_DIR, "suria_db_creds.json")
-    SURIA_DB_CREDS_SECRET_NAME = "suria-db-secret"
-    SURIA_DB_CREDS_NAME = os.environ.get("SURIA_DB_CREDS_NAME", SURIA_DB_CREDS_SECRET_NAME)
-    suria_db_creds_name = f"projects/{project}/secrets/{SURIA_DB_CREDS_NAME}/versions/latest"
-    suria_db_creds_payload = client.access_secret_version(
-        name=suria_db_creds_name).payload.data.decode("UTF-8")
-    
-    with open(suria_db_creds_file, "w") as f:
-        f.write(suria_db_creds_payload)
-
-SURIA_DB_SERVICE_ACCOUNT_FILE = 'suria_db_creds.json'
 # SURIA_DB_SERVICE_ACCOUNT_FILE='authentication/suria-db-access.json'
 
 # Database instance connection details
@@ -96,42 +213,69 @@ DB_NAME_1=os.getenv("DB_NAME_1")
 IAM_USER_1=os.getenv("IAM_USER_1")
 # GCS bucket (test-suria)
 GCS_BUCKET_NAME=os.getenv("GCS_BUCKET_NAME")
+# Uploads above GCS_RESUMABLE_THRESHOLD go up resumably in chunks of GCS_CHUNK_SIZE (a multiple of 256KB)
+GCS_UPLOAD_WORKERS = int(os.getenv("GCS_UPLOAD_WORKERS", 8))
+GCS_CHUNK_SIZE = int(os.getenv("GCS_CHUNK_SIZE", 8 * 1024 * 1024))
+GCS_RESUMABLE_THRESHOLD = int(os.getenv("GCS_RESUMABLE_THRESHOLD", 8 * 1024 * 1024))
+GCS_SIGNED_URL_HOURS = float(os.getenv("GCS_SIGNED_URL_HOURS", 1))
+# Points the client at a local fake GCS server (e.g. fake-gcs-server) when set
+STORAGE_EMULATOR_HOST = os.getenv("STORAGE_EMULATOR_HOST")
 
 
 ## SIP-CDE PROJECT
 # GOOGLE_APPLICATION_CREDENTIALS_2 = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_2")
-# CREDENTIALS to get from directory sip_cde_db_creds.json 
-if IS_GOOGLE:
-    # FOR DEPLOYMENT
-    cde_db_creds_file = os.path.join(BASE_DIR, "sip_cde_db_creds.json")
-    CDE_DB_CREDS_SECRET_NAME = "sip-cde-db-secret"
-    CDE_DB_CREDS_NAME = os.environ.get("CDE_DB_CREDS_SECRET_NAME", CDE_DB_CREDS_SECRET_NAME)
-    cde_db_creds_name = f"projects/{project}/secrets/{CDE_DB_CREDS_NAME}/versions/latest"
-    cde_db_creds_payload = client.access_secret_version(
-        name=cde_db_creds_name).payload.data.decode("UTF-8")
-    
-    with open(cde_db_creds_file, "w") as f:
-        f.write(cde_db_creds_payload)
-
-SIP_CDE_DB_SERVICE_ACCOUNT_FILE = 'sip_cde_db_creds.json'
 # SIP_CDE_DB_SERVICE_ACCOUNT_FILE='authentication/sip-cde-db-access.json'
 
 # Database instance connection details
 INSTANCE_CONNECTION_NAME_2 = os.getenv("INSTANCE_CONNECTION_NAME_2")
 DB_NAME_2=os.getenv("DB_NAME_2")
 IAM_USER_2=os.getenv("IAM_USER_2")
+# Connection pool of each SQL database, the connections are opened on demand
+SQL_POOL_SIZE = int(os.getenv("SQL_POOL_SIZE", 5))
+SQL_POOL_MAX_OVERFLOW = int(os.getenv("SQL_POOL_MAX_OVERFLOW", 5))
+SQL_POOL_TIMEOUT = float(os.getenv("SQL_POOL_TIMEOUT", 30))
+SQL_POOL_RECYCLE = int(os.getenv("SQL_POOL_RECYCLE", 1800))
+# Schema snapshots of the SQL databases: rebuilt after the TTL, checked for DDL changes every interval
+SQL_SCHEMA_TTL = float(os.getenv("SQL_SCHEMA_TTL", 3600))
+SQL_SCHEMA_CHECK_INTERVAL = float(os.getenv("SQL_SCHEMA_CHECK_INTERVAL", 300))
 
 
-# GOOGLE GEMINI CREDENTIALS 
-# CREDENTIALS to get from directory gemini_creds.json
-if IS_GOOGLE:
-    # FOR DEPLOYMENT
-    gemini_creds_file = os.path.join(BASE_DIR, "gemini_creds.json")
-    GEMINI_CREDS_SECRET_NAME = "gemini-ocr-secret"
-    gemini_creds_name = f"projects/{project}/secrets/{GEMINI_CREDS_SECRET_NAME}/versions/latest"
-    gemini_creds_payload = client.access_secret_version(
-        name=gemini_creds_name).payload.data.decode("UTF-8")
-    
-    with open(gemini_creds_file, "w") as f:
-        f.write(gemini_creds_payload)
-GEMINI_SERVICE_ACCOUNT_FILE = 'gemini_creds.json'
\ No newline at end of file
+# LOCAL STUBS (BACKEND=local)
+# SQLAlchemy URLs used instead of Cloud SQL, and a directory used instead of the GCS bucket
+SURIA_DB_URL = os.getenv("SURIA_DB_URL", f"sqlite:///{BASE_DIR / 'local' / 'suria.db'}")
+SIP_CDE_DB_URL = os.getenv("SIP_CDE_DB_URL", f"sqlite:///{BASE_DIR / 'local' / 'sip_cde.db'}")
+LOCAL_STORAGE_DIR = os.getenv("LOCAL_STORAGE_DIR", str(BASE_DIR / "local" / "storage"))
+
+
+# SERVICE ACCOUNT CREDENTIALS
+# Written from Secret Manager the first time one of them is used, see __getattr__
+CREDENTIAL_FILES = {
+    # for suria
+    "SURIA_DB_SERVICE_ACCOUNT_FILE": ("suria_db_creds.json", os.environ.get("SURIA_DB_CREDS_NAME", "suria-db-secret")),
+    # for sip-cde
+    "SIP_CDE_DB_SERVICE_ACCOUNT_FILE": ("sip_cde_db_creds.json", os.environ.get("CDE_DB_CREDS_SECRET_NAME", "sip-cde-db-secret")),
+    # GOOGLE GEMINI CREDENTIALS
+    "GEMINI_SERVICE_ACCOUNT_FILE": ("gemini_creds.json", "gemini-ocr-secret"),
+}
+_credentials_lock = threading.Lock()
+_credentials_ready = False
+
+
+def fetch_credentials() -> None:
+    """Write every service account file, in parallel, the first time one is needed."""
+    global _credentials_ready
+    with _credentials_lock:
+        if _credentials_ready:
+            return
+        if IS_GOOGLE:
+            write_secret_files(
+                {os.path.join(BASE_DIR, file_name): secret_name for file_name, secret_name in CREDENTIAL_FILES.values()}
+            )
+        _credentials_ready = True
+
+
+def __getattr__(name):
+    if name in CREDENTIAL_FILES:
+        fetch_credentials()
+        return CREDENTIAL_FILES[name][0]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,72 @@
+# detects blocking calls on the event loop
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a sleeping task.
+
+    Every interval seconds a task sleeps and compares when it woke up with when it should
+    have. Anything above threshold_ms means some callback held the loop, e.g. a sync
+    network call in an async path, and is logged. With debug enabled asyncio also logs the
+    offending callback itself, at the cost of slower callbacks, so it is meant for staging.
+
+    Args:
+        threshold_ms (float): Lag in milliseconds above which a block is reported. Defaults to 100.
+        interval (float): Seconds between two measurements. Defaults to 0.25.
+        debug (bool): Enable asyncio debug mode to log the slow callbacks. Defaults to False.
+    """
+
+    def __init__(self, threshold_ms: float = 100, interval: float = 0.25, debug: bool = False) -> None:
+        self.threshold_ms = threshold_ms
+        self.interval = interval
+        self.debug = debug
+        self._task: Optional[asyncio.Task] = None
+        self.samples = 0
+        self.blocked = 0
+        self.max_lag_ms = 0.0
+        self.last_blocked_at: Optional[float] = None
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        if self.debug:
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.threshold_ms / 1000
+        self._task = loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "samples": self.samples,
+            "blocked": self.blocked,
+            "max_lag_ms": self.max_lag_ms,
+            "last_blocked_at": self.last_blocked_at,
+        }
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag_ms = (loop.time() - start - self.interval) * 1000
+            self.samples += 1
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+            if lag_ms > self.threshold_ms:
+                self.blocked += 1
+                self.last_blocked_at = time.time()
+                logger.warning("Event loop blocked for %.0f ms", lag_ms)
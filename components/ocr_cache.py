@@ -0,0 +1,158 @@
+# cache of OCR extractions keyed by file content and request
+import asyncio
+import hashlib
+import logging
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import UpdateOne
+
+from components.lru_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_request(list_to_extract: Optional[str], user_prompt: Optional[str]) -> str:
+    """The part of the cache key that comes from the request.
+
+    The user prompt wins over the list of fields, as in tools.ocr.generate, so the list is
+    ignored when there is a prompt. Fields are stripped, deduplicated and sorted, and
+    whitespace is collapsed, so "Total, Date" and "Date ,Total" share an entry. Case is
+    kept, the field names end up in the response.
+    """
+    if user_prompt and user_prompt.strip():
+        return "prompt:" + " ".join(user_prompt.split())
+    fields = {" ".join(field.split()) for field in (list_to_extract or "").split(",")}
+    return "fields:" + ",".join(sorted(field for field in fields if field))
+
+
+class OCRResultCache:
+    """Successful OCR extractions, looked up by the SHA-256 of the file and the normalized request.
+
+    Entries live in MongoDB, shared by every worker and expiring after ttl_hours, with an
+    in-memory LRU of the most recent ones in front, kept for an hour at most so entries
+    invalidated by another worker stop being served. version is part of the key, bump it
+    when the extraction prompt or model changes to stop serving older results.
+
+    Hits are counted in memory and added to the entries in one bulk write at most every
+    hits_flush_seconds, in the background, so a hit served from memory makes no request.
+
+    Args:
+        collection (AsyncIOMotorCollection): The collection holding the entries.
+        max_entries (int): The maximum number of entries kept in memory. Defaults to 1024.
+        ttl_hours (float): Hours an extraction is served for. Defaults to 720 (30 days).
+        version (str): Part of every key. Defaults to "1".
+        hits_flush_seconds (float): Seconds between writes of the hit counts. Defaults to 30.
+    """
+
+    def __init__(
+        self,
+        collection: AsyncIOMotorCollection,
+        max_entries: int = 1024,
+        ttl_hours: float = 720,
+        version: str = "1",
+        hits_flush_seconds: float = 30,
+    ) -> None:
+        self.collection = collection
+        self.memory = LRUCache(max_entries, ttl=min(ttl_hours * 3600, 3600))
+        self.ttl = timedelta(hours=ttl_hours)
+        self.version = version
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.hits_flush_seconds = hits_flush_seconds
+        self._pending_hits: Counter = Counter()
+        self._hits_flushed_at = time.monotonic()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def asetup(self) -> None:
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def key(self, file_sha256: str, list_to_extract: Optional[str], user_prompt: Optional[str]) -> str:
+        request = normalize_request(list_to_extract, user_prompt)
+        return hashlib.sha256(f"{self.version}\n{file_sha256}\n{request}".encode("utf-8")).hexdigest()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "memory_hits": self.memory_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory": self.memory.stats(),
+        }
+
+    async def astats(self) -> Dict[str, Any]:
+        """Stats of this worker, plus the entries and hits of every worker."""
+        await self.aflush_hits()
+        pipeline = [{"$group": {"_id": None, "entries": {"$sum": 1}, "hits": {"$sum": "$hits"}}}]
+        totals = await self.collection.aggregate(pipeline).to_list(length=1)
+        total = totals[0] if totals else {"entries": 0, "hits": 0}
+        return {"worker": self.stats(), "entries": total["entries"], "hits": total["hits"]}
+
+    async def aget(self, key: str) -> Optional[Dict[str, Any]]:
+        result = self.memory.get(key, count=False)
+        if result is not None:
+            self.memory_hits += 1
+        else:
+            doc = await self.collection.find_one({"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}})
+            result = doc["result"] if doc else None
+            if result is not None:
+                self.memory.set(key, result)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._pending_hits[key] += 1
+        if time.monotonic() - self._hits_flushed_at >= self.hits_flush_seconds and (
+            self._flush_task is None or self._flush_task.done()
+        ):
+            self._flush_task = asyncio.ensure_future(self.aflush_hits())
+        return result
+
+    async def aflush_hits(self) -> None:
+        """Add the hits counted since the last flush to the entries."""
+        pending, self._pending_hits = self._pending_hits, Counter()
+        self._hits_flushed_at = time.monotonic()
+        if not pending:
+            return
+        try:
+            await self.collection.bulk_write(
+                [UpdateOne({"_id": key}, {"$inc": {"hits": count}}) for key, count in pending.items()],
+                ordered=False,
+            )
+        except Exception as e:
+            # Kept for the next flush, the counts are only stats
+            self._pending_hits.update(pending)
+            logger.warning("Could not write the OCR cache hits: %s", e)
+
+    async def aclose(self) -> None:
+        """Write the hits not flushed yet."""
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.aflush_hits()
+
+    async def aset(self, key: str, file_sha256: str, result: Dict[str, Any]) -> None:
+        """Store a successful extraction, replacing any older one of the same key."""
+        now = datetime.now(timezone.utc)
+        self.memory.set(key, result)
+        await self.collection.update_one(
+            {"_id": key},
+            {
+                "$set": {"file_sha256": file_sha256, "result": result, "created_at": now, "expires_at": now + self.ttl},
+                "$setOnInsert": {"hits": 0},
+            },
+            upsert=True,
+        )
+
+    async def ainvalidate(self, file_sha256: Optional[str] = None) -> int:
+        """Delete the extractions of a file, or all of them. Returns the number deleted."""
+        res = await self.collection.delete_many({} if file_sha256 is None else {"file_sha256": file_sha256})
+        # Other workers keep their in-memory entries until these expire or are evicted
+        self.memory.clear()
+        return res.deleted_count
@@ -0,0 +1,418 @@
+# bounded OCR pipeline: spooled uploads, Gemini calls off the event loop, job queue
+import asyncio
+import base64
+import hashlib
+import io
+import ipaddress
+import logging
+import socket
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+from fastapi import UploadFile
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+import tools.ocr as ocr_tools
+from components.ocr_cache import OCRResultCache
+
+logger = logging.getLogger(__name__)
+
+# Extensions accepted by the OCR service
+OCR_EXTENSIONS = [".pdf", ".jpeg", ".jpg", ".png"]
+
+
+class OCRFileError(Exception):
+    """The upload is too large or cannot be read, the message is meant for the caller."""
+
+
+class OCRCallbackError(Exception):
+    """The callback URL of a job is refused, the message is meant for the caller."""
+
+
+class OCRQueueFull(Exception):
+    """Too many jobs are queued or running on this worker, the message is meant for the caller."""
+
+
+class OCRPipeline:
+    """Runs OCR extractions with Gemini without blocking the event loop, a bounded number at a time.
+
+    Uploads are copied in chunks into a spooled temporary file, in memory up to
+    spool_max_memory and on disk beyond, and refused above max_bytes. At most
+    max_concurrency extractions run at once; each one validates the file, base64-encodes it
+    and calls Gemini on a thread pool of its own, so the file is only held in memory while
+    its extraction runs. Extractions waiting for a slot hold their spooled file only.
+
+    Jobs are extractions run in the background: asubmit() returns a job id straight away,
+    the job document in the jobs collection holds the status and result for any worker to
+    answer a poll, and the result is also POSTed to the job's callback URL when it has one.
+    At most max_jobs jobs are queued or running per worker, each holding its spooled file,
+    further submissions are refused with OCRQueueFull. Callback URLs must be https, must be
+    on one of callback_allowed_hosts when it is set, and their host must only resolve to
+    public addresses, checked at submission and again before every POST. Until a job
+    finishes its document is touched every job_timeout / 3 seconds, so only jobs whose
+    worker went away time out, queued or running.
+
+    With a cache, an upload whose content and request were already extracted gets the
+    earlier result without a Gemini call; the SHA-256 of the file is computed while it is
+    spooled.
+
+    Args:
+        jobs (AsyncIOMotorCollection): The collection of the jobs.
+        max_concurrency (int): The maximum number of extractions running at once. Defaults to 4.
+        max_bytes (int): The largest file accepted. Defaults to 50MB.
+        spool_max_memory (int): Bytes of an upload kept in memory before it spools to disk. Defaults to 8MB.
+        read_chunk_size (int): Bytes per read of an upload. Defaults to 1MB.
+        job_ttl_hours (float): Hours a job and its result are kept. Defaults to 24.
+        job_timeout (float): Seconds after which a running job whose worker went away is reported failed. Defaults to 600.
+        cache (Optional[OCRResultCache]): Cache of the successful extractions. Defaults to None.
+        callback_allowed_hosts (Optional[Sequence[str]]): Hosts callbacks may go to, a leading "." allows subdomains. Defaults to any public host.
+        max_jobs (int): The maximum number of jobs queued or running at once. Defaults to 32.
+    """
+
+    def __init__(
+        self,
+        jobs: AsyncIOMotorCollection,
+        max_concurrency: int = 4,
+        max_bytes: int = 50 * 1024 * 1024,
+        spool_max_memory: int = 8 * 1024 * 1024,
+        read_chunk_size: int = 1024 * 1024,
+        job_ttl_hours: float = 24,
+        job_timeout: float = 600,
+        cache: Optional[OCRResultCache] = None,
+        callback_allowed_hosts: Optional[Sequence[str]] = None,
+        max_jobs: int = 32,
+    ) -> None:
+        self.jobs = jobs
+        self.cache = cache
+        self.callback_allowed_hosts = [host.lower() for host in callback_allowed_hosts or []]
+        self.max_jobs = max_jobs
+        self.max_concurrency = max_concurrency
+        self.max_bytes = max_bytes
+        self.spool_max_memory = spool_max_memory
+        self.read_chunk_size = read_chunk_size
+        self.job_ttl = timedelta(hours=job_ttl_hours)
+        self.job_timeout = job_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="ocr")
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._tasks = set()
+        self._submitting = 0
+        self._client: Optional[httpx.AsyncClient] = None
+        self.running = 0
+        self.waiting = 0
+        self.extractions = 0
+        self.failures = 0
+        self.total_seconds = 0.0
+
+    async def asetup(self) -> None:
+        await self.jobs.create_index("expires_at", expireAfterSeconds=0)
+        if self.cache is not None:
+            await self.cache.asetup()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "extractions": self.extractions,
+            "failures": self.failures,
+            "avg_seconds": self.total_seconds / self.extractions if self.extractions else 0.0,
+            "background_jobs": len(self._tasks),
+            "max_jobs": self.max_jobs,
+        }
+
+    def check_capacity(self) -> None:
+        """Raise OCRQueueFull when no more jobs can be submitted to this worker."""
+        if len(self._tasks) + self._submitting >= self.max_jobs:
+            raise OCRQueueFull("Too many OCR jobs are in progress, please try again later.")
+
+    async def acheck_callback_url(self, url: str) -> None:
+        """Raise OCRCallbackError unless results may be POSTed to url, resolving its host."""
+        parts = urlsplit(url)
+        host = (parts.hostname or "").lower()
+        if parts.scheme != "https" or not host:
+            raise OCRCallbackError("The callback_url must be an https URL.")
+        if self.callback_allowed_hosts and not any(
+            host == allowed or (allowed.startswith(".") and host.endswith(allowed))
+            for allowed in self.callback_allowed_hosts
+        ):
+            raise OCRCallbackError(f"Callbacks to {host} are not allowed.")
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, parts.port or 443, type=socket.SOCK_STREAM)
+        except (OSError, UnicodeError):
+            raise OCRCallbackError(f"The host {host} of the callback_url cannot be resolved.")
+        # Every address must be public, the client may connect to any of them
+        if not infos or any(not ipaddress.ip_address(info[4][0].split("%")[0]).is_global for info in infos):
+            raise OCRCallbackError("The callback_url must not point at a private address.")
+
+    async def aspool(self, file: UploadFile) -> Tuple[tempfile.SpooledTemporaryFile, str]:
+        """Copy an upload into a spooled temporary file, chunk by chunk. Returns it, for the caller to close, and its SHA-256."""
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_max_memory)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            while chunk := await file.read(self.read_chunk_size):
+                digest.update(chunk)
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise OCRFileError(f"The file is over the limit of {self.max_bytes // 2**20}MB.")
+                if size > self.spool_max_memory:
+                    # Spooled to disk from here on, writing blocks
+                    await asyncio.to_thread(spool.write, chunk)
+                else:
+                    spool.write(chunk)
+        except BaseException:
+            spool.close()
+            raise
+        return spool, digest.hexdigest()
+
+    def _prepare(self, spool: tempfile.SpooledTemporaryFile, file_extension: str) -> str:
+        spool.seek(0)
+        file_bytes = io.BytesIO(spool.read())
+        try:
+            valid = ocr_tools.validate_file(file_bytes, file_extension)
+        except Exception:
+            raise OCRFileError("Please attach a PDF first before accessing our OCR service.")
+        if not valid:
+            raise OCRFileError("File failed to be accessed. Please upload a different file.")
+        return base64.b64encode(file_bytes.getvalue()).decode("utf-8")
+
+    def _extract(
+        self,
+        spool: tempfile.SpooledTemporaryFile,
+        file_extension: str,
+        list_to_extract: Optional[str],
+        user_prompt: Optional[str],
+    ) -> Dict[str, Any]:
+        file_base64 = self._prepare(spool, file_extension)
+        return ocr_tools.generate(file_base64, file_extension.replace(".", ""), list_to_extract, user_prompt)
+
+    @asynccontextmanager
+    async def _aslot(self) -> AsyncIterator[None]:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self._semaphore.release()
+
+    async def _arun_extract(
+        self,
+        spool: tempfile.SpooledTemporaryFile,
+        file_extension: str,
+        list_to_extract: Optional[str],
+        user_prompt: Optional[str],
+    ) -> Dict[str, Any]:
+        start = time.monotonic()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._extract, spool, file_extension, list_to_extract, user_prompt
+            )
+        except BaseException:
+            self.failures += 1
+            raise
+        finally:
+            self.extractions += 1
+            self.total_seconds += time.monotonic() - start
+        if result.get("status") != 200:
+            self.failures += 1
+        return result
+
+    async def aextract(
+        self,
+        spool: tempfile.SpooledTemporaryFile,
+        file_extension: str,
+        list_to_extract: Optional[str] = None,
+        user_prompt: Optional[str] = None,
+        file_sha256: Optional[str] = None,
+        bypass_cache: bool = False,
+        on_start: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> Dict[str, Any]:
+        """Extract the fields or answer the prompt from a spooled file, once a slot is free.
+
+        Args:
+            file_sha256 (Optional[str]): The SHA-256 of the file, needed to use the cache.
+            bypass_cache (bool): Extract again even when cached, and cache the new result. Defaults to False.
+            on_start (Optional[Callable[[], Awaitable[None]]]): Awaited when the extraction gets its slot.
+
+        Returns:
+            Dict[str, Any]: The result of ocr_tools.generate, "status" with "response" or "message", and "cached".
+
+        Raises:
+            OCRFileError: When the file cannot be read.
+        """
+        key = None
+        if self.cache is not None and file_sha256:
+            key = self.cache.key(file_sha256, list_to_extract, user_prompt)
+            if bypass_cache:
+                self.cache.bypassed += 1
+            else:
+                result = await self.cache.aget(key)
+                if result is not None:
+                    return {**result, "cached": True}
+        async with self._aslot():
+            if on_start is not None:
+                await on_start()
+            result = await self._arun_extract(spool, file_extension, list_to_extract, user_prompt)
+        if key is not None and result.get("status") == 200:
+            await self.cache.aset(key, file_sha256, result)
+        return {**result, "cached": False}
+
+    async def asubmit(
+        self,
+        spool: tempfile.SpooledTemporaryFile,
+        file_extension: str,
+        list_to_extract: Optional[str] = None,
+        user_prompt: Optional[str] = None,
+        callback_url: Optional[str] = None,
+        filename: Optional[str] = None,
+        file_sha256: Optional[str] = None,
+        bypass_cache: bool = False,
+    ) -> str:
+        """Queue an extraction and return its job id. Once submitted, the job owns the spooled file.
+
+        Raises:
+            OCRQueueFull: When max_jobs jobs are already queued or running.
+            OCRCallbackError: When the callback URL is refused.
+        """
+        self.check_capacity()
+        if callback_url:
+            await self.acheck_callback_url(callback_url)
+            self.check_capacity()
+        now = datetime.now(timezone.utc)
+        job_id = uuid.uuid4().hex
+        # Holds a place until the task exists, so concurrent submissions cannot overshoot max_jobs
+        self._submitting += 1
+        try:
+            await self._ainsert_job(job_id, now, filename, file_sha256, list_to_extract, user_prompt, callback_url)
+        finally:
+            self._submitting -= 1
+        task = asyncio.get_running_loop().create_task(
+            self._arun_job(job_id, spool, file_extension, list_to_extract, user_prompt, callback_url, file_sha256, bypass_cache)
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job_id
+
+    async def _ainsert_job(
+        self,
+        job_id: str,
+        now: datetime,
+        filename: Optional[str],
+        file_sha256: Optional[str],
+        list_to_extract: Optional[str],
+        user_prompt: Optional[str],
+        callback_url: Optional[str],
+    ) -> None:
+        await self.jobs.insert_one({
+            "_id": job_id,
+            "status": "queued",
+            "filename": filename,
+            "file_sha256": file_sha256,
+            "list_to_extract": list_to_extract,
+            "user_prompt": user_prompt,
+            "callback_url": callback_url,
+            "created_at": now,
+            "updated_at": now,
+            "expires_at": now + self.job_ttl,
+        })
+
+    async def _arun_job(
+        self,
+        job_id: str,
+        spool: tempfile.SpooledTemporaryFile,
+        file_extension: str,
+        list_to_extract: Optional[str],
+        user_prompt: Optional[str],
+        callback_url: Optional[str],
+        file_sha256: Optional[str],
+        bypass_cache: bool,
+    ) -> None:
+        # Queued and running alike, so aget_job only reports jobs of a worker that went away
+        heartbeat = asyncio.get_running_loop().create_task(self._aheartbeat(job_id))
+        try:
+            try:
+                result = await self.aextract(
+                    spool, file_extension, list_to_extract, user_prompt, file_sha256, bypass_cache,
+                    on_start=lambda: self._aupdate_job(job_id, status="running"),
+                )
+            except OCRFileError as e:
+                result = {"status": 400, "message": str(e)}
+            except Exception as e:
+                logger.exception("OCR job %s failed", job_id)
+                result = {"status": 500, "message": repr(e)}
+            finally:
+                heartbeat.cancel()
+            status = "done" if result.get("status") == 200 else "failed"
+            await self._aupdate_job(job_id, status=status, result=result)
+            if callback_url:
+                await self._acallback(callback_url, {"job_id": job_id, "status": status, "result": result})
+        finally:
+            spool.close()
+
+    async def _aheartbeat(self, job_id: str) -> None:
+        # Keeps updated_at recent until the job finishes, so aget_job does not report it lost
+        while True:
+            await asyncio.sleep(self.job_timeout / 3)
+            try:
+                await self._aupdate_job(job_id)
+            except Exception as e:
+                logger.warning("Heartbeat of OCR job %s failed: %r", job_id, e)
+
+    async def _aupdate_job(self, job_id: str, **fields: Any) -> None:
+        fields["updated_at"] = datetime.now(timezone.utc)
+        await self.jobs.update_one({"_id": job_id}, {"$set": fields})
+
+    async def _acallback(self, url: str, payload: Dict[str, Any]) -> None:
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=30)
+        for attempt in range(3):
+            try:
+                # Checked again, the host may resolve elsewhere than at submission
+                await self.acheck_callback_url(url)
+            except OCRCallbackError as e:
+                logger.warning("OCR callback to %s refused: %s", url, e)
+                return
+            try:
+                response = await self._client.post(url, json=payload)
+                response.raise_for_status()
+                return
+            except httpx.HTTPError as e:
+                logger.warning("OCR callback to %s failed (attempt %d): %r", url, attempt + 1, e)
+                await asyncio.sleep(2 ** attempt)
+
+    async def aget_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """The status of a job, with its result once it finished. None for an unknown or expired job."""
+        job = await self.jobs.find_one({"_id": job_id}, {"expires_at": 0})
+        if job is None:
+            return None
+        updated_at = job["updated_at"].replace(tzinfo=timezone.utc)
+        if job["status"] in ("queued", "running") and datetime.now(timezone.utc) - updated_at > timedelta(seconds=self.job_timeout):
+            # The worker running it went away, the job is lost
+            job["status"] = "failed"
+            job["result"] = {"status": 500, "message": "The job did not finish, please submit it again."}
+        job["job_id"] = job.pop("_id")
+        return job
+
+    async def aclose(self) -> None:
+        """Let the background jobs finish, then release the threads and the callback client and write the cache hits."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=False)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self.cache is not None:
+            await self.cache.aclose()
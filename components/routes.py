@@ -1,19 +1,31 @@
 import re
-import pandas as pd
+import asyncio
+import time
 import uvicorn
 import base64
-import io
+import hmac
 import os
 from functools import wraps
-from fastapi import FastAPI, HTTPException, Response, Request, UploadFile, File, Query, Depends, Form
+from fastapi import FastAPI, HTTPException, Response, Request, UploadFile, File, Query, Depends, Form, Header
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi_users.exceptions import UserInactive, InvalidVerifyToken
 
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from components import initializer as init
 import tools.ocr as ocr_tools
+from tools.registry import lazy_import
+# Imported on first use, they pull in the SQL agent, matplotlib and the Cloud SQL connector
+db_tools = lazy_import("tools.database")
+db = lazy_import("components.db")
 import components.initializer as init
-from components.conversation_handler import handle_single_agent_all
+from components.conversation_handler import handle_single_agent_all, stream_single_agent_all, thread_locks
+from sse_starlette.sse import EventSourceResponse
+from agents.single_agent import checkpointer, get_single_agent_graph
+from components.loop_monitor import LoopLagMonitor
+from components.ocr_cache import OCRResultCache
+from components.ocr_pipeline import OCR_EXTENSIONS, OCRCallbackError, OCRFileError, OCRPipeline, OCRQueueFull
+import components.gcs_bucket as gcs
 
 # Initialize FastAPI 
 from beanie import init_beanie
@@ -23,16 +35,132 @@ from users.db import User
 from users.schemas import UserCreate, UserRead, UserUpdate
 from users.users import auth_backend, current_active_user, fastapi_users
 
+loop_monitor = LoopLagMonitor(threshold_ms=init.LOOP_LAG_THRESHOLD_MS, debug=init.LOOP_DEBUG)
+ocr_pipeline = OCRPipeline(
+    init.mongodb.get_collection(init.OCR_JOBS_COLLECTION),
+    max_concurrency=init.OCR_MAX_CONCURRENCY,
+    max_bytes=init.OCR_MAX_FILE_BYTES,
+    spool_max_memory=init.OCR_SPOOL_MAX_MEMORY,
+    job_ttl_hours=init.OCR_JOB_TTL_HOURS,
+    callback_allowed_hosts=init.OCR_CALLBACK_ALLOWED_HOSTS,
+    max_jobs=init.OCR_MAX_JOBS,
+    cache=OCRResultCache(
+        init.mongodb.get_collection("ocr_result_cache"),
+        max_entries=init.OCR_CACHE_MAX_ENTRIES,
+        ttl_hours=init.OCR_CACHE_TTL_HOURS,
+        version=init.OCR_CACHE_VERSION,
+        hits_flush_seconds=init.OCR_CACHE_HITS_FLUSH_SECONDS,
+    ) if init.OCR_CACHE_ENABLED else None,
+)
+# Set by the lifespan, /ready reports on it
+warm_up_task = None
+# The Telegram bot in webhook mode (TELEGRAM_WEBHOOK_URL), started by the lifespan
+telegram_app = None
+# Orders the webhook updates of each chat across workers, set with the bot in webhook mode
+telegram_updates = None
+started_at = time.monotonic()
+
+
+async def warm_up():
+    """Fetch the credentials, connect to the SQL databases and create the MongoDB indexes, concurrently."""
+    start = time.monotonic()
+    await asyncio.to_thread(init.fetch_credentials)
+    setups = [
+        db.awarm_up(),
+        # Create the checkpoint indexes, warns if a checkpoint query still scans the collection
+        checkpointer.asetup(),
+        db_tools.result_cache.asetup(),
+        db_tools.chart_pool.astart(),
+        ocr_pipeline.asetup(),
+    ]
+    if hasattr(thread_locks, "asetup"):
+        setups.append(thread_locks.asetup())
+    await asyncio.gather(*setups)
+    # Builds the agent graph and imports its tools before the first question needs them
+    await asyncio.to_thread(get_single_agent_graph)
+    print(f"Warm-up finished in {time.monotonic() - start:.2f}s")
+
+
+async def start_telegram_webhook():
+    """Start the bot without an updater and point Telegram at the webhook route."""
+    global telegram_app, telegram_updates
+    import telegram_bot
+    from components.thread_lock import MongoLeaseThreadLocks
+
+    # Without the secret anyone could post updates into any chat, e.g. approve a tool call
+    if not init.TELEGRAM_WEBHOOK_SECRET:
+        raise RuntimeError("TELEGRAM_WEBHOOK_SECRET must be set to serve the Telegram webhook")
+    # Every worker receives updates, the turns of a thread need the leases across workers too
+    if init.THREAD_LOCK_BACKEND != "mongo":
+        raise RuntimeError("THREAD_LOCK_BACKEND=mongo is required to serve the Telegram webhook from several workers")
+    telegram_app = telegram_bot.build_application(webhook=True)
+    db = init.mongo_client[init.CHATBOT_MONGO_DATABASE]
+    telegram_updates = telegram_bot.WebhookUpdateQueue(
+        telegram_app,
+        db[init.TELEGRAM_UPDATES_COLLECTION],
+        MongoLeaseThreadLocks(db[init.THREAD_LOCK_COLLECTION]),
+        media_group_wait=init.TELEGRAM_MEDIA_GROUP_WAIT,
+    )
+    await telegram_updates.asetup()
+    await telegram_app.initialize()
+    await telegram_app.start()
+    # Every worker sets the same webhook, Telegram spreads the updates over them through the load balancer
+    await telegram_app.bot.set_webhook(
+        init.TELEGRAM_WEBHOOK_URL,
+        secret_token=init.TELEGRAM_WEBHOOK_SECRET,
+        allowed_updates=telegram_bot.Update.ALL_TYPES,
+        max_connections=100,
+    )
+
+
+async def start_telegram_polling():
+    """Start the bot polling for updates in this event loop, next to the API."""
+    global telegram_app
+    import telegram_bot
+
+    telegram_app = telegram_bot.build_application()
+    await telegram_app.initialize()
+    await telegram_app.start()
+    await telegram_app.updater.start_polling(allowed_updates=telegram_bot.Update.ALL_TYPES)
+
+
 # Initialise beanie for user management 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global warm_up_task
     await init_beanie(
         database=init.mongodb,  
         document_models=[
             User,  
         ],
     )
+    # The worker serves as soon as beanie is ready, the rest warms up in the background
+    warm_up_task = asyncio.create_task(warm_up())
+    # Deletes checkpoint history outside the retention policy, no-op without one
+    checkpointer.start_compaction(init.CHECKPOINT_COMPACTION_INTERVAL)
+    # Reports sync calls that block the event loop
+    loop_monitor.start()
+    if init.TELEGRAM_WEBHOOK_URL:
+        await start_telegram_webhook()
+    elif init.TELEGRAM_POLLING:
+        await start_telegram_polling()
     yield
+    if telegram_app is not None:
+        # The bot stops first, its updates in progress still need the clients closed below
+        if telegram_updates is not None:
+            await telegram_updates.aclose()
+        if telegram_app.updater is not None and telegram_app.updater.running:
+            await telegram_app.updater.stop()
+        await telegram_app.stop()
+        await telegram_app.shutdown()
+    if not warm_up_task.done():
+        warm_up_task.cancel()
+    await loop_monitor.stop()
+    await ocr_pipeline.aclose()
+    await db_tools.chart_pool.aclose()
+    await checkpointer.aclose()
+    await init.embedding_client.aclose()
+    await gcs.aclose()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -71,10 +199,95 @@ app.include_router(
 )
 
 
+@app.get("/ready", tags=["health"])
+async def ready():
+    """503 until the warm-up connected to every backend, for the load balancer's readiness probe."""
+    if warm_up_task is not None and warm_up_task.done() and not warm_up_task.cancelled():
+        if warm_up_task.exception() is None:
+            return {"status": "ready", "uptime_seconds": time.monotonic() - started_at}
+        return JSONResponse({"status": "failed", "error": repr(warm_up_task.exception())}, status_code=503)
+    return JSONResponse({"status": "starting", "uptime_seconds": time.monotonic() - started_at}, status_code=503)
+
+
 @app.get("/authenticated-route")
 async def authenticated_route(user: User = Depends(current_active_user)):
     return {"message": f"Hello {user.email}!"}
 
+current_superuser = fastapi_users.current_user(active=True, superuser=True)
+
+
+@app.get("/admin/cache-stats", tags=["admin"])
+async def cache_stats(user: User = Depends(current_superuser)):
+    """Hit/miss counters of the in-process caches of this worker."""
+    stats = {}
+    if hasattr(checkpointer, "stats"):
+        stats["checkpoint"] = checkpointer.stats()
+    stats["query_embeddings"] = db_tools.embedding_cache.stats()
+    stats["sql_schema"] = {name: database.stats() for name, database in db.databases.items()}
+    return stats
+
+
+@app.get("/admin/thread-lock-stats", tags=["admin"])
+async def thread_lock_stats(user: User = Depends(current_superuser)):
+    """Turns serialized per thread by this worker, time spent waiting and coalesced duplicates."""
+    return thread_locks.stats()
+
+
+@app.get("/admin/sql-result-cache", tags=["admin"])
+async def sql_result_cache_stats(user: User = Depends(current_superuser)):
+    """Hit rate and LLM tokens saved by the SQL result cache, for this worker and per database."""
+    return await db_tools.result_cache.astats()
+
+
+@app.delete("/admin/sql-result-cache", tags=["admin"])
+async def invalidate_sql_result_cache(database: str = Query(None, description="Only this database, all when empty"), user: User = Depends(current_superuser)):
+    """Forget the cached answers, e.g. after the data of a database was corrected."""
+    deleted = await db_tools.result_cache.ainvalidate(database)
+    return {"deleted": deleted}
+
+
+@app.get("/admin/ocr-cache", tags=["admin"])
+async def ocr_cache_stats(user: User = Depends(current_superuser)):
+    """Hit rate of the OCR result cache, for this worker and overall."""
+    if ocr_pipeline.cache is None:
+        return {"enabled": False}
+    return await ocr_pipeline.cache.astats()
+
+
+@app.delete("/admin/ocr-cache", tags=["admin"])
+async def invalidate_ocr_cache(file_sha256: str = Query(None, description="Only the extractions of this file, all when empty"), user: User = Depends(current_superuser)):
+    """Forget cached extractions, e.g. after a wrong extraction was reported."""
+    if ocr_pipeline.cache is None:
+        return {"deleted": 0}
+    deleted = await ocr_pipeline.cache.ainvalidate(file_sha256)
+    return {"deleted": deleted}
+
+
+@app.post("/telegram/webhook", tags=["telegram"], include_in_schema=False)
+async def telegram_webhook(request: Request):
+    """Updates from Telegram, queued for the bot. Answers at once, the bot replies through the Bot API."""
+    if telegram_app is None or telegram_app.updater is not None:
+        raise HTTPException(status_code=404, detail="Webhook mode is off")
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret.encode(), init.TELEGRAM_WEBHOOK_SECRET.encode()):
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+    # Stored before answering, the updates of a chat are then handled in order by one worker at a time
+    await telegram_updates.aput(await request.json())
+    return Response(status_code=200)
+
+
+@app.get("/admin/loop-stats", tags=["admin"])
+async def loop_stats(user: User = Depends(current_superuser)):
+    """Event loop lag of this worker, the embeddings requests it made, its chart workers, GCS uploads and OCR extractions."""
+    return {
+        "loop": loop_monitor.stats(),
+        "embeddings": init.embedding_client.stats(),
+        "charts": db_tools.chart_pool.stats(),
+        "gcs": {str(path): service.stats() for path, service in gcs.services.items()},
+        "ocr": ocr_pipeline.stats(),
+        "ocr_cache": ocr_pipeline.cache.stats() if ocr_pipeline.cache is not None else None,
+    }
+
 
 """
 For permission:
@@ -88,6 +301,8 @@ finish = finish
 
 @app.get("/upload-atlas-vectors")
 async def upload_vectors():
+    import pandas as pd
+
     # Replace the following line with the path to your own text file
     # with open(init.SIP_CDE_SUMMARY_PATH, "r") as file:
     #     faq_text = file.read()
@@ -102,16 +317,16 @@ async def upload_vectors():
     df['database_name'] = 'suria'  # Replace with the actual database name
 
     # Generate embeddings using your OpenAI client
-    res = init.openai_client.embeddings.create(input=df['page_content'], model=init.DEFAULT_EMBEDDINGS_MODEL)
-    embeddings = [data.embedding for data in res.data]
-    df['embeddings'] = embeddings
+    df['embeddings'] = await init.embedding_client.aembed(df['page_content'].tolist())
     
     # Convert the DataFrame to a list of dictionaries
     df_dict = df.to_dict(orient="records")
 
     # Insert the data into MongoDB
     collection = init.mongodb.get_collection("sql_db_description")
-    collection.insert_many(df_dict)
+    await collection.insert_many(df_dict)
+    # Every worker reloads its routing index
+    await db_tools.routing_index.bump_version()
 
     return {
         "message": "Vectors uploaded successfully",
@@ -126,13 +341,21 @@ def add_padding(encoded_string):
 Single-agent chatbot
 """
 @app.post("/single_agent_with_response/")
-async def single_agent_response(question: str = Form(..., description="Enter the question"), file : UploadFile = File(None,description="Attach a file to use OCR services"), user=Depends(current_active_user)):
+async def single_agent_response(question: str = Form(..., description="Enter the question"), file : UploadFile = File(None,description="Attach a file to use OCR services"), user=Depends(current_active_user), idempotency_key: str = Header(None, description="Retries of a request with the same key while it is still running get its response instead of running again.")):
     try:
-        message = await handle_single_agent_all(question, str(user.thread_id[0]), file)
+        message = await handle_single_agent_all(question, str(user.thread_id[0]), file, request_id=idempotency_key)
         return Response(content=message, media_type="text/plain")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+@app.post("/single_agent_stream/", summary="Stream the chatbot response", description="Same as /single_agent_with_response/, but streams server-sent events: start, token, tool_start, tool_end, permission, end and error.")
+async def single_agent_stream(question: str = Form(..., description="Enter the question"), file : UploadFile = File(None,description="Attach a file to use OCR services"), user=Depends(current_active_user)):
+    # Upload the attachment before streaming starts, the form file is closed once the endpoint returns
+    if file is not None:
+        link = await ocr_tools.upload_file_and_get_link(file)
+        question = question + " " + link
+    return EventSourceResponse(stream_single_agent_all(question, str(user.thread_id[0])))
+
 def authenticate_user(credentials: HTTPBasicCredentials = Depends(HTTPBasic())):
     user_pass = f"{credentials.username}:{credentials.password}"
     user_pass_encode = base64.b64encode(user_pass.encode("utf-8")).decode("utf-8")
@@ -150,29 +373,77 @@ def check_authentication(func):
         return await func(*args, **kwargs)
     return wrapper
 
+async def spool_ocr_upload(file: UploadFile):
+    """The spooled upload, its SHA-256 and its extension, or the error response for the caller."""
+    file_extension = os.path.splitext(file.filename or "")[1]
+    if file_extension not in OCR_EXTENSIONS:
+        return None, None, file_extension, {'message':f'Please attach a PDF/JPEG/JPG or PNG file. You have attached a {file_extension} file.','status': 400}
+    try:
+        spool, file_sha256 = await ocr_pipeline.aspool(file)
+    except OCRFileError as e:
+        return None, None, file_extension, {'message': str(e), 'status': 400}
+    except Exception as e:
+        return None, None, file_extension, {'message':'Please attach a PDF first before accessing our OCR service.','status': 400}
+    finally:
+        await file.close()
+    return spool, file_sha256, file_extension, None
+
 @app.post("/use_ocr_service", summary="Get response from Gemini", description="You must put the PDF file. You can either put the list of fields to extract (string of fields separated by commas) or the prompt. If you put both, the user prompt that you passed will be prioritised. The response will be returned in a JSON format.", tags=["Get Response"])
 @check_authentication
-async def use_ocr_service(file : UploadFile =File(..., description="The PDF file to upload"), list_to_extract: str = Query(None, description="Comma-separated list of fields to extract from the PDF."), user_prompt: str = Query(None, description="Feel free to pass your own prompt. Note if you enter both parameters, the user prompt will get prioritised."), credentials: HTTPBasicCredentials = Depends(HTTPBasic())): 
-    # try to open the file and convert to base64
+async def use_ocr_service(file : UploadFile =File(..., description="The PDF file to upload"), list_to_extract: str = Query(None, description="Comma-separated list of fields to extract from the PDF."), user_prompt: str = Query(None, description="Feel free to pass your own prompt. Note if you enter both parameters, the user prompt will get prioritised."), credentials: HTTPBasicCredentials = Depends(HTTPBasic()), x_ocr_cache: str = Header(None, description='"bypass" to extract again instead of returning a cached result for the same file and request.')): 
+    # Spool the upload, then validate, encode and extract off the event loop
+    spool, file_sha256, file_extension, error = await spool_ocr_upload(file)
+    if error is not None:
+        return error
     try:
-        contents = file.file.read()
-        file_bytes = io.BytesIO(contents)
-        file_extension = os.path.splitext(file.filename)[1]
-        if file_extension not in [".pdf", ".jpeg", ".jpg", ".png"]:
-            return {'message':f'Please attach a PDF/JPEG/JPG or PNG file. You have attached a {file_extension} file.','status': 400}
-        
-        if not ocr_tools.validate_file(file_bytes, file_extension):
-            return {'message':'File failed to be accessed. Please upload a different file.','status': 400}
-        file_base64 = base64.b64encode(file_bytes.getvalue()).decode('utf-8')
-    except Exception as e:
-        return {'message':'Please attach a PDF first before accessing our OCR service.','status': 400}
+        response_dict = await ocr_pipeline.aextract(
+            spool, file_extension, list_to_extract, user_prompt,
+            file_sha256=file_sha256, bypass_cache=x_ocr_cache == "bypass",
+        )
+    except OCRFileError as e:
+        return {'message': str(e), 'status': 400}
     finally:
-        file.file.close()
-    response_dict = ocr_tools.generate(file_base64,file_extension.replace('.',''),list_to_extract, user_prompt)
+        spool.close()
     if response_dict['status'] == 400:
         return {'message':'Response not generated. Please check your prompt again.' + str(response_dict['message']),'status': 400}
-    return {'message':'Response generated','response': response_dict['response'], 'status': 200}
-    
+    return {'message':'Response generated','response': response_dict['response'], 'cached': response_dict['cached'], 'status': 200}
+
+@app.post("/ocr_jobs", summary="Submit an OCR job", description="Same as /use_ocr_service, but returns a job_id at once and runs the extraction in the background. Poll GET /ocr_jobs/{job_id} for the result, or pass a callback_url to receive it as a POST when the job finishes. Suited to long multi-page documents.", tags=["Get Response"])
+@check_authentication
+async def submit_ocr_job(file : UploadFile =File(..., description="The PDF file to upload"), list_to_extract: str = Query(None, description="Comma-separated list of fields to extract from the PDF."), user_prompt: str = Query(None, description="Feel free to pass your own prompt. Note if you enter both parameters, the user prompt will get prioritised."), callback_url: str = Query(None, description="https URL the result is POSTed to when the job finishes."), credentials: HTTPBasicCredentials = Depends(HTTPBasic()), x_ocr_cache: str = Header(None, description='"bypass" to extract again instead of returning a cached result for the same file and request.')):
+    # Refused before the upload is read
+    try:
+        ocr_pipeline.check_capacity()
+        if callback_url:
+            await ocr_pipeline.acheck_callback_url(callback_url)
+    except OCRQueueFull as e:
+        await file.close()
+        return JSONResponse({'message': str(e), 'status': 429}, status_code=429, headers={"Retry-After": "30"})
+    except OCRCallbackError as e:
+        await file.close()
+        return {'message': str(e), 'status': 400}
+    spool, file_sha256, file_extension, error = await spool_ocr_upload(file)
+    if error is not None:
+        return error
+    try:
+        job_id = await ocr_pipeline.asubmit(
+            spool, file_extension, list_to_extract, user_prompt, callback_url=callback_url, filename=file.filename,
+            file_sha256=file_sha256, bypass_cache=x_ocr_cache == "bypass",
+        )
+    except (OCRQueueFull, OCRCallbackError) as e:
+        spool.close()
+        if isinstance(e, OCRQueueFull):
+            return JSONResponse({'message': str(e), 'status': 429}, status_code=429, headers={"Retry-After": "30"})
+        return {'message': str(e), 'status': 400}
+    return {'message':'Job submitted', 'job_id': job_id, 'status': 202}
+
+@app.get("/ocr_jobs/{job_id}", summary="Get an OCR job", description="The status of an OCR job (queued, running, done or failed), with its result once it finished.", tags=["Get Response"])
+@check_authentication
+async def get_ocr_job(job_id: str, credentials: HTTPBasicCredentials = Depends(HTTPBasic())):
+    job = await ocr_pipeline.aget_job(job_id)
+    if job is None:
+        return {'message':'Job not found, it may have expired.','status': 404}
+    return {'message':'Job found', 'job': job, 'status': 200}
 
 
 def fastapi_main():
@@ -0,0 +1,152 @@
+# in-process vector index for routing SQL questions to a database
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from components.lru_cache import LRUCache
+
+
+def normalize_query(text: str) -> str:
+    """Normalize a question so trivially different spellings share a cache entry."""
+    return " ".join(text.lower().split())
+
+
+class EmbeddingCache:
+    """Cache of query embeddings keyed by model and normalized text.
+
+    Lookups go to an in-memory LRU first, then to an optional directory on disk that is
+    shared by the workers of a host and survives restarts.
+
+    Args:
+        model (str): The embeddings model, part of the cache key.
+        max_entries (int): The maximum number of embeddings kept in memory. Defaults to 10000.
+        cache_dir (Optional[str]): Directory for the on-disk cache. Defaults to memory only.
+    """
+
+    def __init__(self, model: str, max_entries: int = 10000, cache_dir: Optional[str] = None) -> None:
+        self.model = model
+        self.memory = LRUCache(max_entries)
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\n{normalize_query(text)}".encode("utf-8")).hexdigest()
+
+    async def aget(self, text: str) -> Optional[np.ndarray]:
+        key = self.key(text)
+        vector = self.memory.get(key, count=False)
+        if vector is None and self.cache_dir:
+            # Disk reads block, they run on a thread so a slow disk never stalls the event loop
+            vector = await asyncio.to_thread(self._load, key)
+            if vector is not None:
+                self.disk_hits += 1
+                self.memory.set(key, vector)
+        if vector is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return vector
+
+    async def aset(self, text: str, vector: Any) -> np.ndarray:
+        key = self.key(text)
+        vector = np.asarray(vector, dtype=np.float32)
+        self.memory.set(key, vector)
+        if self.cache_dir:
+            await asyncio.to_thread(self._save, key, vector)
+        return vector
+
+    def _load(self, key: str) -> Optional[np.ndarray]:
+        try:
+            return np.load(os.path.join(self.cache_dir, f"{key}.npy"))
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, key: str, vector: np.ndarray) -> None:
+        # Written under a temporary name first so other workers never read a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, vector)
+        os.replace(tmp_path, os.path.join(self.cache_dir, f"{key}.npy"))
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.memory),
+        }
+
+
+class RoutingIndex:
+    """Cosine top-k over the database descriptions, loaded from MongoDB into a NumPy matrix.
+
+    The description collection is tiny, so searching it locally replaces the Atlas
+    $vectorSearch round-trip. The matrix is reloaded when the version document written by
+    bump_version() changes, which is checked at most every check_interval seconds.
+
+    Args:
+        collection (AsyncIOMotorCollection): The collection holding page_content, database_name and embeddings.
+        check_interval (float): Seconds between checks of the version document. Defaults to 30.
+    """
+
+    def __init__(self, collection: AsyncIOMotorCollection, check_interval: float = 30) -> None:
+        self.collection = collection
+        self.meta_collection = collection.database[f"{collection.name}_meta"]
+        self.check_interval = check_interval
+        self.version = None
+        self.checked_at: Optional[float] = None
+        self.documents: List[Dict[str, Any]] = []
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+
+    async def bump_version(self) -> None:
+        """Record that the collection changed, every worker reloads on its next check."""
+        await self.meta_collection.update_one({"_id": "version"}, {"$inc": {"version": 1}}, upsert=True)
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        self.checked_at = None
+
+    async def aload(self) -> None:
+        meta = await self.meta_collection.find_one({"_id": "version"})
+        docs = await self.collection.find(
+            {}, {"_id": 0, "page_content": 1, "database_name": 1, "embeddings": 1}
+        ).to_list(length=None)
+        matrix = np.array([doc.pop("embeddings") for doc in docs], dtype=np.float32)
+        if len(docs):
+            matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.documents, self.matrix = docs, matrix
+        self.version = meta["version"] if meta else None
+        self.checked_at = time.monotonic()
+        print(f"Loaded {len(docs)} database descriptions into the routing index")
+
+    async def aensure_fresh(self) -> None:
+        if self.checked_at is not None and time.monotonic() - self.checked_at < self.check_interval:
+            return
+        if self.checked_at is not None:
+            meta = await self.meta_collection.find_one({"_id": "version"})
+            if (meta["version"] if meta else None) == self.version:
+                self.checked_at = time.monotonic()
+                return
+        await self.aload()
+
+    async def atop_k(self, vector: Any, k: int = 2) -> List[Dict[str, Any]]:
+        """Get the k descriptions most similar to a query embedding, best first, with their cosine score."""
+        await self.aensure_fresh()
+        if not self.documents:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        scores = self.matrix @ (query / np.linalg.norm(query))
+        top = np.argsort(-scores)[:k]
+        return [{**self.documents[i], "score": float(scores[i])} for i in top]
@@ -0,0 +1,262 @@
+# semantic cache of SQL agent answers
+import re
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+_MONTHS = (
+    "jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec",
+    "january", "february", "march", "april", "june", "july", "august", "september",
+    "october", "november", "december",
+)
+# Words that change the rows or the period a question covers while barely moving its
+# embedding: relative periods, their units, and ordering and direction
+_MODIFIERS = {
+    # relative periods
+    "last", "this", "previous", "prior", "past", "next", "current", "coming", "recent", "latest",
+    "today", "yesterday", "tomorrow", "tonight", "now", "ago", "since", "before", "after", "until",
+    "ytd", "mtd", "qtd", "wtd", "yoy", "mom", "qoq", "to-date", "so-far",
+    # units of a relative period
+    "day", "days", "week", "weeks", "weekly", "month", "months", "monthly", "quarter", "quarters",
+    "quarterly", "year", "years", "yearly", "annual", "annually", "fy", "h1", "h2",
+    "weekday", "weekend", "morning", "afternoon", "evening", "night",
+    "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+    # ordering and direction
+    "top", "bottom", "highest", "lowest", "most", "least", "max", "maximum", "min", "minimum",
+    "best", "worst", "largest", "smallest", "biggest", "first", "final", "increase", "decrease",
+    "ascending", "descending", "asc", "desc", "above", "below", "over", "under", "more", "less",
+    "fewer", "greater", "not", "without", "excluding", "except", "only",
+    # aggregates
+    "total", "sum", "average", "avg", "mean", "median", "count", "number", "percentage", "percent", "share",
+}
+# Quoted strings, numbers and dates (2024, 3.5, 12/01/2024, Q3), month names,
+# capitalized or upper-case words, which name the entities a question is about, and
+# the words of _MODIFIERS
+_KEY_TOKEN = re.compile(
+    r"[\"“]([^\"”]+)[\"”]"
+    r"|(\d+(?:[.,/:-]\d+)*%?|\b[qQ][1-4]\b)"
+    r"|\b(" + "|".join(_MONTHS) + r")\b"
+    r"|(?<!^)(?<![.?!]\s)\b([A-Z][\w-]*)"
+    r"|\b([a-z][\w-]*)\b",
+    re.IGNORECASE,
+)
+
+
+def normalize_question(question: str) -> str:
+    """Lower-case the question and collapse its whitespace and trailing punctuation."""
+    return " ".join(question.lower().split()).rstrip("?.! ")
+
+
+def key_tokens(question: str) -> List[str]:
+    """The numbers, dates, periods, quoted strings, named entities and ordering words of a question, sorted.
+
+    Two questions only share an answer when these match exactly, so "sales in 2023" never
+    gets the answer of "sales in 2024", "spend last month" the one of "spend this month",
+    or "top 5 vendors" the one of "bottom 5 vendors", however close their embeddings are.
+    """
+    tokens = set()
+    question = " ".join(question.split())
+    for match in _KEY_TOKEN.finditer(question):
+        quoted, number, month, entity, word = match.groups()
+        if word is not None or (entity is not None and not entity[0].isupper()):
+            word = (word or entity).lower()
+            if word in _MODIFIERS:
+                tokens.add(word)
+            continue
+        token = quoted or number or month or entity
+        tokens.add(token.lower()[:3] if month else token.lower())
+    return sorted(tokens)
+
+
+class SemanticResultCache:
+    """Answers of the SQL agent, looked up by the embedding of the question.
+
+    A question whose embedding has a cosine similarity of at least threshold with a cached
+    question of the same database (and schema version) gets the cached answer without
+    running the agent, provided both have the same key tokens: the numbers, dates and named
+    entities that embeddings barely tell apart. A question with the same normalized text
+    is a hit whatever the similarity. Entries live in MongoDB, so every worker shares them,
+    and expire after the TTL of their database. Each worker keeps the live entries of a database in a
+    matrix, refreshed with the entries added by other workers at most every check_interval
+    seconds and reloaded when invalidate() is called anywhere.
+
+    Args:
+        collection (AsyncIOMotorCollection): The collection holding the entries.
+        threshold (float): The minimum cosine similarity of a hit. Defaults to 0.97.
+        ttl (float): Seconds an answer is served for. Defaults to 3600.
+        ttls (Optional[Dict[str, float]]): TTL overrides per database. Defaults to None.
+        check_interval (float): Seconds between two refreshes from MongoDB. Defaults to 10.
+    """
+
+    def __init__(
+        self,
+        collection: AsyncIOMotorCollection,
+        threshold: float = 0.97,
+        ttl: float = 3600,
+        ttls: Optional[Dict[str, float]] = None,
+        check_interval: float = 10,
+    ) -> None:
+        self.collection = collection
+        self.meta_collection = collection.database[f"{collection.name}_meta"]
+        self.threshold = threshold
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.check_interval = check_interval
+        # database -> {"version", "checked_at", "loaded_until", "entries", "matrix", "normalized"}
+        self._indexes: Dict[str, Dict[str, Any]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    async def asetup(self) -> None:
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+        await self.collection.create_index([("database", 1), ("created_at", 1)])
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_tokens": self.saved_tokens,
+            "entries": {database: len(index["entries"]) for database, index in self._indexes.items()},
+        }
+
+    async def astats(self) -> Dict[str, Any]:
+        """Stats of this worker, plus the hits and saved tokens of every worker per database."""
+        pipeline = [
+            {"$group": {
+                "_id": "$database",
+                "entries": {"$sum": 1},
+                "hits": {"$sum": "$hits"},
+                "saved_tokens": {"$sum": {"$multiply": ["$hits", "$tokens"]}},
+            }},
+        ]
+        databases = {
+            doc.pop("_id"): doc async for doc in self.collection.aggregate(pipeline)
+        }
+        return {"worker": self.stats(), "databases": databases}
+
+    async def alookup(
+        self,
+        database: str,
+        question: str,
+        embedding: Any,
+        schema_version: Optional[str] = None,
+    ) -> Optional[str]:
+        """Get the cached answer of the most similar question with the same key tokens, None below the threshold."""
+        index = await self._aensure_fresh(database)
+        now = datetime.now(timezone.utc)
+        normalized, tokens = normalize_question(question), key_tokens(question)
+        entry, score = None, -1.0
+        candidate = index["normalized"].get(normalized)
+        if candidate is not None and candidate["expires_at"] > now and candidate["schema_version"] == schema_version:
+            entry, score = candidate, 1.0
+        elif index["entries"]:
+            query = np.asarray(embedding, dtype=np.float32)
+            scores = index["matrix"] @ (query / np.linalg.norm(query))
+            for i in np.argsort(-scores):
+                if scores[i] < self.threshold:
+                    break
+                candidate = index["entries"][i]
+                if (
+                    candidate["expires_at"] > now
+                    and candidate["schema_version"] == schema_version
+                    and candidate["key_tokens"] == tokens
+                ):
+                    entry, score = candidate, float(scores[i])
+                    break
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.saved_tokens += entry["tokens"]
+        await self.collection.update_one({"_id": entry["_id"]}, {"$inc": {"hits": 1}})
+        print(f"SQL result cache hit ({score:.3f}): {entry['question']}")
+        return entry["answer"]
+
+    async def astore(
+        self,
+        database: str,
+        question: str,
+        embedding: Any,
+        answer: str,
+        tokens: int,
+        schema_version: Optional[str] = None,
+    ) -> None:
+        now = datetime.now(timezone.utc)
+        doc = {
+            "_id": uuid.uuid4().hex,
+            "database": database,
+            "question": question,
+            "embedding": [float(x) for x in embedding],
+            "answer": answer,
+            "tokens": tokens,
+            "schema_version": schema_version,
+            "hits": 0,
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=self.ttls.get(database, self.ttl)),
+        }
+        await self.collection.insert_one(doc)
+        index = self._indexes.get(database)
+        if index is not None:
+            self._add_entries(index, [doc])
+
+    async def ainvalidate(self, database: Optional[str] = None) -> int:
+        """Delete the cached answers of a database, or of every database. Returns the number deleted."""
+        res = await self.collection.delete_many({} if database is None else {"database": database})
+        await self.meta_collection.update_one({"_id": "version"}, {"$inc": {"version": 1}}, upsert=True)
+        self._indexes.clear()
+        return res.deleted_count
+
+    async def _aensure_fresh(self, database: str) -> Dict[str, Any]:
+        index = self._indexes.get(database)
+        if index is not None and time.monotonic() - index["checked_at"] < self.check_interval:
+            return index
+        meta = await self.meta_collection.find_one({"_id": "version"})
+        version = meta["version"] if meta else None
+        if index is None or index["version"] != version:
+            index = {
+                "version": version,
+                "loaded_until": None,
+                "entries": [],
+                "matrix": np.zeros((0, 0), dtype=np.float32),
+                "normalized": {},
+            }
+            self._indexes[database] = index
+        query = {"database": database, "expires_at": {"$gt": datetime.now(timezone.utc)}}
+        if index["loaded_until"] is not None:
+            # Overlaps the previous load, entries of other workers may arrive slightly out of order
+            query["created_at"] = {"$gt": index["loaded_until"] - timedelta(seconds=60)}
+        docs = await self.collection.find(query).to_list(length=None)
+        for doc in docs:
+            # Motor returns naive datetimes unless the client is tz_aware
+            for field in ("created_at", "expires_at"):
+                doc[field] = doc[field].replace(tzinfo=timezone.utc)
+        known = {entry["_id"] for entry in index["entries"]}
+        self._add_entries(index, [doc for doc in docs if doc["_id"] not in known])
+        if docs:
+            loaded_until = max(doc["created_at"] for doc in docs)
+            index["loaded_until"] = max(loaded_until, index["loaded_until"] or loaded_until)
+        index["checked_at"] = time.monotonic()
+        return index
+
+    @staticmethod
+    def _add_entries(index: Dict[str, Any], docs: List[Dict[str, Any]]) -> None:
+        now = datetime.now(timezone.utc)
+        for doc in docs:
+            # Derived from the question on load, so entries follow changes to key_tokens()
+            doc["normalized"] = normalize_question(doc["question"])
+            doc["key_tokens"] = key_tokens(doc["question"])
+        entries = [entry for entry in index["entries"] if entry["expires_at"] > now] + docs
+        if entries:
+            matrix = np.array([entry["embedding"] for entry in entries], dtype=np.float32)
+            matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        index["entries"], index["matrix"] = entries, matrix
+        index["normalized"] = {entry["normalized"]: entry for entry in entries}
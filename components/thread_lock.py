@@ -0,0 +1,185 @@
+# per-thread concurrency control for conversation turns
+import asyncio
+import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+
+class InProcessThreadLocks:
+    """Serializes the turns of a conversation thread within one process.
+
+    Turns of the same thread_id run one at a time, in arrival order, while turns of
+    different threads run in parallel. A turn submitted with a coalesce_key while a turn
+    of the same thread and key is still queued or running (a client retry, a Telegram
+    redelivery) is not run again, it waits for and returns the result of the first one.
+    Such a turn runs to completion even when the caller that started it is cancelled.
+    """
+
+    def __init__(self) -> None:
+        # thread_id -> [lock, number of turns holding or waiting for it]
+        self._locks: Dict[str, list] = {}
+        self._inflight: Dict[tuple, asyncio.Task] = {}
+        self.turns = 0
+        self.waiting = 0
+        self.coalesced = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "turns": self.turns,
+            "waiting": self.waiting,
+            "coalesced": self.coalesced,
+            "avg_wait_seconds": self.total_wait / self.turns if self.turns else 0.0,
+            "max_wait_seconds": self.max_wait,
+        }
+
+    @asynccontextmanager
+    async def hold(self, thread_id: str) -> AsyncIterator[None]:
+        """Hold the lock of a thread for the duration of a turn."""
+        entry = self._locks.setdefault(thread_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        self.waiting += 1
+        start = time.monotonic()
+        acquired = False
+        try:
+            async with entry[0]:
+                async with self._lease(thread_id):
+                    acquired = True
+                    self._record_wait(time.monotonic() - start)
+                    yield
+        finally:
+            if not acquired:
+                self.waiting -= 1
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(thread_id, None)
+
+    async def run(self, thread_id: str, turn: Callable[[], Awaitable[Any]], coalesce_key: Optional[Hashable] = None) -> Any:
+        """Run a turn while holding the lock of its thread.
+
+        Args:
+            thread_id (str): The conversation thread of the turn.
+            turn (Callable[[], Awaitable[Any]]): Runs the turn and returns its result.
+            coalesce_key (Optional[Hashable]): Identifies identical turns, e.g. a request id supplied by the client. Defaults to never coalescing.
+
+        Returns:
+            Any: The result of the turn.
+        """
+        if coalesce_key is None:
+            async with self.hold(thread_id):
+                return await turn()
+
+        key = (thread_id, coalesce_key)
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            # Owned by the locks rather than by the caller, so a caller going away (a client
+            # disconnect) cancels neither the turn nor the duplicates waiting for its result
+            task = asyncio.ensure_future(self._arun_turn(thread_id, turn))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._turn_done(key, t))
+        return await asyncio.shield(task)
+
+    async def _arun_turn(self, thread_id: str, turn: Callable[[], Awaitable[Any]]) -> Any:
+        async with self.hold(thread_id):
+            return await turn()
+
+    def _turn_done(self, key: tuple, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # The callers may all be gone by the time the turn fails
+        if not task.cancelled():
+            task.exception()
+
+    def _record_wait(self, wait: float) -> None:
+        self.waiting -= 1
+        self.turns += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    @asynccontextmanager
+    async def _lease(self, thread_id: str) -> AsyncIterator[None]:
+        # Nothing to do across processes
+        yield
+
+
+class MongoLeaseThreadLocks(InProcessThreadLocks):
+    """Serializes the turns of a conversation thread across workers with MongoDB leases.
+
+    Turns are first serialized in-process, so only one turn per worker competes for a
+    thread's lease. A lease is a document keyed by thread_id that expires after lease_ttl
+    seconds. It is renewed while the turn runs, so a crashed worker only blocks its
+    threads until the lease expires.
+
+    Args:
+        collection (AsyncIOMotorCollection): The collection holding the leases.
+        lease_ttl (float): Seconds after which an unrenewed lease expires. Defaults to 60.
+        acquire_timeout (float): Seconds to wait for a lease before giving up. Defaults to 300.
+    """
+
+    def __init__(self, collection: AsyncIOMotorCollection, lease_ttl: float = 60, acquire_timeout: float = 300) -> None:
+        super().__init__()
+        self.collection = collection
+        self.lease_ttl = lease_ttl
+        self.acquire_timeout = acquire_timeout
+        self.lease_timeouts = 0
+
+    async def asetup(self) -> None:
+        """Let MongoDB remove leases left behind by crashed workers."""
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "lease_timeouts": self.lease_timeouts}
+
+    @asynccontextmanager
+    async def _lease(self, thread_id: str) -> AsyncIterator[None]:
+        owner = uuid.uuid4().hex
+        await self._acquire(thread_id, owner)
+        renew = asyncio.create_task(self._renew(thread_id, owner))
+        try:
+            yield
+        finally:
+            renew.cancel()
+            await self.collection.delete_one({"_id": thread_id, "owner": owner})
+
+    async def _acquire(self, thread_id: str, owner: str) -> None:
+        deadline = time.monotonic() + self.acquire_timeout
+        backoff = 0.05
+        while True:
+            now = datetime.now(timezone.utc)
+            try:
+                # Matches an expired lease, or inserts a new one. A live lease held by
+                # another worker does not match and the insert fails on the _id
+                await self.collection.update_one(
+                    {"_id": thread_id, "expires_at": {"$lt": now}},
+                    {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=self.lease_ttl)}},
+                    upsert=True,
+                )
+                return
+            except DuplicateKeyError:
+                if time.monotonic() + backoff > deadline:
+                    self.lease_timeouts += 1
+                    raise TimeoutError(f"Thread {thread_id} is busy in another worker")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 1.0)
+
+    async def _renew(self, thread_id: str, owner: str) -> None:
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                await self.collection.update_one(
+                    {"_id": thread_id, "owner": owner},
+                    {"$set": {"expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.lease_ttl)}},
+                )
+            except Exception as e:
+                logger.warning("Could not renew the lease of thread %s: %s", thread_id, e)
@@ -1,7 +1,47 @@
+import argparse
+
+import uvicorn
+
+import components.initializer as init
 from telegram_bot import telegram_bot
 from components.routes import fastapi_main
 
-# main program, choose between fastapi and telegram, only 1 can run at a time
+
+def run_all(host: str = "127.0.0.1", port: int = 8000):
+    """Run the API and the Telegram bot in one process and one event loop.
+
+    Both frontends share the Mongo clients, the SQL connectors, the chart workers and the
+    compiled agent graph. The bot polls for updates, or is served by the webhook route when
+    TELEGRAM_WEBHOOK_URL is set, and is started and stopped by the lifespan of the API: on
+    SIGINT/SIGTERM uvicorn stops accepting requests and waits for those in progress, then
+    the bot stops polling and finishes its updates in progress before the clients close.
+    Polling allows a single process, so there is a single uvicorn worker.
+    """
+    if not init.TELEGRAM_API_KEY:
+        raise SystemExit("TELEGRAM_API_KEY is not set, run `python main.py api` to serve the API only")
+    if not init.TELEGRAM_WEBHOOK_URL:
+        init.TELEGRAM_POLLING = True
+    uvicorn.run("components.routes:app", host=host, port=port, workers=1, timeout_graceful_shutdown=30)
+
+
+# main program: "api" (the default) runs fastapi with 4 workers, "telegram" runs the bot,
+# "all" runs both in one process with a single worker
 if __name__ == "__main__":
-    fastapi_main()
-    # telegram_bot()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "mode",
+        nargs="?",
+        choices=["api", "telegram", "all"],
+        default="api",
+        help="api: the FastAPI app with 4 workers (default). telegram: the bot alone, polling. "
+        "all: the API and the bot in one process, limited to a single uvicorn worker, needs TELEGRAM_API_KEY.",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Host of the API in all mode")
+    parser.add_argument("--port", type=int, default=8000, help="Port of the API in all mode")
+    args = parser.parse_args()
+    if args.mode == "all":
+        run_all(args.host, args.port)
+    elif args.mode == "api":
+        fastapi_main()
+    else:
+        telegram_bot()
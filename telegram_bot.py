@@ -1,20 +1,26 @@
-from typing import Final
-from telegram import Update, Bot
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, CallbackContext
+from itertools import takewhile
+from typing import Any, Awaitable, Dict, Final, List, Optional
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import DuplicateKeyError
+from telegram import Message, Update, Bot
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, CallbackContext, SimpleUpdateProcessor
 import components.initializer as init
 from components.conversation_handler import handle_single_agent_1, handle_single_agent_2, handle_single_agent_all
 # from components.conversation_handler import handle_multi_agent_1, handle_multi_agent_2
+from components.attachments import AttachmentPipeline, AttachmentTooLarge, file_extension
+from components.thread_lock import InProcessThreadLocks, MongoLeaseThreadLocks
 import components.gcs_bucket as gcs
-import uuid
-import requests
 
+import asyncio
 import logging
-import io
-import os
+import time
+import uuid
+from datetime import datetime, timezone
 
 token: Final = init.TELEGRAM_API_KEY
 bot_usernmae: Final = init.TELEGRAM_BOT_USERNAME
-thread_id = 5001
+# Namespace of the conversation threads of Telegram chats, see thread_id_for_chat
+TELEGRAM_THREAD_NAMESPACE: Final = uuid.UUID("5b0e6c1e-9a43-4f0c-9a55-3f1f3c2b7e61")
 
 # Enable logging
 logging.basicConfig(
@@ -24,53 +30,249 @@ logging.basicConfig(
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+def thread_id_for_chat(chat_id: int) -> str:
+    """The conversation thread of a Telegram chat, stable across restarts and workers."""
+    return str(uuid.uuid5(TELEGRAM_THREAD_NAMESPACE, f"telegram:{chat_id}"))
+
+class ChatOrderedUpdateProcessor(SimpleUpdateProcessor):
+    """Processes updates of different chats concurrently and updates of the same chat in order.
+
+    An update waits for the earlier updates of its chat before it takes one of the
+    max_concurrent_updates slots, so a user sending several messages in a row does not hold
+    slots that other chats could use. The later messages of an album join the album of its
+    first message as they arrive instead of waiting, the first one answers for all of them
+    in its place in the chat's order.
+    """
+
+    def __init__(self, max_concurrent_updates: int) -> None:
+        super().__init__(max_concurrent_updates)
+        self.chat_locks = InProcessThreadLocks()
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+        message = update.effective_message
+        if message is not None and message.media_group_id and get_attachment(message) is not None:
+            group = media_groups.get(message.media_group_id)
+            if group is not None:
+                group.append(message)
+                coroutine.close()
+                return
+            media_groups[message.media_group_id] = [message]
+        async with self.chat_locks.hold(str(chat.id)):
+            await super().process_update(update, coroutine)
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Hello, I am a Sunway AI bot. Ask me anything!")
 
+# Downloads attachments from Telegram and streams them into the bucket
+attachments = AttachmentPipeline(max_bytes=init.TELEGRAM_MAX_FILE_BYTES)
+# media_group_id -> messages of an album received so far
+media_groups: Dict[str, List[Message]] = {}
+
+def get_attachment(message: Message):
+    """The file of a message and its extension, or None for a text message."""
+    if message.document:
+        return message.document, file_extension(message.document.file_name, message.document.mime_type)
+    if message.photo:
+        # Telegram sends every size of a photo, the largest one is the original
+        return max(message.photo, key=lambda size: size.width * size.height), "jpg"
+    if message.video:
+        return message.video, file_extension(message.video.file_name, message.video.mime_type, "mp4")
+    return None
+
+async def ingest_attachment(message: Message, context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Upload the file of a message to the bucket and return its download link."""
+    file, extension = get_attachment(message)
+    # Refused before asking Telegram, which does not serve files over 20MB anyway
+    attachments.check_size(file.file_size)
+    start = time.perf_counter()
+    new_file = await context.bot.get_file(file.file_id)
+    resolved = time.perf_counter()
+    # Fetched from Secret Manager on first use, off the event loop
+    cred_path = await asyncio.to_thread(getattr, init, "SURIA_DB_SERVICE_ACCOUNT_FILE") if init.BACKEND != "local" else None
+    result = await attachments.aingest(new_file.file_path, extension, size=new_file.file_size, cred_path=cred_path)
+    logger.info("Attachment %s: get_file %.0fms", file.file_unique_id, (resolved - start) * 1000)
+    return result["link"]
+
+async def handle_attachments(messages: List[Message], context: ContextTypes.DEFAULT_TYPE):
+    """Upload the files of one message or of an album concurrently, then answer them as one input."""
+    results = await asyncio.gather(*(ingest_attachment(message, context) for message in messages), return_exceptions=True)
+    links = []
+    for result in results:
+        if isinstance(result, AttachmentTooLarge):
+            await messages[0].reply_text(str(result))
+            return
+        if isinstance(result, Exception):
+            logger.error("Attachment upload failed: %r", result)
+            await messages[0].reply_text("Sorry, I could not read that file. Please send it again.")
+            return
+        links.append(result)
+    captions = [message.caption for message in messages if message.caption]
+    text = "\n".join(captions + links)
+
+    response: str = await handle_single_agent_all(
+        user_input=text, thread_id=thread_id_for_chat(messages[0].chat_id), request_id=str(messages[0].message_id)
+    )
+    await messages[0].reply_text(response)
+
 # Change the functions within this function to handle_multi_agent_all or handle_single_agent_all to swap between single_agent and multi_agent
 async def handle_telegram_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text: str = update.message.text
-
-    if update.message.document or update.message.photo or update.message.video:
-        if update.message.document:
-            file = update.message.document
-        elif update.message.photo:
-            file = update.message.photo
-        elif update.message.video:
-            file = update.message.video
-        # mime_type = update.message.document.mime_type
-        # print(mime_type)
-        file_extension = os.path.splitext(file.file_name)[1][1:]
-        new_file = await context.bot.get_file(file.file_id)
-
-        # getting file url from telegram api, then download and read file as bytes
-        file_url = new_file.file_path
-        response = requests.get(file_url)
-        file_bytes = io.BytesIO(response.content)
-
-        # upload and donwload file frim gcs
-        link = gcs.upload_and_download_file(
-            cred_path=init.GOOGLE_APPLICATION_CREDENTIALS_1,
-            file_bytes=file_bytes,  # Pass the in-memory bytes directly
-            file_extension=file_extension,
-            blob_name=f"{uuid.uuid4().hex}.{file_extension}",
-            bucket_name=init.GCS_BUCKET_NAME
-        )
-        text = link
+    message = update.message
+    text: str = message.text
+
+    if message.media_group_id:
+        # Every file of an album comes as its own update, the first one answers for all of them.
+        # ChatOrderedUpdateProcessor adds the later ones to its group while this waits
+        media_groups.setdefault(message.media_group_id, [message])
+        await asyncio.sleep(init.TELEGRAM_MEDIA_GROUP_WAIT)
+        await handle_attachments(media_groups.pop(message.media_group_id), context)
+        return
+
+    if get_attachment(message) is not None:
+        await handle_attachments([message], context)
+        return
 
     # else:
-    response: str = await handle_single_agent_all(user_input=text, thread_id=thread_id)
+    # A redelivered update has the same message id, message ids are unique within a chat
+    response: str = await handle_single_agent_all(
+        user_input=text, thread_id=thread_id_for_chat(message.chat_id), request_id=str(message.message_id)
+    )
     
     # print('Bot:', response)
-    await update.message.reply_text(response)
+    await message.reply_text(response)
 
 async def error(update: Update, context: ContextTypes.DEFAULT_TYPE):
     print(f"Update {update} cause error {context.error}")
 
+async def close_clients(app: Application):
+    await attachments.aclose()
+    await gcs.aclose()
 
-def telegram_bot():
-    print( 'Starting bot ... ')
-    app = Application.builder().token(token).build()
+
+class WebhookUpdateQueue:
+    """Orders the webhook updates of each chat across the API workers.
+
+    Telegram spreads webhook updates over every worker, so the in-process ordering of
+    ChatOrderedUpdateProcessor is not enough. The webhook route stores each update in
+    MongoDB, keyed by its update_id, and answers at once. The worker that holds the chat's
+    lease then handles the stored updates of the chat one at a time in update_id order,
+    until none is left, and the messages of an album together once no new one has arrived
+    for media_group_wait seconds. Every worker that stores an update of a chat queues for
+    its lease, so an update stored while the holder finishes is never left behind.
+    Redelivered updates are dropped on their update_id.
+
+    Args:
+        app (Application): The bot, built with build_application(webhook=True).
+        collection (AsyncIOMotorCollection): The collection holding the updates not handled yet.
+        chat_locks (MongoLeaseThreadLocks): The leases of the chats.
+        media_group_wait (float): Seconds to wait for the other messages of an album. Defaults to 1.
+        ttl_hours (float): Hours after which an update that was never handled is dropped. Defaults to 24.
+    """
+
+    def __init__(
+        self,
+        app: Application,
+        collection: AsyncIOMotorCollection,
+        chat_locks: MongoLeaseThreadLocks,
+        media_group_wait: float = 1.0,
+        ttl_hours: float = 24,
+    ) -> None:
+        self.app = app
+        self.collection = collection
+        self.chat_locks = chat_locks
+        self.media_group_wait = media_group_wait
+        self.ttl_hours = ttl_hours
+        self._tasks = set()
+
+    async def asetup(self) -> None:
+        await self.collection.create_index([("chat_id", 1), ("_id", 1)])
+        await self.collection.create_index("received_at", expireAfterSeconds=int(self.ttl_hours * 3600))
+
+    async def aput(self, payload: Dict[str, Any]) -> None:
+        """Store an update from the webhook and have its chat drained."""
+        update = Update.de_json(payload, self.app.bot)
+        chat = update.effective_chat
+        if chat is None:
+            # Not tied to a chat, nothing to order
+            await self.app.update_queue.put(update)
+            return
+        message = update.effective_message
+        try:
+            await self.collection.insert_one({
+                "_id": update.update_id,
+                "chat_id": chat.id,
+                "media_group_id": message.media_group_id if message is not None else None,
+                "payload": payload,
+                "received_at": datetime.now(timezone.utc),
+            })
+        except DuplicateKeyError:
+            return
+        task = asyncio.get_running_loop().create_task(self._adrain(chat.id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _adrain(self, chat_id: int) -> None:
+        try:
+            async with self.chat_locks.hold(f"telegram-chat:{chat_id}"):
+                while await self._ahandle_next(chat_id):
+                    pass
+        except Exception:
+            # The updates stay stored, the next drain of the chat handles them
+            logger.exception("Draining the updates of chat %s failed", chat_id)
+
+    async def _ahandle_next(self, chat_id: int) -> bool:
+        docs = await self.collection.find({"chat_id": chat_id}).sort("_id", 1).to_list(length=100)
+        if not docs:
+            return False
+        first = docs[0]
+        if first["media_group_id"]:
+            group = list(takewhile(lambda doc: doc["media_group_id"] == first["media_group_id"], docs))
+            newest = max(doc["received_at"].replace(tzinfo=timezone.utc) for doc in group)
+            wait = self.media_group_wait - (datetime.now(timezone.utc) - newest).total_seconds()
+            if wait > 0:
+                # More messages of the album may still arrive
+                await asyncio.sleep(wait)
+                return True
+        else:
+            group = [first]
+        updates = [Update.de_json(doc["payload"], self.app.bot) for doc in group]
+        try:
+            if first["media_group_id"]:
+                context = CallbackContext.from_update(updates[0], self.app)
+                await handle_attachments([update.effective_message for update in updates], context)
+            else:
+                await self.app.process_update(updates[0])
+        except Exception:
+            logger.exception("Update %s of chat %s failed", first["_id"], chat_id)
+        await self.collection.delete_many({"_id": {"$in": [doc["_id"] for doc in group]}})
+        return True
+
+    async def aclose(self) -> None:
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def build_application(webhook: bool = False, concurrent_updates: Optional[int] = None, **builder_options) -> Application:
+    """The bot with its handlers. In webhook mode it has no updater, updates are put on its update_queue by the webhook route.
+
+    builder_options are extra ApplicationBuilder settings, e.g. base_url to use another Bot API server.
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(ChatOrderedUpdateProcessor(concurrent_updates or init.TELEGRAM_CONCURRENT_UPDATES))
+        .post_shutdown(close_clients)
+    )
+    if webhook:
+        builder = builder.updater(None)
+    if init.TELEGRAM_BASE_URL:
+        builder = builder.base_url(init.TELEGRAM_BASE_URL)
+    for option, value in builder_options.items():
+        builder = getattr(builder, option)(value)
+    app = builder.build()
 
     # Commands
     app.add_handler(CommandHandler('start', start_command))
@@ -79,13 +281,20 @@ def telegram_bot():
     app.add_handler(MessageHandler(filters.TEXT, handle_telegram_message))
     app.add_handler(MessageHandler(filters.Document.ALL, handle_telegram_message))
     app.add_handler(MessageHandler(filters.PHOTO, handle_telegram_message))
+    app.add_handler(MessageHandler(filters.VIDEO, handle_telegram_message))
     
     # Errors
     app.add_error_handler(error)
+    return app
+
+
+def telegram_bot():
+    print( 'Starting bot ... ')
+    app = build_application()
 
-    # Polls the bot
+    # Long polling, Telegram answers as soon as there is an update
     print('Polling ... ')
-    app.run_polling(poll_interval=3)
+    app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
-    telegram_bot()
\ No newline at end of file
+    telegram_bot()
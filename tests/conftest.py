@@ -0,0 +1,9 @@
+import os
+import sys
+from pathlib import Path
+
+# Neither the Secret Manager (BACKEND=gcp) nor the local stubs (BACKEND=local), the
+# tests talk to the servers named in the environment, e.g. STORAGE_EMULATOR_HOST
+os.environ.setdefault("BACKEND", "emulator")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
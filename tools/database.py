@@ -1,51 +1,57 @@
 from typing import Annotated
 import uuid
 import re
-import base64
-import io
-import matplotlib
 from langchain_core.tools import tool
 from langchain_openai import ChatOpenAI
 from langchain_community.agent_toolkits.sql.base import create_sql_agent
 from langchain_community.agent_toolkits import SQLDatabaseToolkit
-from langchain_experimental.utilities import PythonREPL
+from langchain_community.tools.sql_database.tool import (
+    InfoSQLDatabaseTool,
+    ListSQLDatabaseTool,
+    QuerySQLDataBaseTool,
+)
+from langchain_community.callbacks import get_openai_callback
 
 import components.db as db
 import components.gcs_bucket as gcs
 import components.initializer as init
-
-repl = PythonREPL()
+from components.chart_pool import ChartPool
+from components.routing_index import EmbeddingCache, RoutingIndex
+from components.semantic_cache import SemanticResultCache
+
+# Chart code written by the agent runs in separate worker processes
+chart_pool = ChartPool(
+    max_workers=init.CHART_POOL_WORKERS,
+    timeout=init.CHART_TIMEOUT,
+    cpu_seconds=init.CHART_CPU_SECONDS,
+    memory_limit_mb=init.CHART_MEMORY_LIMIT_MB,
+    image_format=init.CHART_FORMAT,
+    dpi=init.CHART_DPI,
+    max_bytes=init.CHART_MAX_BYTES,
+    worker_user=init.CHART_WORKER_USER,
+)
+
+# Query embeddings and database descriptions are kept in memory, so routing a
+# repeated question makes no network calls
+embedding_cache = EmbeddingCache(init.DEFAULT_EMBEDDINGS_MODEL, cache_dir=init.EMBEDDING_CACHE_DIR)
+routing_index = RoutingIndex(init.mongodb.get_collection("sql_db_description"))
+# Answers to questions similar enough to an earlier one of the same database skip the agent
+result_cache = SemanticResultCache(
+    init.mongodb.get_collection("sql_result_cache"),
+    threshold=init.SQL_RESULT_CACHE_THRESHOLD,
+    ttl=init.SQL_RESULT_CACHE_TTL,
+    ttls=init.SQL_RESULT_CACHE_TTLS,
+)
 
 # FUNCTIONS
 async def determine_db_to_query(user_input):
     limit = 2
-    res = init.openai_client.embeddings.create(input=user_input, model=init.DEFAULT_EMBEDDINGS_MODEL)
-    embeddings = [data.embedding for data in res.data]
-
-    # Find matching vectors
-    aggregation_pipeline = [
-        {
-            "$vectorSearch": {
-                "queryVector": embeddings[0],
-                "path": "embeddings",
-                "numCandidates": 100,
-                "index": "db_description_vector_index",
-                "limit": limit,
-            }
-        },   
-        {
-            "$project": {
-                "_id": 0,
-                "page_content": 1,
-                "database_name": 1,  # Include the database name in the projection
-                "score": {
-                    "$meta": "vectorSearchScore"
-                }
-            }
-        }
-    ]
-    collection = init.mongodb.get_collection("sql_db_description")
-    matched_vectors = await collection.aggregate(aggregation_pipeline).to_list(length=None)
+    embedding = await embedding_cache.aget(user_input)
+    if embedding is None:
+        embedding = await embedding_cache.aset(user_input, await init.embedding_client.aembed_one(user_input))
+
+    # Find matching vectors in the in-process index of the sql_db_description collection
+    matched_vectors = await routing_index.atop_k(embedding, k=limit)
     print("\n\nMatched Vectors: " + str(matched_vectors))
 
     # Determine the database to query from the matched vectors
@@ -54,10 +60,8 @@ async def determine_db_to_query(user_input):
         print("Database: " + db_choice)
 
         # Query the appropriate database based on the database_name
-        if db_choice == "suria":
-            result = await query_suria_sql_db(user_input)
-        elif db_choice == "sip-cde":
-            result = await query_sip_cde_sql_db(user_input)
+        if db_choice in db.DATABASE_SOURCES:
+            result = await query_sql_db_cached(user_input, db_choice, embedding)
         else:
             result = f"Error: No known database found for {db_choice}."
     else:
@@ -65,68 +69,98 @@ async def determine_db_to_query(user_input):
     return result
 
 
-async def query_sql_db(user_input, db_instance):
-    llm = ChatOpenAI(model_name=init.DEFAULT_CHAT_MODEL)
-    toolkit = SQLDatabaseToolkit(db=db_instance, llm=llm)
-    agent_executor = create_sql_agent(
-        llm=llm,
-        toolkit=toolkit,
-        verbose=True
-    )
-    result = await agent_executor.ainvoke(user_input)
+# The toolkit's database tools are sync, run by langchain on the default executor when
+# the agent is invoked asynchronously. These run them on the SQL thread pool instead
+class AsyncQuerySQLDataBaseTool(QuerySQLDataBaseTool):
+    async def _arun(self, query, run_manager=None):
+        return await db.arun_sql(self._run, query)
+
+
+class AsyncInfoSQLDatabaseTool(InfoSQLDatabaseTool):
+    async def _arun(self, table_names, run_manager=None):
+        return await db.arun_sql(self._run, table_names)
+
+
+class AsyncListSQLDatabaseTool(ListSQLDatabaseTool):
+    async def _arun(self, tool_input="", run_manager=None):
+        return await db.arun_sql(self._run, tool_input)
+
+
+class AsyncSQLDatabaseToolkit(SQLDatabaseToolkit):
+    def get_tools(self):
+        async_tools = {
+            QuerySQLDataBaseTool: AsyncQuerySQLDataBaseTool,
+            InfoSQLDatabaseTool: AsyncInfoSQLDatabaseTool,
+            ListSQLDatabaseTool: AsyncListSQLDatabaseTool,
+        }
+        return [
+            async_tools[type(tool)](db=tool.db, description=tool.description) if type(tool) in async_tools else tool
+            for tool in super().get_tools()
+        ]
+
+
+# SQL agent executors, built once per database. An executor keeps no state between
+# invocations, so concurrent questions share it
+sql_agents = {}
+
+
+async def aget_sql_agent(db_name):
+    agent_executor = sql_agents.get(db_name)
+    if agent_executor is None:
+        llm = ChatOpenAI(model_name=init.DEFAULT_CHAT_MODEL)
+        toolkit = AsyncSQLDatabaseToolkit(db=await db.aget_database(db_name), llm=llm)
+        agent_executor = create_sql_agent(
+            llm=llm,
+            toolkit=toolkit,
+            verbose=True
+        )
+        sql_agents[db_name] = agent_executor
+    return agent_executor
+
+
+async def query_sql_db(user_input, db_name):
+    result = await (await aget_sql_agent(db_name)).ainvoke(user_input)
     return result['output']
 
+async def query_sql_db_cached(user_input, db_name, embedding):
+    if not init.SQL_RESULT_CACHE_ENABLED:
+        return await query_sql_db(user_input, db_name)
+    schema_version = (await db.aget_database(db_name)).version
+    result = await result_cache.alookup(db_name, user_input, embedding, schema_version)
+    if result is None:
+        # Counts the tokens a later hit on this answer saves
+        with get_openai_callback() as cb:
+            result = await query_sql_db(user_input, db_name)
+        await result_cache.astore(db_name, user_input, embedding, result, cb.total_tokens, schema_version)
+    return result
+
 async def query_suria_sql_db(user_input):
-    return await query_sql_db(user_input, db.suria_db)
+    return await query_sql_db(user_input, "suria")
 
 async def query_sip_cde_sql_db(user_input):
-    return await query_sql_db(user_input, db.sip_cde_db)
+    return await query_sql_db(user_input, "sip-cde")
 
 async def python_repl(
     code: Annotated[str, "The python code to execute to generate your chart."],
 ):
     """Use this to execute python code. If you want to see the output of a value,
     you should print it out with `print(...)`. This is visible to the user."""
-    try:
-        # Set the matplotlib backend to 'Agg' to avoid issues with Tkinter
-        matplotlib.use('Agg')
-
-        # Remove any user-provided savefig or show statements
-        modified_code = re.sub(r'plt\.savefig\(.*\)', '', code)
-        modified_code = re.sub(r'plt\.show\(.*\)', '', modified_code)
-
-        # Add code to save the image to a BytesIO object
-        modified_code += (
-            f"\nif 'plt' in globals() or 'plt' in locals():\n"
-            f"    import io\n"
-            f"    img_bytes = io.BytesIO()\n"
-            f"    plt.savefig(img_bytes, format='png')\n"
-            f"    img_bytes.seek(0)\n"
-            f"    plt.close()\n"
-            f"    import base64\n"
-            f"    encoded_image = base64.b64encode(img_bytes.getvalue()).decode('utf-8')\n"
-            f"    print(f'Image converted to bytes: {{encoded_image}}')"
-        )
+    # Remove any user-provided savefig or show statements
+    modified_code = re.sub(r'plt\.savefig\(.*\)', '', code)
+    modified_code = re.sub(r'plt\.show\(.*\)', '', modified_code)
 
-        result = repl.run(modified_code)
-    except BaseException as e:
-        return f"Failed to execute. Error: {repr(e)}"
+    result = await chart_pool.arender(modified_code)
+    if result["error"]:
+        return f"Failed to execute. Error: {result['error']}"
 
-    # Check if the result contains the encoded image
-    if 'Image converted to bytes:' in result:
+    if result["image"] is not None:
         try:
-            # Extract the base64 encoded image from the result
-            encoded_image = result.split('Image converted to bytes: ')[1].strip()
-
-            # Decode the base64 string back to bytes
-            img_bytes = io.BytesIO(base64.b64decode(encoded_image))
-
             # Now, upload to Google Cloud Storage
             link = await gcs.upload_and_download_file(
                 cred_path=init.SURIA_DB_SERVICE_ACCOUNT_FILE,
-                file_bytes=img_bytes,  # Pass the in-memory bytes directly
-                file_extension='png',
-                blob_name=f"{uuid.uuid4().hex}.png",
+                file_bytes=result["image"],  # Pass the image bytes directly
+                file_extension=init.CHART_FORMAT,
+                blob_name=f"{uuid.uuid4().hex}.{init.CHART_FORMAT}",
                 bucket_name=init.GCS_BUCKET_NAME
             )
             return link
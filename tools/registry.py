@@ -0,0 +1,116 @@
+# tools declared up front, imported on first call
+import importlib
+import importlib.util
+import logging
+import sys
+from types import ModuleType
+from typing import Any, Dict, Optional, Type
+
+from langchain_core.pydantic_v1 import BaseModel, Field, PrivateAttr
+from langchain_core.tools import BaseTool
+
+logger = logging.getLogger(__name__)
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Import a module on first attribute access instead of now, see importlib.util.LazyLoader."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+class LazyTool(BaseTool):
+    """A tool whose name, description and arguments are declared here, and whose implementation
+    is imported the first time it is called.
+
+    The LLM only needs the declaration to bind the tool, so building the agent graph no longer
+    imports the SQL agent, the Python REPL, matplotlib or the search client.
+
+    Args:
+        target (str): "module:attribute" of the implementation, a tool or a tool class.
+        target_kwargs (Dict[str, Any]): Arguments to build the tool with when target is a class.
+    """
+
+    target: str
+    target_kwargs: Dict[str, Any] = {}
+    _tool: Optional[BaseTool] = PrivateAttr(default=None)
+
+    def load(self) -> BaseTool:
+        if self._tool is None:
+            module_name, attribute = self.target.split(":")
+            tool = getattr(importlib.import_module(module_name), attribute)
+            if isinstance(tool, type):
+                tool = tool(**self.target_kwargs)
+            declared, actual = set(self.args), set(tool.args)
+            if declared != actual:
+                logger.warning("Tool %s is declared with %s but takes %s", self.name, sorted(declared), sorted(actual))
+            self._tool = tool
+        return self._tool
+
+    def _run(self, *args: Any, run_manager: Any = None, **kwargs: Any) -> Any:
+        callbacks = run_manager.get_child() if run_manager else None
+        return self.load().invoke(kwargs, {"callbacks": callbacks})
+
+    async def _arun(self, *args: Any, run_manager: Any = None, **kwargs: Any) -> Any:
+        callbacks = run_manager.get_child() if run_manager else None
+        return await self.load().ainvoke(kwargs, {"callbacks": callbacks})
+
+
+class DetermineDbToQueryInput(BaseModel):
+    user_input: str = Field(description="The natural language query or input provided by the user.")
+
+
+class PythonReplInput(BaseModel):
+    code: str = Field(description="The Python code to execute. Use print(...) to see the output of a value.")
+
+
+class TavilyInput(BaseModel):
+    query: str = Field(description="search query to look up")
+
+
+def _declare(name: str, description: str, args_schema: Type[BaseModel], target: str, **target_kwargs: Any) -> LazyTool:
+    return LazyTool(name=name, description=description, args_schema=args_schema, target=target, target_kwargs=target_kwargs)
+
+
+# Keep the descriptions in line with the docstrings of the implementations, they are what the LLM reads
+determine_db_to_query_tool = _declare(
+    "determine_db_to_query_tool",
+    "Route all SQL database queries through this tool to determine the appropriate database.\n\n"
+    "This tool serves as the entry point for any query related to the SQL databases. "
+    "It first utilizes an LLM to analyze the user's input and match it against existing vectors "
+    "in a MongoDB collection. This will then determine the appropriate database to be queried, "
+    "and the result is returned.\n\n"
+    "This tool should ALWAYS be invoked when the user's input involves querying a SQL database. "
+    "It ensures that the correct database is selected before any actual data retrieval occurs.",
+    DetermineDbToQueryInput,
+    "tools.database:determine_db_to_query_tool",
+)
+
+python_repl_tool = _declare(
+    "python_repl_tool",
+    "Execute Python code and return the output.\n\n"
+    "This tool allows you to execute a snippet of Python code. If the code produces "
+    "output, it will be captured and returned as a string. If the execution fails, "
+    "an error message will be returned instead.\n\n"
+    "Returns a message indicating the success or failure of the code execution. "
+    "If successful, the message will return a link in the form of a sring, which needs to sent "
+    "to the user in full. If there is an error, the error message is returned.",
+    PythonReplInput,
+    "tools.database:python_repl_tool",
+)
+
+tavily_search_tool = _declare(
+    "tavily_search_results_json",
+    "A search engine optimized for comprehensive, accurate, and trusted results. "
+    "Useful for when you need to answer questions about current events. "
+    "Input should be a search query.",
+    TavilyInput,
+    "langchain_community.tools.tavily_search.tool:TavilySearchResults",
+    max_results=1,
+)